@@ -0,0 +1,145 @@
+# bench/certdb_bench.py
+"""证书数据库压测：几十万张证书时按序列号 / CN / 指纹 / 到期时间查找，对比逐行扫描 index.txt
+
+在临时目录生成一个 -n 行的 index.txt（序列号连续、CN 互不相同、到期时间随机分布在
+未来 3 年内），计时导入 certs.db，再分别用两种方式查找随机挑选的 --lookups 个目标：
+    index_scan  每次从头读 index.txt（以前 issuer 检查重名、openssl 查序列号的方式）
+    certdb      pki/certdb.py 的索引查询
+index.txt 没有证书本身，导入后指纹为空，压测用序列号的 SHA-256 填一个合成指纹。
+同时对每种查询做 EXPLAIN QUERY PLAN，确认走的是索引（SEARCH）而不是全表扫描。
+
+    python bench/certdb_bench.py -n 200000
+
+结果以 JSON 输出：导入耗时、每次查找的平均耗时（微秒）和查询计划；--output 同时写入文件。
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.certdb import COLUMNS, TIME_FORMAT, CertDB, normalize_serial
+from pki.issuer import index_time
+
+FIRST_SERIAL = 0x10000
+
+
+def write_index(path, count, rng):
+    now = datetime.datetime(2026, 1, 1)
+    with open(path, "w") as f:
+        for i in range(count):
+            expires = now + datetime.timedelta(seconds=rng.randint(0, 3 * 365 * 86400))
+            f.write(f"V\t{index_time(expires)}\t\t{normalize_serial(FIRST_SERIAL + i)}\tunknown\t/CN=user{i}\n")
+
+
+def scan_index(path, predicate):
+    """逐行扫描 index.txt，返回满足条件的行"""
+    matches = []
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 6 and predicate(fields):
+                matches.append(fields)
+    return matches
+
+
+def scan_expiring(path, after, before):
+    # 都是 UTCTime（2049 年以前），可以直接按字符串比较
+    low, high = index_time(after), index_time(before)
+    return scan_index(path, lambda fields: fields[0] == "V" and low <= fields[1] < high)
+
+
+def timed(fn, targets):
+    """对每个目标调用一次 fn，返回平均耗时（微秒）"""
+    start = time.perf_counter()
+    for target in targets:
+        fn(target)
+    return round((time.perf_counter() - start) / len(targets) * 1e6, 1)
+
+
+def query_plan(db, sql, params):
+    rows = db._conn().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="证书数据库 vs index.txt 扫描（输出 JSON）")
+    parser.add_argument("-n", "--count", type=int, default=200000, help="证书条数")
+    parser.add_argument("--lookups", type=int, default=1000, help="certdb 每种查询的次数")
+    parser.add_argument("--scan-lookups", type=int, default=5, help="逐行扫描每种查询的次数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="certdb_bench_")
+    try:
+        index_path = os.path.join(workdir, "index.txt")
+        write_index(index_path, args.count, rng)
+        db = CertDB(os.path.join(workdir, "certs.db"))
+        start = time.perf_counter()
+        db.import_index(index_path, certs_dir=None)
+        import_seconds = time.perf_counter() - start
+        with db._conn() as conn:
+            conn.executemany("UPDATE certificates SET fingerprint = ? WHERE serial = ?",
+                             ((hashlib.sha256(serial.encode()).hexdigest(), serial)
+                              for (serial,) in conn.execute("SELECT serial FROM certificates").fetchall()))
+
+        picks = [rng.randrange(args.count) for _ in range(args.lookups)]
+        serials = [normalize_serial(FIRST_SERIAL + i) for i in picks]
+        names = [f"user{i}" for i in picks]
+        fingerprints = [hashlib.sha256(serial.encode()).hexdigest() for serial in serials]
+        week = datetime.timedelta(days=7)
+        windows = [datetime.datetime(2026, 1, 1) + datetime.timedelta(days=rng.randrange(3 * 365 - 7))
+                   for _ in range(args.lookups)]
+
+        scan = args.scan_lookups
+        index_scan = {
+            "serial": timed(lambda s: scan_index(index_path, lambda f: f[3] == s), serials[:scan]),
+            "common_name": timed(lambda n: scan_index(index_path, lambda f: f[5] == "/CN=" + n), names[:scan]),
+            "expiring_7d": timed(lambda w: scan_expiring(index_path, w, w + week), windows[:scan]),
+        }
+        certdb = {
+            "serial": timed(db.by_serial, serials),
+            "common_name": timed(db.by_common_name, names),
+            "fingerprint": timed(db.by_fingerprint, fingerprints),
+            "valid_subject": timed(lambda n: db.valid_subjects(["/CN=" + n]), names),
+            "expiring_7d": timed(lambda w: db.expiring(w + week, after=w), windows),
+        }
+        base = f"SELECT {COLUMNS} FROM certificates WHERE "
+        plans = {
+            "serial": query_plan(db, base + "serial = ?", (serials[0],)),
+            "common_name": query_plan(db, base + "common_name = ?", (names[0],)),
+            "fingerprint": query_plan(db, base + "fingerprint = ?", (fingerprints[0],)),
+            "valid_subject": query_plan(
+                db, "SELECT 1 FROM certificates WHERE subject = ? AND status = 'V' LIMIT 1", ("/CN=user1",)),
+            "expiring_7d": query_plan(
+                db, base + "status = 'V' AND not_after >= ? AND not_after < ? ORDER BY not_after",
+                (windows[0].strftime(TIME_FORMAT), (windows[0] + week).strftime(TIME_FORMAT))),
+        }
+        data = {
+            "certificates": args.count,
+            "import_seconds": round(import_seconds, 2),
+            "db_bytes": os.path.getsize(db.path),
+            "lookup_us": {"index_scan": index_scan, "certdb": certdb},
+            "query_plans": plans,
+            "all_indexed": all(not step.startswith("SCAN") for plan in plans.values() for step in plan),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(data, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
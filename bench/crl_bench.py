@@ -0,0 +1,133 @@
+# bench/crl_bench.py
+"""吊销检查压测：大 CRL 时发布完整 / 增量 CRL 的耗时，以及按序列号判断是否吊销的开销
+
+在临时目录中复制一份 ca/issuing，写入一个 -n 行的 index.txt（其中 --revoked 比例已吊销），
+导入 certs.db 后计时：
+    publish_full    重签完整 CRL（全部吊销记录）
+    revoke          吊销一张证书：更新 certs.db、重写 index.txt、只重签增量 CRL
+    index_load      RevocationIndex 解析完整 + 增量 CRL、校验签名、建哈希集合（重新加载的耗时）
+再对随机挑选的 --lookups 个序列号（一半已吊销）比较每次检查的耗时：
+    crl_scan        逐条遍历 CRL 中的吊销记录
+    crl_lookup      cryptography 的 get_revoked_certificate_by_serial_number
+    index           RevocationIndex.is_revoked（frozenset 查找）
+
+    python bench/crl_bench.py -n 200000 --revoked 0.1
+
+结果以 JSON 输出；--output 同时写入文件。
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.certdb import normalize_serial
+from pki.crl import CrlPublisher, RevocationIndex, load_crl
+from pki.issuer import Issuer, index_time
+
+ISSUING_DIR = "ca/issuing"
+CONFIG = "ca/issuing/issuing.cnf"
+CRL = "crl/issuing.crl.pem"
+DELTA_CRL = "crl/issuing-delta.crl.pem"
+FIRST_SERIAL = 0x10000
+
+
+def write_index(path, count, revoked, rng):
+    """最后一张证书保持有效，留给 revoke 计时"""
+    expires = index_time(datetime.datetime(2028, 1, 1))
+    revoked_at = index_time(datetime.datetime(2026, 1, 1))
+    with open(path, "w") as f:
+        for i in range(count):
+            serial = normalize_serial(FIRST_SERIAL + i)
+            if rng.random() < revoked and i < count - 1:
+                f.write(f"R\t{expires}\t{revoked_at},superseded\t{serial}\tunknown\t/CN=user{i}\n")
+            else:
+                f.write(f"V\t{expires}\t\t{serial}\tunknown\t/CN=user{i}\n")
+
+
+def timed(fn, targets):
+    """对每个目标调用一次 fn，返回平均耗时（微秒）"""
+    start = time.perf_counter()
+    for target in targets:
+        fn(target)
+    return round((time.perf_counter() - start) / len(targets) * 1e6, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CRL 发布与吊销检查的开销（输出 JSON）")
+    parser.add_argument("-n", "--count", type=int, default=200000, help="证书条数")
+    parser.add_argument("--revoked", type=float, default=0.1, help="已吊销的比例")
+    parser.add_argument("--lookups", type=int, default=10000, help="index 检查次数")
+    parser.add_argument("--scan-lookups", type=int, default=20, help="crl_scan / crl_lookup 检查次数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    root = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="crl_bench_")
+    try:
+        shutil.copytree(os.path.join(root, ISSUING_DIR), os.path.join(workdir, ISSUING_DIR))
+        os.chdir(workdir)
+        for name in os.listdir(ISSUING_DIR):
+            if name.startswith("certs.db"):
+                os.remove(os.path.join(ISSUING_DIR, name))
+        write_index(os.path.join(ISSUING_DIR, "index.txt"), args.count, args.revoked, rng)
+        issuer = Issuer(CONFIG)
+        crl_path, delta_path = os.path.join(ISSUING_DIR, CRL), os.path.join(ISSUING_DIR, DELTA_CRL)
+        publisher = CrlPublisher(issuer, crl_path, delta_path)
+
+        start = time.perf_counter()
+        publisher.publish_full()
+        publish_seconds = time.perf_counter() - start
+        target = normalize_serial(FIRST_SERIAL + args.count - 1)
+        start = time.perf_counter()
+        if not publisher.revoke(target, "keyCompromise"):
+            sys.exit(f"[-] {target} is not a valid certificate")
+        revoke_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = RevocationIndex((crl_path, delta_path), os.path.join(ISSUING_DIR, "certs/issuing.crt"))
+        load_seconds = time.perf_counter() - start
+        full = load_crl(crl_path)
+        entries = list(full)
+
+        revoked = [entry.serial_number for entry in entries]
+        picks = [rng.choice(revoked) if i % 2 else FIRST_SERIAL + rng.randrange(args.count)
+                 for i in range(args.lookups)]
+        scan = picks[:args.scan_lookups]
+        data = {
+            "certificates": args.count,
+            "revoked": len(index),
+            "crl_bytes": os.path.getsize(crl_path),
+            "delta_crl_bytes": os.path.getsize(delta_path),
+            "seconds": {
+                "publish_full": round(publish_seconds, 3),
+                "revoke": round(revoke_seconds, 3),
+                "index_load": round(load_seconds, 3),
+            },
+            "check_us": {
+                "crl_scan": timed(lambda s: any(entry.serial_number == s for entry in entries), scan),
+                "crl_lookup": timed(full.get_revoked_certificate_by_serial_number, scan),
+                "index": timed(index.is_revoked, picks),
+            },
+            "revoked_target_found": index.is_revoked(target),
+        }
+    finally:
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(data, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
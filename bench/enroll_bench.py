@@ -0,0 +1,101 @@
+# bench/enroll_bench.py
+"""注册签发证书的延迟：当场生成私钥 vs 从密钥池取现成私钥
+
+与 web/enrollment.py 相同的步骤：取得私钥 -> 签发证书 -> 用密码加密私钥拼成 PEM。
+在临时目录中复制一份 ca/issuing，密钥池也建在临时目录（先用 --workers 个进程填满，
+填充时间单独报告，不计入签发延迟）。
+
+    python bench/enroll_bench.py -n 50
+
+结果以 JSON 输出：两种方式每次签发的延迟 p50/p99/max（毫秒）；--output 同时写入文件。
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.issuer import Issuer, generate_key
+from pki.keypool import KEYPOOL_WORKERS, KeyPool
+from web.enrollment import Enrollment
+
+from load_bench import percentile
+
+ISSUING_DIR = "ca/issuing"
+CONFIG = "ca/issuing/issuing.cnf"
+
+
+class InlineKeys:
+    """不用密钥池：每次当场生成"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def take(self):
+        return generate_key(self._pool.key_type)
+
+
+def measure(enrollment, prefix, count):
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        enrollment.enroll(f"{prefix}{i}", "bench-password")
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        "enrollments": count,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(latencies[-1], 2),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="注册签发证书延迟：密钥池 vs 当场生成（输出 JSON）")
+    parser.add_argument("-n", "--count", type=int, default=50, help="每种方式签发的证书数")
+    parser.add_argument("--workers", type=int, default=KEYPOOL_WORKERS, help="填充密钥池的进程数")
+    parser.add_argument("--key-type", choices=("rsa", "ec"), default="rsa")
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    args = parser.parse_args()
+
+    root = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="enroll_bench_")
+    try:
+        shutil.copytree(os.path.join(root, ISSUING_DIR), os.path.join(workdir, ISSUING_DIR))
+        os.chdir(workdir)
+        issuer = Issuer(CONFIG)
+        pool = KeyPool("keypool", secret="bench", size=args.count, workers=args.workers, key_type=args.key_type)
+        start = time.perf_counter()
+        pool.fill()
+        fill_seconds = time.perf_counter() - start
+
+        data = {
+            "key_type": args.key_type,
+            "inline": measure(Enrollment(issuer, InlineKeys(pool)), "inline-", args.count),
+            "pool": measure(Enrollment(issuer, pool), "pool-", args.count),
+            "pool_fill": {
+                "keys": args.count,
+                "workers": args.workers,
+                "seconds": round(fill_seconds, 2),
+                "keys_per_sec": round(args.count / fill_seconds, 1),
+            },
+            "pool_misses": pool.stats()["misses"],
+        }
+    finally:
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(data, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# bench/handshake_bench.py
+"""TLS 握手压测：对比完整握手和会话恢复的握手速率
+
+模拟频繁断线重连的移动端：反复 连接 -> 握手 -> 读取欢迎行 -> 断开。
+先用一个连接跑完整握手（每次不带 session），再用上一次连接得到的 session 重连。
+
+    python server/chat_server.py &
+    python bench/handshake_bench.py -n 500
+    python bench/handshake_bench.py -n 500 --tls12
+
+服务器用 --session-tickets 0 启动可以作对照（TLS 1.3 下恢复全部失败）。
+结果以 JSON 输出：每秒握手数、延迟分位数（毫秒）和实际恢复成功的比例。
+"""
+import argparse
+import json
+import os
+import socket
+import ssl
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.tls import create_client_context
+
+CLIENT_CERT = "client/client_fullchain.crt"
+CLIENT_KEY = "client/client.key"
+
+
+def handshake_once(context, host, port, session=None):
+    """完成一次连接和握手，返回 (耗时秒, 是否恢复, 新的 session)"""
+    start = time.perf_counter()
+    sock = socket.create_connection((host, port))
+    tls = context.wrap_socket(sock, server_hostname="localhost", session=session)
+    # 读到服务器的第一行数据：TLS 1.3 的 session ticket 随它一起到达
+    tls.recv(1024)
+    elapsed = time.perf_counter() - start
+    reused = tls.session_reused
+    new_session = tls.session
+    tls.close()
+    return elapsed, reused, new_session
+
+
+def run(context, host, port, count, resume):
+    latencies = []
+    resumed = 0
+    session = None
+    if resume:
+        # 预热：先做一次完整握手拿到 session
+        _, _, session = handshake_once(context, host, port)
+    start = time.perf_counter()
+    for _ in range(count):
+        elapsed, reused, new_session = handshake_once(context, host, port, session if resume else None)
+        latencies.append(elapsed)
+        resumed += reused
+        if resume and new_session is not None:
+            session = new_session
+    total = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "handshakes": count,
+        "handshakes_per_sec": round(count / total, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+        "resumed_ratio": round(resumed / count, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS 完整握手 vs 会话恢复压测")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4433)
+    parser.add_argument("-n", "--count", type=int, default=200, help="每种方式的握手次数")
+    parser.add_argument("--tls12", action="store_true", help="限制为 TLS 1.2（使用 session ticket/会话缓存）")
+    args = parser.parse_args()
+
+    context = create_client_context(CLIENT_CERT, CLIENT_KEY)
+    if args.tls12:
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+    full = run(context, args.host, args.port, args.count, resume=False)
+    resumed = run(context, args.host, args.port, args.count, resume=True)
+    result = {
+        "tls_version": "1.2" if args.tls12 else "1.3",
+        "full": full,
+        "resumed": resumed,
+        "speedup": round(resumed["handshakes_per_sec"] / full["handshakes_per_sec"], 2),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
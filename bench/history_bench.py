@@ -0,0 +1,232 @@
+# bench/history_bench.py
+"""历史消息负载压测：逐条字典（rows）与列式编码（columns）的帧大小、编解码耗时和切换聊天室延迟
+
+离线部分（总是运行）：生成一页 --limit 条、正文约 --text-size 个字符的消息，按服务器实际发送的
+Socket.IO 帧（42["room_history",{...}]）计算两种格式的字节数，以及经 permessage-deflate
+（raw deflate，每条消息 SYNC_FLUSH，与 WebSocket 扩展相同）压缩后的字节数和编解码耗时：
+
+    python bench/history_bench.py --limit 100 --text-size 200
+
+在线部分（给出 --url 时）：登录后在两个填满历史的聊天室之间反复切换，测量从发出 switch_room 到收到
+room_history 的往返延迟，WebSocket 压缩开、关各测一次。服务器分别用 CHAT_HISTORY_FORMAT=rows 和
+columns 启动，对比两次输出（需要 pip install "python-socketio[asyncio_client]" aiohttp）：
+
+    CHAT_HISTORY_FORMAT=rows python web/app.py &
+    python bench/history_bench.py --url https://localhost:8443 --switches 200
+
+结果以 JSON 输出，--output 同时写入文件。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import ssl
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "web"))
+from history_codec import CompactJSON, decode_history, encode_history
+
+from load_bench import percentile
+
+# 中英文混合的词表，接近聊天内容的可压缩性
+WORDS = ("证书 握手 会话 聊天室 消息 服务器 客户端 加密 签名 吊销 "
+         "the TLS cert session ticket ok thanks see you later :) lol").split()
+
+
+def make_history(count, text_size, seed):
+    rng = random.Random(seed)
+    users = [f"user{k}" for k in range(20)]
+    start = datetime(2026, 1, 1, 9, 0, 0)
+    history = []
+    message_id = 1000
+    for i in range(count):
+        message_id += 1 if rng.random() < 0.9 else rng.randint(2, 50)
+        start += timedelta(seconds=rng.randint(0, 120))
+        words = []
+        while sum(len(w) + 1 for w in words) < text_size:
+            words.append(rng.choice(WORDS))
+        timestamp = start.strftime("%Y-%m-%d %H:%M:%S")
+        history.append({
+            "id": message_id,
+            "user": rng.choice(users),
+            "text": " ".join(words),
+            "time": timestamp.split(" ")[1],
+            "timestamp": timestamp,
+            "room": "general",
+            "type": "room",
+        })
+    return history
+
+
+def socketio_frame(payload, dumps):
+    """与 python-socketio 的 EVENT 包相同的文本帧"""
+    return ("42" + dumps(["room_history", payload], separators=(",", ":"))).encode("utf-8")
+
+
+def deflated_size(frame):
+    """permessage-deflate 压缩后的大小：raw deflate，SYNC_FLUSH 后去掉末尾 4 字节"""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+def timed(fn, iterations, repeat=5):
+    """每次调用的耗时（微秒），取 repeat 轮中最快的一轮"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / iterations * 1e6, 1)
+
+
+def offline(args):
+    history = make_history(args.limit, args.text_size, args.seed)
+    page = {"room": "general", "has_more": True, "before_id": None, "after_id": None}
+    variants = {
+        "rows": (lambda: dict(page, history=history), json.dumps),
+        "rows_utf8": (lambda: dict(page, history=history), CompactJSON.dumps),
+        "columns": (lambda: dict(page, format="columns", history=encode_history(history)), json.dumps),
+        "columns_utf8": (lambda: dict(page, format="columns", history=encode_history(history)), CompactJSON.dumps),
+    }
+    result = {}
+    for name, (build, dumps) in variants.items():
+        frame = socketio_frame(build(), dumps)
+        if name.startswith("columns"):
+            decode = lambda: decode_history(json.loads(frame[2:])[1]["history"], room="general", type="room")
+        else:
+            decode = lambda: json.loads(frame[2:])[1]["history"]
+        result[name] = {
+            "bytes": len(frame),
+            "deflated_bytes": deflated_size(frame),
+            "encode_us": timed(lambda: socketio_frame(build(), dumps), args.iterations),
+            "decode_us": timed(decode, args.iterations),
+        }
+    check = decode_history(encode_history(history), room="general", type="room")
+    assert check == history, "columns 编码往返结果与原数据不一致"
+    return result
+
+
+# ---------------- 在线部分：切换聊天室的往返延迟 ----------------
+
+async def login(http, args):
+    form = {"username": args.user, "password": args.password, "confirm_password": args.password}
+    for path in ("/", "/register"):
+        async with http.post(args.url + path, data=form, allow_redirects=False) as resp:
+            if resp.status in (301, 302, 303) and "session" in resp.cookies:
+                return resp.cookies["session"].value
+    raise ConnectionError(f"login failed for {args.user}")
+
+
+async def measure_switches(socketio, http, cookie, args, compress):
+    sio = socketio.AsyncClient(http_session=http, reconnection=False, websocket_extra_options={
+        "headers": {"Cookie": f"session={cookie}"},
+        "compress": 15 if compress else 0,
+    })
+    waiting = {}
+    sizes = []
+    counts = {}
+
+    def on_history(data):
+        sizes.append(len(json.dumps(data, ensure_ascii=False).encode("utf-8")))
+        history = data.get("history") or []
+        counts[data.get("room")] = len(history["id"]) if isinstance(history, dict) else len(history)
+        future = waiting.pop(data.get("room"), None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    sio.on("room_history", on_history)
+    await sio.connect(args.url, transports=["websocket"], wait_timeout=args.timeout)
+    rooms = [f"history-bench-{k}" for k in ("a", "b")]
+    text = make_history(1, args.text_size, args.seed)[0]["text"]
+
+    async def switch(room, event="switch_room"):
+        future = asyncio.get_running_loop().create_future()
+        waiting[room] = future
+        await sio.emit(event, {"room_name": room})
+        await asyncio.wait_for(future, args.timeout)
+
+    # 准备两个各有至少 --limit 条消息的聊天室（已存在时 create_room 只回一条系统消息）
+    for room in rooms:
+        await sio.emit("create_room", {"room_name": room})
+        await asyncio.sleep(0.2)
+        await switch(room, "join_room")
+        for i in range(counts.get(room, 0), args.limit):
+            await sio.emit("chat_message", {"text": f"{i} {text}"})
+    await asyncio.sleep(1)
+
+    latencies = []
+    sizes.clear()
+    for i in range(args.switches):
+        room = rooms[i % 2]
+        start = time.perf_counter()
+        await switch(room)
+        latencies.append((time.perf_counter() - start) * 1000)
+    await sio.disconnect()
+    latencies.sort()
+    return {
+        "switches": len(latencies),
+        "payload_bytes": round(sum(sizes) / len(sizes)) if sizes else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+        },
+    }
+
+
+async def online(args):
+    try:
+        import aiohttp
+        import socketio
+    except ImportError as e:
+        sys.exit(f"在线部分需要 python-socketio 和 aiohttp: {e}")
+
+    context = ssl.create_default_context(cafile=args.cafile)
+    if args.insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    connector = aiohttp.TCPConnector(ssl=context)
+    async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar()) as http:
+        cookie = await login(http, args)
+        result = {}
+        for compress in (False, True):
+            result["deflate" if compress else "plain"] = await measure_switches(socketio, http, cookie, args, compress)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="历史消息负载压测（输出 JSON）")
+    parser.add_argument("--limit", type=int, default=100, help="每页消息条数（与 ROOM_HISTORY_LIMIT 一致）")
+    parser.add_argument("--text-size", type=int, default=200, help="每条消息正文的大致字符数")
+    parser.add_argument("--iterations", type=int, default=200, help="离线部分编解码计时的重复次数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--url", help="web/app.py 的地址，给出时运行在线部分")
+    parser.add_argument("--user", default="history-bench")
+    parser.add_argument("--password", default="bench-password")
+    parser.add_argument("--switches", type=int, default=200, help="在线部分切换聊天室的次数")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--cafile", default="ca-chain.crt", help="校验服务器证书用的 CA 链")
+    parser.add_argument("--insecure", action="store_true", help="不校验服务器证书（本机自测）")
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    args = parser.parse_args()
+
+    result = {
+        "page": {"limit": args.limit, "text_size": args.text_size},
+        "offline": offline(args),
+    }
+    if args.url:
+        result["online"] = asyncio.run(online(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
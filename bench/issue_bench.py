@@ -0,0 +1,116 @@
+# bench/issue_bench.py
+"""证书签发压测：每张证书启动一次 openssl ca 对比进程内签发（pki/issuer.py）
+
+在临时目录中复制一份 ca/issuing（不改动仓库里的 index.txt、serial），预先生成 CSR
+（P-256 私钥，生成时间不计入），然后分别计时：
+    openssl    每张证书运行一次 openssl ca -batch，与以前手工签发相同
+    issuer     进程内签发，整批一次分配序列号、一次追加 index.txt
+    issuer_mp  同上，签名分给 --workers 个进程
+
+    python bench/issue_bench.py -n 2000 --openssl-count 100
+
+结果以 JSON 输出：每种方式的证书数、耗时和每秒签发数；--output 同时写入文件。
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from pki.issuer import Issuer
+
+ISSUING_DIR = "ca/issuing"
+CONFIG = "ca/issuing/issuing.cnf"
+
+
+def make_csrs(prefix, count):
+    key = ec.generate_private_key(ec.SECP256R1())
+    csrs = []
+    for i in range(count):
+        # 所有 CSR 共用一把私钥：只影响 CSR 的生成速度，签发时每个 CSR 仍单独验签
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, f"{prefix}{i}")])
+        csrs.append(x509.CertificateSigningRequestBuilder().subject_name(name).sign(key, hashes.SHA256()))
+    return csrs
+
+
+def result(count, elapsed):
+    return {
+        "certs": count,
+        "seconds": round(elapsed, 3),
+        "certs_per_sec": round(count / elapsed, 1) if elapsed else None,
+    }
+
+
+def bench_openssl(csrs):
+    os.makedirs("requests", exist_ok=True)
+    paths = []
+    for i, csr in enumerate(csrs):
+        path = os.path.join("requests", f"{i}.csr")
+        with open(path, "wb") as f:
+            f.write(csr.public_bytes(serialization.Encoding.PEM))
+        paths.append(path)
+    start = time.perf_counter()
+    for path in paths:
+        subprocess.run(["openssl", "ca", "-config", CONFIG, "-batch", "-notext",
+                        "-in", path, "-out", path[:-4] + ".crt"],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result(len(paths), time.perf_counter() - start)
+
+
+def bench_issuer(csrs, workers):
+    start = time.perf_counter()
+    issuer = Issuer(CONFIG)
+    loaded = time.perf_counter()
+    certs = issuer.issue(csrs, workers=workers)
+    data = result(len(certs), time.perf_counter() - loaded)
+    data["load_ms"] = round((loaded - start) * 1000, 2)
+    data["workers"] = workers
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="openssl ca 与进程内签发的吞吐对比（输出 JSON）")
+    parser.add_argument("-n", "--count", type=int, default=2000, help="进程内签发的证书数")
+    parser.add_argument("--openssl-count", type=int, default=100, help="逐张运行 openssl ca 的证书数（0 跳过）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="issuer_mp 的签名进程数")
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    args = parser.parse_args()
+
+    root = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="issue_bench_")
+    try:
+        shutil.copytree(os.path.join(root, ISSUING_DIR), os.path.join(workdir, ISSUING_DIR))
+        # issuing.cnf 中的 dir = ./ca/issuing 相对于当前目录
+        os.chdir(workdir)
+        data = {"cpu_count": os.cpu_count()}
+        if args.openssl_count:
+            data["openssl"] = bench_openssl(make_csrs("openssl-", args.openssl_count))
+        data["issuer"] = bench_issuer(make_csrs("issuer-", args.count), workers=1)
+        if args.workers > 1:
+            data["issuer_mp"] = bench_issuer(make_csrs("issuer-mp-", args.count), workers=args.workers)
+        if "openssl" in data:
+            data["speedup"] = round(data["issuer"]["certs_per_sec"] / data["openssl"]["certs_per_sec"], 1)
+        with open(os.path.join(ISSUING_DIR, "index.txt")) as f:
+            data["index_lines"] = sum(1 for _ in f)
+    finally:
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(data, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
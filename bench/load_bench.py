@@ -0,0 +1,385 @@
+# bench/load_bench.py
+"""聊天服务器负载压测：大量并发 mTLS 连接 + 按速率发消息，测握手、端到端延迟和扇出吞吐
+
+两个目标：
+    tcp  server/chat_server.py 的原生 TLS 协议（所有人在同一个广播里）
+    web  web/app.py 的 Socket.IO 接口（需要 pip install "python-socketio[asyncio_client]" aiohttp）
+
+    python server/chat_server.py --stats-interval 10 &
+    python bench/load_bench.py tcp -c 2000 --rate 200 --duration 30 --server-pid $!
+
+    python web/app.py &
+    python bench/load_bench.py web -c 500 --rooms 10 --room-dist zipf --rate 100 --server-pid $!
+
+每条消息的正文是 bench:<发送者>:<序号>:<发送时刻 ns>，收到时用同一个进程的单调时钟算端到端延迟。
+连接阶段之后按 --rate（全体合计，条/秒）从 --senders 比例的连接中随机挑选发送者，持续 --duration 秒，
+再等待 --drain 秒收尾。结果以 JSON 输出（--output 同时写入文件），便于跟踪回归：
+    handshakes_per_sec   连接阶段每秒完成的 TLS 连接（web 目标为 Socket.IO 连接，登录单独计时）
+    latency_ms           消息从发出到各接收者收到的 p50/p99/max
+    deliveries_per_sec   测量期间每秒收到的消息份数（扇出吞吐）
+    server_rss_mb        --server-pid 及其子进程（多进程模式的 worker）的常驻内存，峰值和结束时
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import ssl
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.protocol import LineDecoder, MAX_INCOMING_FRAME, READ_SIZE
+from server.tls import create_client_context
+
+CLIENT_CERT = "client/client_fullchain.crt"
+CLIENT_KEY = "client/client.key"
+
+MARK = "bench:"
+# 发送调度的时间片（秒）
+TICK = 0.01
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class Recorder:
+    """收集握手耗时、消息延迟和投递计数"""
+
+    def __init__(self):
+        self.handshakes = []
+        self.latencies = []
+        self.connect_errors = 0
+        self.sent = 0
+        self.expected = 0
+        self.deliveries = 0
+        self.measuring = False
+        self.measured = 0
+
+    def message(self, sender):
+        self.sent += 1
+        return f"{MARK}{sender}:{self.sent}:{time.perf_counter_ns()}"
+
+    def received(self, text):
+        at = text.find(MARK)
+        if at < 0 or not self.measuring:
+            return
+        sent_ns = int(text[at:].split(":", 3)[3].split()[0])
+        self.deliveries += 1
+        self.latencies.append((time.perf_counter_ns() - sent_ns) / 1e6)
+
+
+class RssSampler:
+    """定时读取 /proc 中服务器进程（及其子进程）的 VmRSS"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+
+    def _pids(self):
+        """服务器进程及其全部后代"""
+        pids = [self.pid]
+        for pid in pids:
+            try:
+                for task in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{task}/children") as f:
+                        pids.extend(int(p) for p in f.read().split())
+            except FileNotFoundError:
+                pass
+        return pids
+
+    def sample(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1])
+            except FileNotFoundError:
+                pass
+        self.last = total
+        self.peak = max(self.peak, total)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def summary(self):
+        return {"peak": round(self.peak / 1024, 1), "end": round(self.last / 1024, 1)}
+
+
+# ---------------- tcp 目标：server/chat_server.py ----------------
+
+class TcpClient:
+    def __init__(self, index):
+        self.name = f"bench{index}"
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, args, context, rec):
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(
+            args.host, args.port, ssl=context, server_hostname="localhost")
+        rec.handshakes.append(time.perf_counter() - start)
+        self.writer.write(f"LOGIN:{self.name}\n".encode("utf-8"))
+        decoder = LineDecoder(MAX_INCOMING_FRAME)
+        while True:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("closed during login")
+            for frame in decoder.feed(data):
+                if frame.startswith(b"Welcome"):
+                    return decoder
+                if b"already in use" in frame:
+                    raise ConnectionError(f"{self.name} already in use")
+
+    async def receive(self, decoder, rec):
+        while True:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return
+            for frame in decoder.feed(data):
+                rec.received(frame.decode("utf-8", errors="replace"))
+
+    def send(self, rec):
+        self.writer.write((rec.message(self.name) + "\n").encode("utf-8"))
+
+
+async def run_tcp(args, rec):
+    context = create_client_context(CLIENT_CERT, CLIENT_KEY)
+    slots = asyncio.Semaphore(args.connect_concurrency)
+    clients = [TcpClient(i) for i in range(args.connections)]
+    readers = []
+
+    async def open_one(client):
+        async with slots:
+            try:
+                decoder = await asyncio.wait_for(client.connect(args, context, rec), args.connect_timeout)
+            except (OSError, ssl.SSLError, ConnectionError, asyncio.TimeoutError):
+                rec.connect_errors += 1
+                return None
+        readers.append(asyncio.ensure_future(client.receive(decoder, rec)))
+        return client
+
+    start = time.perf_counter()
+    connected = [c for c in await asyncio.gather(*(open_one(c) for c in clients)) if c is not None]
+    connect_time = time.perf_counter() - start
+
+    # 所有人在同一个广播里，每条消息投递给全部在线连接
+    await drive(args, rec, connected, lambda client: len(connected))
+
+    for client in connected:
+        client.writer.close()
+    for task in readers:
+        task.cancel()
+    return connected, connect_time, {"rooms": 1}
+
+
+# ---------------- web 目标：web/app.py 的 Socket.IO ----------------
+
+def pick_rooms(args):
+    """按 --room-dist 给每个连接分配聊天室"""
+    names = ["general"] + [f"bench-room-{k}" for k in range(1, args.rooms)]
+    if args.room_dist == "zipf":
+        weights = [1 / (k + 1) for k in range(len(names))]
+    else:
+        weights = [1] * len(names)
+    rng = random.Random(args.seed)
+    return names, rng.choices(names, weights, k=args.connections)
+
+
+class WebClient:
+    def __init__(self, index, room):
+        self.name = f"bench{index}"
+        self.room = room
+        self.cookie = None
+        self.sio = None
+
+    async def login(self, http, args):
+        """登录（用户不存在时注册），记下 Flask 的 session cookie"""
+        form = {"username": self.name, "password": args.password, "confirm_password": args.password}
+        for path in ("/", "/register"):
+            async with http.post(args.url + path, data=form, allow_redirects=False) as resp:
+                if resp.status in (301, 302, 303) and "session" in resp.cookies:
+                    self.cookie = resp.cookies["session"].value
+                    return
+        raise ConnectionError(f"login failed for {self.name}")
+
+    async def connect(self, socketio, http, args, rec):
+        start = time.perf_counter()
+        # 共用的 http 会话不保存 cookie（每个连接是不同的用户），直接放进 WebSocket 握手的请求头
+        self.sio = socketio.AsyncClient(http_session=http, reconnection=False,
+                                        websocket_extra_options={"headers": {"Cookie": f"session={self.cookie}"}})
+        self.sio.on("chat_message", lambda msg: rec.received(msg.get("text", "")))
+        # 服务器繁忙时命名空间的连接确认可能晚于默认的 1 秒
+        await self.sio.connect(args.url, transports=["websocket"], wait_timeout=args.connect_timeout)
+        rec.handshakes.append(time.perf_counter() - start)
+
+    def send(self, rec):
+        asyncio.ensure_future(self.sio.emit("chat_message", {"text": rec.message(self.name)}))
+
+
+async def run_web(args, rec):
+    try:
+        import aiohttp
+        import socketio
+    except ImportError as e:
+        sys.exit(f"web 目标需要 python-socketio 和 aiohttp: {e}")
+
+    context = create_client_context(CLIENT_CERT, CLIENT_KEY)
+    names, assignment = pick_rooms(args)
+    clients = [WebClient(i, room) for i, room in enumerate(assignment)]
+    slots = asyncio.Semaphore(args.connect_concurrency)
+    # 每个模拟用户用独立的 TCP 连接，不复用 keep-alive
+    connector = aiohttp.TCPConnector(ssl=context, limit=0, force_close=True)
+    errors = (OSError, ssl.SSLError, ConnectionError, asyncio.TimeoutError, socketio.exceptions.ConnectionError)
+
+    async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar()) as http:
+        async def step(client, action):
+            async with slots:
+                try:
+                    await asyncio.wait_for(action, args.connect_timeout)
+                except errors:
+                    rec.connect_errors += 1
+                    return None
+            return client
+
+        # 先全部登录（服务器端的密码哈希很耗 CPU），再单独计时 Socket.IO 连接
+        start = time.perf_counter()
+        logged_in = [c for c in await asyncio.gather(*(step(c, c.login(http, args)) for c in clients)) if c]
+        login_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        connected = [c for c in await asyncio.gather(
+            *(step(c, c.connect(socketio, http, args, rec)) for c in logged_in)) if c]
+        connect_time = time.perf_counter() - start
+
+        # 每个聊天室由第一个成员创建（已存在时服务器只回一条系统消息），其余成员加入
+        members = {}
+        for client in connected:
+            members.setdefault(client.room, []).append(client)
+        for room, group in members.items():
+            if room != "general":
+                await group[0].sio.emit("create_room", {"room_name": room})
+        await asyncio.sleep(1)
+        for room, group in members.items():
+            if room != "general":
+                await asyncio.gather(*(c.sio.emit("join_room", {"room_name": room}) for c in group))
+        await asyncio.sleep(1)
+
+        await drive(args, rec, connected, lambda client: len(members[client.room]))
+
+        await asyncio.gather(*(c.sio.disconnect() for c in connected), return_exceptions=True)
+
+    sizes = sorted((len(group) for group in members.values()), reverse=True)
+    topology = {"rooms": len(names), "room_dist": args.room_dist, "room_sizes": sizes,
+                "logins_per_sec": round(len(logged_in) / login_time, 1) if login_time else None}
+    return connected, connect_time, topology
+
+
+# ---------------- 发送调度和结果 ----------------
+
+async def drive(args, rec, connected, fanout_of):
+    """按速率从发送者中随机挑选连接发消息，持续 duration 秒，再等待 drain 秒"""
+    if not connected:
+        return
+    rng = random.Random(args.seed)
+    senders = connected[:max(1, int(len(connected) * args.senders))]
+    rec.measuring = True
+    started = time.perf_counter()
+    sent = 0
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= args.duration:
+            break
+        # 按已经过去的时间补齐应发条数，事件循环繁忙时不会少发
+        while sent < args.rate * elapsed:
+            sent += 1
+            client = rng.choice(senders)
+            client.send(rec)
+            rec.expected += fanout_of(client)
+        await asyncio.sleep(TICK)
+    await asyncio.sleep(args.drain)
+    rec.measured = time.perf_counter() - started
+
+
+async def run(args):
+    rec = Recorder()
+    sampler = None
+    if args.server_pid:
+        sampler = RssSampler(args.server_pid)
+        sampler.sample()
+        baseline = sampler.summary()["end"]
+        sampler_task = asyncio.ensure_future(sampler.run())
+
+    target = run_tcp if args.target == "tcp" else run_web
+    connected, connect_time, topology = await target(args, rec)
+
+    handshakes = sorted(rec.handshakes)
+    latencies = sorted(rec.latencies)
+    measured = rec.measured or 1
+    result = {
+        "target": args.target,
+        "connections": {"requested": args.connections, "connected": len(connected), "errors": rec.connect_errors},
+        "topology": topology,
+        "handshakes_per_sec": round(len(handshakes) / connect_time, 1) if connect_time else None,
+        "handshake_ms": {
+            "p50": round(percentile(handshakes, 0.5) * 1000, 3) if handshakes else None,
+            "p99": round(percentile(handshakes, 0.99) * 1000, 3) if handshakes else None,
+        },
+        "messages": {"rate": args.rate, "sent": rec.sent, "expected_deliveries": rec.expected,
+                     "deliveries": rec.deliveries},
+        "deliveries_per_sec": round(rec.deliveries / measured, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5), 3) if latencies else None,
+            "p99": round(percentile(latencies, 0.99), 3) if latencies else None,
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+    }
+    if sampler is not None:
+        sampler_task.cancel()
+        sampler.sample()
+        result["server_rss_mb"] = dict(sampler.summary(), baseline=baseline)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天服务器负载压测（输出 JSON）")
+    parser.add_argument("target", choices=("tcp", "web"),
+                        help="tcp：server/chat_server.py；web：web/app.py 的 Socket.IO")
+    parser.add_argument("--host", default="127.0.0.1", help="tcp 目标的地址")
+    parser.add_argument("--port", type=int, default=4433, help="tcp 目标的端口")
+    parser.add_argument("--url", default="https://localhost:8443", help="web 目标的地址")
+    parser.add_argument("--password", default="bench-password", help="web 目标压测用户的密码")
+    parser.add_argument("-c", "--connections", type=int, default=1000, help="并发连接数")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="同时进行的连接/握手数")
+    parser.add_argument("--connect-timeout", type=float, default=30)
+    parser.add_argument("--rate", type=float, default=100, help="全体合计每秒发送的消息数")
+    parser.add_argument("--senders", type=float, default=0.1, help="参与发送的连接比例")
+    parser.add_argument("--duration", type=float, default=10, help="发送阶段持续秒数")
+    parser.add_argument("--drain", type=float, default=2, help="停止发送后等待投递完成的秒数")
+    parser.add_argument("--rooms", type=int, default=1, help="web 目标：聊天室数（含 general）")
+    parser.add_argument("--room-dist", choices=("uniform", "zipf"), default="uniform",
+                        help="web 目标：连接在聊天室之间的分布")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server-pid", type=int, help="服务器进程号，用于采样 RSS（含子进程）")
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
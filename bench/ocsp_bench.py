@@ -0,0 +1,110 @@
+# bench/ocsp_bench.py
+"""OCSP 响应器压测：每次现签 vs 命中缓存的响应耗时，以及 OCSP 响应和完整 CRL 的大小
+
+在临时目录中复制一份 ca/issuing，写入一个 -n 行的 index.txt（其中 --revoked 比例已吊销），
+导入 certs.db 后对随机挑选的 --lookups 个序列号计时：
+    sign        缓存未命中：查 certs.db 并签名（OcspResponder 清空缓存后的第一次请求）
+    cached      命中缓存：直接返回签好的 DER
+    request     完整请求路径：解析 DER 请求、核对签发者哈希、命中缓存
+    verify      客户端校验一个 stapled 响应（pki/ocsp.verify_response）
+另外记录一条 OCSP 响应的字节数和完整 CRL 的字节数（后者是不用 OCSP 时每个客户端要下载的量）。
+
+    python bench/ocsp_bench.py -n 200000 --revoked 0.1
+
+结果以 JSON 输出；--output 同时写入文件。
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.certdb import normalize_serial
+from pki.crl import CrlPublisher
+from pki.issuer import Issuer
+from pki.ocsp import OcspResponder, build_request, load_certificate, verify_response
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from crl_bench import CONFIG, CRL, DELTA_CRL, FIRST_SERIAL, ISSUING_DIR, timed, write_index
+
+SERVER_CERT = "server/server.crt"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCSP 响应耗时与大小（输出 JSON）")
+    parser.add_argument("-n", "--count", type=int, default=200000, help="证书条数")
+    parser.add_argument("--revoked", type=float, default=0.1, help="已吊销的比例")
+    parser.add_argument("--lookups", type=int, default=2000, help="每种计时的次数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="同时把 JSON 结果写入该文件")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    root = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="ocsp_bench_")
+    try:
+        shutil.copytree(os.path.join(root, ISSUING_DIR), os.path.join(workdir, ISSUING_DIR))
+        os.chdir(workdir)
+        for name in os.listdir(ISSUING_DIR):
+            if name.startswith("certs.db"):
+                os.remove(os.path.join(ISSUING_DIR, name))
+        write_index(os.path.join(ISSUING_DIR, "index.txt"), args.count, args.revoked, rng)
+        issuer = Issuer(CONFIG)
+        crl_path = os.path.join(ISSUING_DIR, CRL)
+        CrlPublisher(issuer, crl_path, os.path.join(ISSUING_DIR, DELTA_CRL)).publish_full()
+        responder = OcspResponder(issuer)
+
+        # 同一个序列号可能被挑中两次，sign 计时前各自清空缓存，保证每次都是现签
+        serials = [FIRST_SERIAL + rng.randrange(args.count) for _ in range(args.lookups)]
+
+        def sign(serial):
+            responder.clear()
+            return responder.response_for(serial)
+
+        sign_us = timed(sign, serials)
+        for serial in serials:
+            responder.response_for(serial)
+        cached_us = timed(responder.response_for, serials)
+
+        # 请求和校验用仓库里由签发 CA 签的服务器证书
+        ca_cert = load_certificate(os.path.join(ISSUING_DIR, "certs/issuing.crt"))
+        cert = load_certificate(os.path.join(root, SERVER_CERT))
+        request = build_request(cert, ca_cert)
+        staple = responder.respond(request)
+        request_us = timed(lambda _: responder.respond(request), serials)
+        verify_us = timed(lambda _: verify_response(staple, cert, ca_cert), serials)
+
+        statuses = {}
+        for serial in serials[:200]:
+            status = issuer.db.by_serial(normalize_serial(serial))
+            key = "revoked" if status and status["status"] == "R" else "good"
+            statuses[key] = statuses.get(key, 0) + 1
+        data = {
+            "certificates": args.count,
+            "sample_statuses": statuses,
+            "response_us": {
+                "sign": sign_us,
+                "cached": cached_us,
+                "request": request_us,
+                "verify": verify_us,
+            },
+            "response_bytes": len(staple),
+            "crl_bytes": os.path.getsize(crl_path),
+            "stats": responder.stats(),
+        }
+    finally:
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(data, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
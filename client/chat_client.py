@@ -1,7 +1,22 @@
+import base64
+import os
 import ssl
 import socket
+import sys
 import threading
 
+# 与服务器共用分帧和 TLS 配置代码
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.protocol import LineDecoder, FrameTooLarge, MAX_INCOMING_FRAME, READ_SIZE
+from server.tls import create_client_context
+
+# 校验服务器随登录提示发来的 OCSP 响应（stapling）需要 cryptography，没有时只提示收到
+try:
+    from cryptography import x509
+    from pki.ocsp import OcspError, describe, load_certificate, verify_response
+except ImportError:
+    verify_response = None
+
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 4433
 
@@ -9,55 +24,107 @@ SERVER_PORT = 4433
 CLIENT_CERT = "client/client_fullchain.crt"
 CLIENT_KEY = "client/client.key"
 CA_ROOT = "ca/certs/root.crt"
+# 服务器证书的签发 CA，也是 OCSP 响应的签名者
+ISSUING_CA = "ca/issuing/certs/issuing.crt"
+
+
+def check_staple(tls_sock: ssl.SSLSocket, frame: bytes):
+    """校验 "[OCSP] <base64>" 行；服务器证书已被吊销时返回 False，其他情况只打印结果"""
+    if verify_response is None:
+        print("[*] OCSP response stapled (install cryptography to verify it)")
+        return True
+    cert = x509.load_der_x509_certificate(tls_sock.getpeercert(binary_form=True))
+    try:
+        response = verify_response(base64.b64decode(frame[len(b"[OCSP] "):]), cert, load_certificate(ISSUING_CA))
+    except (OcspError, ValueError) as e:
+        print("[!] Invalid stapled OCSP response:", e)
+        return True
+    status = describe(response)["status"]
+    if status == "revoked":
+        print("[!] Server certificate has been revoked (OCSP), disconnecting.")
+        return False
+    print(f"[✓] Server certificate OCSP status: {status} (stapled)")
+    return True
 
 
 def recv_loop(tls_sock: ssl.SSLSocket):
-    """后台线程：收消息并打印"""
+    """后台线程：收消息并按行打印（一次读取可能有多条，也可能只有半条）"""
+    decoder = LineDecoder(MAX_INCOMING_FRAME)
+    # OCSP 响应只可能是连接上的第一行（在登录提示之前），之后同样开头的行是普通聊天消息
+    first = True
     try:
         while True:
-            data = tls_sock.recv(4096)
+            data = tls_sock.recv(READ_SIZE)
             if not data:
                 print("[*] Server closed connection.")
                 break
-            print(data.decode("utf-8"), end="")
+            for frame in decoder.feed(data):
+                if first and frame.startswith(b"[OCSP] "):
+                    first = False
+                    if not check_staple(tls_sock, frame):
+                        tls_sock.close()
+                        return
+                    continue
+                first = False
+                print(frame.decode("utf-8", errors="replace"))
+    except FrameTooLarge as e:
+        print("[!] Protocol error:", e)
     except Exception as e:
         print("[!] Receive error:", e)
 
 
+def connect(context, session=None):
+    """建立 TLS 连接；传入上次连接的 session 时尝试会话恢复，跳过证书交换和校验"""
+    sock = socket.create_connection((SERVER_HOST, SERVER_PORT))
+    return context.wrap_socket(sock, server_hostname="localhost", session=session)
+
+
 def main():
     username = input("请输入聊天昵称（和 LOGIN:<username> 相同最好）: ").strip()
     if not username:
         print("用户名不能为空")
         return
 
-    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-    context.load_verify_locations(CA_ROOT)
-    context.load_cert_chain(certfile=CLIENT_CERT, keyfile=CLIENT_KEY)
+    context = create_client_context(CLIENT_CERT, CLIENT_KEY, CA_ROOT)
+    session = None
 
-    sock = socket.create_connection((SERVER_HOST, SERVER_PORT))
-    tls = context.wrap_socket(sock, server_hostname="localhost")
+    while True:
+        tls = connect(context, session)
+        if tls.session_reused:
+            print("[✓] TLS handshake OK (session resumed).")
+        else:
+            print("[✓] TLS handshake OK.")
+            print("Server cert:", tls.getpeercert())
 
-    print("[✓] TLS handshake OK.")
-    print("Server cert:", tls.getpeercert())
+        # 登录
+        tls.sendall(f"LOGIN:{username}\n".encode("utf-8"))
 
-    # 登录
-    tls.sendall(f"LOGIN:{username}\n".encode("utf-8"))
+        # 收消息线程
+        t = threading.Thread(target=recv_loop, args=(tls,), daemon=True)
+        t.start()
 
-    # 收消息线程
-    t = threading.Thread(target=recv_loop, args=(tls,), daemon=True)
-    t.start()
+        # 主线程读键盘、发消息；/reconnect 断开后用当前会话重新连接
+        reconnect = False
+        try:
+            while True:
+                msg = input()
+                if not msg:
+                    continue
+                if msg.lower() == "/reconnect":
+                    reconnect = True
+                    msg = "/quit"
+                tls.sendall((msg + "\n").encode("utf-8"))
+                if msg.lower() == "/quit":
+                    break
+            # 等服务器关闭旧连接（释放用户名）
+            t.join(timeout=2)
+        finally:
+            # TLS 1.3 的 session ticket 在握手后随服务器数据到达，此时才可用于恢复
+            session = tls.session
+            tls.close()
 
-    # 主线程读键盘、发消息
-    try:
-        while True:
-            msg = input()
-            if not msg:
-                continue
-            tls.sendall((msg + "\n").encode("utf-8"))
-            if msg.lower() == "/quit":
-                break
-    finally:
-        tls.close()
+        if not reconnect:
+            break
 
 
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+# pki/certdb.py
+"""带索引的证书数据库（SQLite），代替逐行扫描 openssl 的 index.txt
+
+index.txt 是制表符分隔的平面文件：按序列号查证书、查某个 CN 是否已有有效证书、找快要
+到期的证书，都要从头读到尾；多个签发进程同时改写还可能把它写坏。证书数据库把同样的
+信息放进一张 B 树表（主键是序列号），另外按 CN、指纹（DER 的 SHA-256）、到期时间建索引，
+几十万张证书时每次查找仍是 O(log n)；写入在事务中进行，多个进程并发也不会写坏。
+
+    serial       openssl 写法的大写十六进制（主键）
+    status       V 有效 / R 已吊销 / E 已过期（与 index.txt 相同）
+    not_after    到期时间，'YYYY-MM-DD HH:MM:SS'（UTC），可以按范围查询
+    revoked_at   吊销时间；reason 吊销原因（index.txt 中逗号后的部分）
+    subject      /CN=...；common_name 单独一列便于按用户名查
+    fingerprint  证书 DER 的 SHA-256（十六进制）；只从 index.txt 导入、找不到证书文件时为空
+    der          证书本身
+
+与 openssl 互通：import 读入 index.txt（按序列号更新已有记录，能找到 newcerts/<序列号>.pem
+时一并导入证书和指纹），export 按序列号顺序重新生成 index.txt（原文件保存为 index.txt.old）。
+pki/issuer.py 签发时直接写入本数据库，同时仍然追加 index.txt。
+
+    python pki/certdb.py import                 # ca/issuing/index.txt -> ca/issuing/certs.db
+    python pki/certdb.py export
+    python pki/certdb.py show 2001
+    python pki/certdb.py find --cn alice
+    python pki/certdb.py find --fingerprint 3f5a...
+    python pki/certdb.py expiring --days 30
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+CERTDB_PATH = "ca/issuing/certs.db"
+INDEX_PATH = "ca/issuing/index.txt"
+NEW_CERTS_DIR = "ca/issuing/newcerts"
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+BUSY_TIMEOUT_MS = 5000
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS certificates (
+        serial TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        not_after TEXT NOT NULL,
+        revoked_at TEXT,
+        reason TEXT,
+        subject TEXT NOT NULL,
+        common_name TEXT,
+        fingerprint TEXT,
+        filename TEXT NOT NULL DEFAULT 'unknown',
+        der BLOB
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_certificates_common_name ON certificates (common_name, status)",
+    "CREATE INDEX IF NOT EXISTS idx_certificates_subject ON certificates (subject, status)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_certificates_fingerprint ON certificates (fingerprint)",
+    "CREATE INDEX IF NOT EXISTS idx_certificates_expiry ON certificates (status, not_after)",
+    "CREATE INDEX IF NOT EXISTS idx_certificates_revoked ON certificates (status, revoked_at)",
+)
+
+COLUMNS = "serial, status, not_after, revoked_at, reason, subject, common_name, fingerprint, filename"
+
+
+def normalize_serial(serial):
+    """整数或十六进制字符串 -> openssl 写法（大写、偶数位）"""
+    value = serial if isinstance(serial, int) else int(str(serial), 16)
+    text = f"{value:X}"
+    return text if len(text) % 2 == 0 else "0" + text
+
+
+def parse_index_time(value):
+    """index.txt 中的 UTCTime（YYMMDDHHMMSSZ，50 以下为 20xx 年）或 GeneralizedTime"""
+    if len(value) == 13:
+        year = int(value[:2])
+        value = ("20" if year < 50 else "19") + value
+    return datetime.datetime.strptime(value, "%Y%m%d%H%M%SZ").strftime(TIME_FORMAT)
+
+
+def format_index_time(value):
+    """parse_index_time 的逆过程；TIME_FORMAT 是定长的，直接切片（export 时每行调用，strptime 太慢）"""
+    digits = value[:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19] + "Z"
+    return digits[2:] if value < "2050" else digits
+
+
+def subject_line(cert):
+    """index.txt 中的主体：/CN=..."""
+    return "".join(f"/{attr.rfc4514_attribute_name}={attr.value}" for attr in cert.subject)
+
+
+def common_name_of(subject):
+    for part in subject.split("/"):
+        if part.startswith("CN="):
+            return part[3:]
+    return None
+
+
+def _row(row):
+    return dict(zip(COLUMNS.split(", "), row)) if row else None
+
+
+class CertDB:
+    """证书数据库；每个线程一个连接，可以在多个线程和进程中同时使用"""
+
+    def __init__(self, path=CERTDB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode = WAL")
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------------- 写入 ----------------
+
+    def add(self, certs, filename="unknown"):
+        """记录新签发的证书（x509.Certificate 列表），一个事务"""
+        from cryptography.hazmat.primitives import serialization
+        rows = []
+        for cert in certs:
+            der = cert.public_bytes(serialization.Encoding.DER)
+            subject = subject_line(cert)
+            rows.append((normalize_serial(cert.serial_number), "V",
+                         cert.not_valid_after_utc.strftime(TIME_FORMAT), None, None, subject,
+                         common_name_of(subject), hashlib.sha256(der).hexdigest(), filename, der))
+        with self._conn() as conn:
+            conn.executemany(f"INSERT INTO certificates ({COLUMNS}, der) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def revoke(self, serial, reason=None, when=None):
+        """把有效证书标记为吊销，返回是否有记录被修改"""
+        when = when or datetime.datetime.now(datetime.timezone.utc)
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "UPDATE certificates SET status = 'R', revoked_at = ?, reason = ? WHERE serial = ? AND status = 'V'",
+                (when.strftime(TIME_FORMAT), reason, normalize_serial(serial)))
+        return cursor.rowcount > 0
+
+    def expire(self, now=None):
+        """把已过到期时间的有效证书标记为 E（openssl ca -updatedb），返回数量"""
+        now = (now or datetime.datetime.now(datetime.timezone.utc)).strftime(TIME_FORMAT)
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "UPDATE certificates SET status = 'E' WHERE status = 'V' AND not_after <= ?", (now,))
+        return cursor.rowcount
+
+    # ---------------- 查询 ----------------
+
+    def by_serial(self, serial):
+        row = self._conn().execute(f"SELECT {COLUMNS} FROM certificates WHERE serial = ?",
+                                   (normalize_serial(serial),)).fetchone()
+        return _row(row)
+
+    def by_fingerprint(self, fingerprint):
+        fingerprint = fingerprint.replace(":", "").lower()
+        row = self._conn().execute(f"SELECT {COLUMNS} FROM certificates WHERE fingerprint = ?",
+                                   (fingerprint,)).fetchone()
+        return _row(row)
+
+    def by_common_name(self, common_name, status=None):
+        if status is None:
+            rows = self._conn().execute(f"SELECT {COLUMNS} FROM certificates WHERE common_name = ?",
+                                        (common_name,))
+        else:
+            rows = self._conn().execute(
+                f"SELECT {COLUMNS} FROM certificates WHERE common_name = ? AND status = ?",
+                (common_name, status))
+        return [_row(row) for row in rows]
+
+    def certificate_der(self, serial):
+        row = self._conn().execute("SELECT der FROM certificates WHERE serial = ?",
+                                   (normalize_serial(serial),)).fetchone()
+        return row[0] if row else None
+
+    def expiring(self, before, after=None, limit=None):
+        """到期时间在 [after, before) 之间的有效证书，按到期时间排序"""
+        sql = (f"SELECT {COLUMNS} FROM certificates WHERE status = 'V' AND not_after >= ? AND not_after < ? "
+               "ORDER BY not_after")
+        params = [after.strftime(TIME_FORMAT) if after else "", before.strftime(TIME_FORMAT)]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [_row(row) for row in self._conn().execute(sql, params)]
+
+    def valid_subjects(self, subjects):
+        """subjects 中已有有效证书的那些（unique_subject 检查）"""
+        conn = self._conn()
+        return {subject for subject in subjects
+                if conn.execute("SELECT 1 FROM certificates WHERE subject = ? AND status = 'V' LIMIT 1",
+                                (subject,)).fetchone()}
+
+    def revoked(self, since=None):
+        """吊销记录 [(序列号, 吊销时间, 原因)]，生成 CRL 用；since 只要该时间（含）以后吊销的（增量 CRL）"""
+        if since is None:
+            return self._conn().execute(
+                "SELECT serial, revoked_at, reason FROM certificates WHERE status = 'R'").fetchall()
+        return self._conn().execute(
+            "SELECT serial, revoked_at, reason FROM certificates WHERE status = 'R' AND revoked_at >= ?",
+            (since.strftime(TIME_FORMAT),)).fetchall()
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM certificates").fetchone()[0]
+
+    def stats(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM certificates GROUP BY status").fetchall()
+        return dict(rows)
+
+    # ---------------- 与 index.txt 互通 ----------------
+
+    def import_index(self, index_path=INDEX_PATH, certs_dir=NEW_CERTS_DIR):
+        """读入 openssl 的 index.txt，按序列号插入或更新；返回导入的行数"""
+        from cryptography import x509
+        from cryptography.hazmat.primitives import serialization
+        rows = []
+        with open(index_path) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 6:
+                    continue
+                status, expires, revocation, serial, filename, subject = fields
+                revoked_at, _, reason = revocation.partition(",")
+                serial = normalize_serial(serial)
+                der = fingerprint = None
+                pem_path = os.path.join(certs_dir, f"{serial}.pem") if certs_dir else None
+                if pem_path and os.path.exists(pem_path):
+                    with open(pem_path, "rb") as pem:
+                        der = x509.load_pem_x509_certificate(pem.read()).public_bytes(serialization.Encoding.DER)
+                    fingerprint = hashlib.sha256(der).hexdigest()
+                rows.append((serial, status, parse_index_time(expires),
+                             parse_index_time(revoked_at) if revoked_at else None, reason or None,
+                             subject, common_name_of(subject), fingerprint, filename, der))
+        with self._conn() as conn:
+            conn.executemany(
+                f"""INSERT INTO certificates ({COLUMNS}, der) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (serial) DO UPDATE SET
+                        status = excluded.status, not_after = excluded.not_after,
+                        revoked_at = excluded.revoked_at, reason = excluded.reason,
+                        subject = excluded.subject, common_name = excluded.common_name,
+                        fingerprint = COALESCE(excluded.fingerprint, fingerprint),
+                        filename = excluded.filename, der = COALESCE(excluded.der, der)""",
+                rows)
+        return len(rows)
+
+    def export_index(self, index_path=INDEX_PATH):
+        """按序列号顺序重新生成 index.txt，返回行数；原文件改名为 index.txt.old"""
+        rows = self._conn().execute(
+            "SELECT status, not_after, revoked_at, reason, serial, filename, subject FROM certificates "
+            "ORDER BY length(serial), serial")
+        tmp = index_path + ".tmp"
+        count = 0
+        with open(tmp, "w") as f:
+            for status, not_after, revoked_at, reason, serial, filename, subject in rows:
+                revocation = format_index_time(revoked_at) if revoked_at else ""
+                if revocation and reason:
+                    revocation += "," + reason
+                f.write(f"{status}\t{format_index_time(not_after)}\t{revocation}\t{serial}\t{filename}\t{subject}\n")
+                count += 1
+        if os.path.exists(index_path):
+            os.replace(index_path, index_path + ".old")
+        os.replace(tmp, index_path)
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="证书数据库（与 openssl index.txt 互通）")
+    parser.add_argument("--db", default=CERTDB_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    imp = sub.add_parser("import", help="读入 index.txt")
+    imp.add_argument("--index", default=INDEX_PATH)
+    imp.add_argument("--certs-dir", default=NEW_CERTS_DIR, help="按序列号查找证书文件的目录")
+    exp = sub.add_parser("export", help="重新生成 index.txt")
+    exp.add_argument("--index", default=INDEX_PATH)
+    show = sub.add_parser("show", help="按序列号查")
+    show.add_argument("serial")
+    find = sub.add_parser("find", help="按 CN 或指纹查")
+    group = find.add_mutually_exclusive_group(required=True)
+    group.add_argument("--cn")
+    group.add_argument("--fingerprint")
+    expiring = sub.add_parser("expiring", help="列出 --days 天内到期的有效证书")
+    expiring.add_argument("--days", type=int, default=30)
+    sub.add_parser("stats", help="各状态的证书数")
+    args = parser.parse_args()
+
+    db = CertDB(args.db)
+    if args.command == "import":
+        print(f"[*] imported {db.import_index(args.index, args.certs_dir)} entries from {args.index}")
+    elif args.command == "export":
+        print(f"[*] wrote {db.export_index(args.index)} entries to {args.index}")
+    else:
+        if args.command == "show":
+            result = db.by_serial(args.serial)
+        elif args.command == "find":
+            result = db.by_common_name(args.cn) if args.cn else db.by_fingerprint(args.fingerprint)
+        elif args.command == "expiring":
+            now = datetime.datetime.now(datetime.timezone.utc)
+            result = db.expiring(now + datetime.timedelta(days=args.days), after=now)
+        else:
+            result = db.stats()
+        if result is None:
+            sys.exit("[-] not found")
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
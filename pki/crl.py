@@ -0,0 +1,332 @@
+# pki/crl.py
+"""吊销与 CRL：签发 CA 发布完整 CRL 和增量 CRL，服务器按已吊销序列号的哈希集合做 O(1) 检查
+
+吊销记录在 certs.db（pki/certdb.py）中，CRL 由进程内的签发 CA（pki/issuer.py）签名：
+    crl/issuing.crl.pem        完整 CRL：全部吊销记录，nextUpdate 为 issuing.cnf 的 default_crl_days
+    crl/issuing-delta.crl.pem  增量 CRL：完整 CRL 的 lastUpdate 以后吊销的证书，nextUpdate 为
+                               DELTA_CRL_HOURS 小时；每次 revoke 只重发这一份，不用重签整张大 CRL
+两者共用 crlnumber 的编号（与 openssl ca -gencrl 相同）。增量 CRL 带 DeltaCRLIndicator（基准
+CRL 的编号），完整 CRL 带 FreshestCRL 扩展 —— OpenSSL 只有看到这个扩展才会去找增量 CRL。
+吊销时同时按 certs.db 重写 index.txt，openssl ca 看到的状态保持一致。
+
+服务器（server/tls.py）把两份 CRL 装进握手用的证书库并打开 VERIFY_CRL_CHECK_LEAF；但恢复的
+TLS 会话不再校验证书，所以握手后还要按序列号查一次 RevocationIndex：完整 CRL ∪ 增量 CRL 的
+序列号放在一个 frozenset 里，每次检查是一次哈希查找。RevocationIndex 在后台线程中每隔
+RELOAD_INTERVAL 秒检查一次 CRL 文件，发布了新 CRL 就重新加载并通知监听者（换掉握手用的证书库），
+不用重启服务器。
+
+    python pki/crl.py revoke 2001 --reason keyCompromise    # 吊销并发布增量 CRL
+    python pki/crl.py publish --full                        # 重签完整 CRL（至少每 default_crl_days 天一次）
+    python pki/crl.py publish                               # 重签增量 CRL（至少每 DELTA_CRL_HOURS 小时一次）
+    python pki/crl.py show
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.certdb import TIME_FORMAT, normalize_serial
+from pki.issuer import CONFIG_PATH, Issuer
+
+CRL_PATH = "ca/issuing/crl/issuing.crl.pem"
+DELTA_CRL_PATH = "ca/issuing/crl/issuing-delta.crl.pem"
+ISSUING_CA_CERT = "ca/issuing/certs/issuing.crt"
+DELTA_CRL_HOURS = int(os.environ.get("CHAT_DELTA_CRL_HOURS", "24"))
+# 完整 CRL 的 FreshestCRL 扩展中增量 CRL 的位置（OpenSSL 不会去下载，只看扩展是否存在）
+DELTA_CRL_URI = os.environ.get("CHAT_DELTA_CRL_URI", "file:issuing-delta.crl.pem")
+# 检查 CRL 文件是否更新的间隔（秒）
+RELOAD_INTERVAL = float(os.environ.get("CHAT_CRL_RELOAD_INTERVAL", "2"))
+
+# openssl ca -crl_reason 接受的吊销原因
+REASONS = ("unspecified", "keyCompromise", "CACompromise", "affiliationChanged", "superseded",
+           "cessationOfOperation", "certificateHold", "removeFromCRL")
+_REASON_FLAGS = {flag.value.lower(): flag for flag in x509.ReasonFlags}
+
+
+def utc(text):
+    return datetime.datetime.strptime(text, TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+
+
+def reason_flag(reason):
+    """index.txt / certs.db 中的吊销原因 -> x509.ReasonFlags；没有原因或 unspecified 时为 None
+
+    RFC 5280：原因为 unspecified 时不带 reasonCode（openssl 也是这样），OCSP 响应同理。
+    """
+    if not reason or reason == "unspecified":
+        return None
+    return _REASON_FLAGS[reason.lower()]
+
+
+def _revoked_entry(serial, revoked_at, reason):
+    builder = (x509.RevokedCertificateBuilder()
+               .serial_number(int(serial, 16))
+               .revocation_date(utc(revoked_at)))
+    flag = reason_flag(reason)
+    if flag is not None:
+        builder = builder.add_extension(x509.CRLReason(flag), False)
+    return builder.build()
+
+
+def crl_number(crl):
+    return crl.extensions.get_extension_for_class(x509.CRLNumber).value.crl_number
+
+
+def delta_base(crl):
+    """增量 CRL 的基准编号；完整 CRL 返回 None"""
+    try:
+        return crl.extensions.get_extension_for_class(x509.DeltaCRLIndicator).value.crl_number
+    except x509.ExtensionNotFound:
+        return None
+
+
+def load_crl(path):
+    with open(path, "rb") as f:
+        return x509.load_pem_x509_crl(f.read())
+
+
+def _write(path, crl):
+    """先写临时文件再改名：读取者（服务器的 RevocationIndex）不会读到写了一半的 CRL"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(crl.public_bytes(serialization.Encoding.PEM))
+    os.replace(tmp, path)
+
+
+class CrlPublisher:
+    """用签发 CA 吊销证书、签发完整 / 增量 CRL"""
+
+    def __init__(self, issuer, crl_path=CRL_PATH, delta_path=DELTA_CRL_PATH):
+        self.issuer = issuer
+        self.crl_path = crl_path
+        self.delta_path = delta_path
+        ski = issuer.ca_cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value
+        self._authority_key_id = x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski)
+
+    def _build(self, rows, last_update, next_update):
+        # 一次性传入吊销列表：add_revoked_certificate 每次复制整个列表，几万条时是 O(n²)
+        builder = x509.CertificateRevocationListBuilder(
+            last_update=last_update, next_update=next_update,
+            revoked_certificates=[_revoked_entry(*row) for row in rows])
+        return (builder
+                .add_extension(x509.CRLNumber(self.issuer.next_crl_number()), False)
+                .add_extension(self._authority_key_id, False))
+
+    def publish_full(self):
+        """重签完整 CRL，并发布一份以它为基准的（空）增量 CRL，返回完整 CRL"""
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        # 先定 lastUpdate 再读吊销记录：之后吊销的一定会进入下一份增量 CRL
+        rows = self.issuer.db.revoked()
+        builder = (self._build(rows, now, now + datetime.timedelta(days=self.issuer.crl_days))
+                   .add_extension(x509.FreshestCRL([x509.DistributionPoint(
+                       [x509.UniformResourceIdentifier(DELTA_CRL_URI)], None, None, None)]), False))
+        crl = self.issuer.sign_crl(builder)
+        _write(self.crl_path, crl)
+        self.publish_delta(crl)
+        return crl
+
+    def publish_delta(self, base=None):
+        """按当前完整 CRL 重签增量 CRL；还没有完整 CRL 时改为发布完整 CRL"""
+        if base is None:
+            if not os.path.exists(self.crl_path):
+                return self.publish_full()
+            base = load_crl(self.crl_path)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        rows = self.issuer.db.revoked(since=base.last_update_utc)
+        builder = (self._build(rows, now, now + datetime.timedelta(hours=DELTA_CRL_HOURS))
+                   .add_extension(x509.DeltaCRLIndicator(crl_number(base)), True))
+        crl = self.issuer.sign_crl(builder)
+        _write(self.delta_path, crl)
+        return crl
+
+    def revoke(self, serial, reason=None):
+        """吊销一张有效证书并发布增量 CRL；证书不存在或不是有效状态时返回 False"""
+        if reason is not None and reason not in REASONS:
+            raise ValueError(f"unknown revocation reason: {reason}")
+        if not self.issuer.db.revoke(serial, reason):
+            return False
+        self.issuer.sync_index()
+        self.publish_delta()
+        return True
+
+
+class RevocationIndex:
+    """已吊销序列号的哈希集合（完整 CRL ∪ 增量 CRL），CRL 文件更新后自动重新加载
+
+    is_revoked() 只读一次 frozenset 引用，不加锁；重新加载在后台线程中构造新集合后整体替换。
+    CRL 签名用签发 CA 证书校验，加载失败（签名不对、文件损坏）时保留原来的集合。
+    """
+
+    def __init__(self, paths=(CRL_PATH, DELTA_CRL_PATH), ca_cert=ISSUING_CA_CERT, interval=RELOAD_INTERVAL):
+        self.paths = paths
+        self.interval = interval
+        self._ca_key = None
+        if ca_cert and os.path.exists(ca_cert):
+            with open(ca_cert, "rb") as f:
+                self._ca_key = x509.load_pem_x509_certificate(f.read()).public_key()
+        self._revoked = frozenset()
+        self._signature = None
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.crl_number = None
+        self.delta_number = None
+        self.reloads = 0
+        self.errors = 0
+        self.refresh()
+
+    def is_revoked(self, serial):
+        """serial 为整数或十六进制字符串（getpeercert()['serialNumber']）"""
+        if isinstance(serial, str):
+            serial = int(serial, 16)
+        return serial in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def add_listener(self, callback):
+        """CRL 重新加载后调用 callback()（在后台线程中）"""
+        self._listeners.append(callback)
+
+    def _files_signature(self):
+        signature = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                signature.append(None)
+            else:
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    def _load(self, path):
+        crl = load_crl(path)
+        if self._ca_key is not None and not crl.is_signature_valid(self._ca_key):
+            raise ValueError(f"{path}: CRL signature does not match the issuing CA")
+        return crl
+
+    def refresh(self):
+        """CRL 文件有变化时重新加载，返回是否重新加载"""
+        signature = self._files_signature()
+        if signature == self._signature:
+            return False
+        try:
+            full = delta = None
+            for path in self.paths:
+                if not os.path.exists(path):
+                    continue
+                crl = self._load(path)
+                if delta_base(crl) is None:
+                    full = crl
+                else:
+                    delta = crl
+            revoked = set()
+            number = delta_number = None
+            if full is not None:
+                number = crl_number(full)
+                revoked.update(entry.serial_number for entry in full)
+            # 与 OpenSSL 相同：增量 CRL 的基准不晚于完整 CRL、编号比它新时才用
+            if delta is not None and (number is None or delta_base(delta) <= number < crl_number(delta)):
+                delta_number = crl_number(delta)
+                for entry in delta:
+                    try:
+                        reason = entry.extensions.get_extension_for_class(x509.CRLReason).value.reason
+                    except x509.ExtensionNotFound:
+                        reason = None
+                    if reason == x509.ReasonFlags.remove_from_crl:
+                        revoked.discard(entry.serial_number)
+                    else:
+                        revoked.add(entry.serial_number)
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            print(f"[!] Failed to load CRL, keeping the previous revocation list: {e}")
+            self._signature = signature
+            return False
+        self._revoked = frozenset(revoked)
+        self._signature = signature
+        self.crl_number, self.delta_number = number, delta_number
+        self.reloads += 1
+        for callback in self._listeners:
+            callback()
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def start(self):
+        """在后台线程中定期 refresh()"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="crl-reload", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "revoked": len(self._revoked),
+            "crl_number": self.crl_number,
+            "delta_crl_number": self.delta_number,
+            "reloads": self.reloads,
+            "errors": self.errors,
+        }
+
+
+def describe(crl):
+    return {
+        "number": crl_number(crl),
+        "delta_base": delta_base(crl),
+        "last_update": crl.last_update_utc.strftime(TIME_FORMAT),
+        "next_update": crl.next_update_utc.strftime(TIME_FORMAT),
+        "revoked": len(crl),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="吊销证书，发布 ca/issuing 的完整 / 增量 CRL")
+    parser.add_argument("--config", default=CONFIG_PATH, help="openssl ca 的配置文件")
+    sub = parser.add_subparsers(dest="command", required=True)
+    revoke = sub.add_parser("revoke", help="吊销证书（序列号，十六进制）并发布增量 CRL")
+    revoke.add_argument("serial")
+    revoke.add_argument("--reason", choices=REASONS)
+    publish = sub.add_parser("publish", help="重签增量 CRL；--full 重签完整 CRL")
+    publish.add_argument("--full", action="store_true")
+    sub.add_parser("show", help="当前 CRL 的编号、有效期和条数")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        result = {}
+        for name, path in (("full", CRL_PATH), ("delta", DELTA_CRL_PATH)):
+            result[name] = describe(load_crl(path)) if os.path.exists(path) else None
+        print(json.dumps(result, indent=2))
+        return
+
+    publisher = CrlPublisher(Issuer(args.config))
+    start = time.perf_counter()
+    if args.command == "revoke":
+        serial = normalize_serial(args.serial)
+        if not publisher.revoke(serial, args.reason):
+            sys.exit(f"[-] no valid certificate with serial {serial}")
+        print(f"[*] revoked {serial}")
+    elif args.full:
+        publisher.publish_full()
+    else:
+        publisher.publish_delta()
+    for path in (CRL_PATH, DELTA_CRL_PATH):
+        if os.path.exists(path):
+            info = describe(load_crl(path))
+            print(f"[*] {path}: #{info['number']}, {info['revoked']} entries, next update {info['next_update']}")
+    print(f"[*] done in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
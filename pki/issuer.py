@@ -0,0 +1,455 @@
+# pki/issuer.py
+"""进程内签发证书：一次加载签发 CA（ca/issuing）的私钥，按 issuing.cnf 的 usr_cert 扩展签 CSR
+
+以前每张证书都要手工运行一次 openssl ca -config ca/issuing/issuing.cnf，所有用户因此共用
+client/client.crt（CN=client1）。Issuer 启动时读取配置、CA 证书和私钥，之后每张证书只做
+一次签名（RSA-4096 约 2 ms），不再为每张证书启动一个 openssl 进程；批量签发可以分给
+多个 worker 进程（fork 继承已加载的私钥）。
+
+与 openssl ca 共用同一套文件，两者可以交替使用：
+    serial              下一个序列号（十六进制），旧值写入 serial.old
+    newcerts/<序列号>.pem 签出的证书
+    index.txt           每张证书追加一行（V、到期时间、序列号、unknown、/CN=...）
+    certs.db            带索引的证书数据库（pki/certdb.py），第一次使用时从 index.txt 导入；
+                        openssl ca 签发的证书需要 python pki/certdb.py import 补进来
+    crlnumber           下一个 CRL 编号（pki/crl.py 发布 CRL 时递增）
+配置中只用到 default_days、default_md、policy 要求的 commonName 和 x509_extensions 节（或构造时
+指定的 profile 节，如注册签发用的只含 clientAuth 的 client_cert）；
+与 openssl ca 一样只保留 CSR 中的 CN（preserve = no），不复制 CSR 里的扩展。
+index.txt.attr 中 unique_subject = yes 时拒绝与有效证书重名的 CN（在 certs.db 中按索引查；预留序列号时查一次，
+签名后记录前在同一把锁内再查一次，并发签发同一 CN 时只有先记录的成功）。
+
+分配序列号和追加 index.txt 时持有 index.txt.lock 的文件锁：多个签发进程（命令行、web/app.py）
+拿到的序列号互不重复，index.txt 的行也不会交错。签名在锁外进行，一批证书只加两次锁。
+openssl ca 本身不加锁，不要和本模块同时运行。
+
+    python pki/issuer.py sign client/alice.csr -o client/alice.crt
+    python pki/issuer.py batch requests/ --out-dir issued/          # 目录中所有 *.csr
+    python pki/issuer.py users alice bob --out-dir issued/          # 生成私钥并签发
+    python pki/issuer.py users --count 5000 --prefix user --out-dir issued/ --workers 4
+"""
+import argparse
+import contextlib
+import datetime
+import fcntl
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.certdb import CertDB, subject_line
+
+CONFIG_PATH = os.environ.get("CHAT_CA_CONFIG", "ca/issuing/issuing.cnf")
+# 签发 CA 私钥的口令（ca/issuing/private/issuing.key 目前未加密）
+KEY_PASSWORD = os.environ.get("CHAT_CA_KEY_PASSWORD")
+PROFILE = "usr_cert"
+# 只含 clientAuth 的扩展节，给 CN 由用户自己决定的证书用（web/enrollment.py）
+CLIENT_PROFILE = "client_cert"
+
+_HASHES = {"sha256": hashes.SHA256, "sha384": hashes.SHA384, "sha512": hashes.SHA512}
+
+_KEY_USAGE = {
+    "digitalSignature": "digital_signature",
+    "nonRepudiation": "content_commitment",
+    "keyEncipherment": "key_encipherment",
+    "dataEncipherment": "data_encipherment",
+    "keyAgreement": "key_agreement",
+    "keyCertSign": "key_cert_sign",
+    "cRLSign": "crl_sign",
+    "encipherOnly": "encipher_only",
+    "decipherOnly": "decipher_only",
+}
+
+_EXTENDED_KEY_USAGE = {
+    "serverAuth": ExtendedKeyUsageOID.SERVER_AUTH,
+    "clientAuth": ExtendedKeyUsageOID.CLIENT_AUTH,
+    "codeSigning": ExtendedKeyUsageOID.CODE_SIGNING,
+    "emailProtection": ExtendedKeyUsageOID.EMAIL_PROTECTION,
+    "timeStamping": ExtendedKeyUsageOID.TIME_STAMPING,
+    "OCSPSigning": ExtendedKeyUsageOID.OCSP_SIGNING,
+}
+
+
+class IssuanceError(ValueError):
+    """CSR 无效或不符合签发策略"""
+
+
+def read_config(path):
+    """解析 openssl 配置文件：[ 节 ]、key = value，展开同一节或默认节中的 $变量"""
+    sections = {"default": {}}
+    current = sections["default"]
+    with open(path) as f:
+        for raw in f:
+            line = raw.split("#", 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith("["):
+                current = sections.setdefault(line.strip("[] \t"), {})
+                continue
+            key, _, value = line.partition("=")
+
+            def expand(match, section=current):
+                name = match.group(1) or match.group(2)
+                return section.get(name, sections["default"].get(name, ""))
+
+            current[key.strip()] = re.sub(r"\$\{(\w+)\}|\$(\w+)", expand, value.strip())
+    return sections
+
+
+def _split(value):
+    """'critical, a, b' -> (True, ['a', 'b'])"""
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    critical = bool(items) and items[0] == "critical"
+    return critical, items[1:] if critical else items
+
+
+def build_extensions(section, ca_cert):
+    """把 x509_extensions 节翻译成 [(扩展, critical)]；subjectKeyIdentifier 每张证书单独计算，返回 None 占位"""
+    extensions = []
+    for name, value in section.items():
+        critical, items = _split(value)
+        if name == "basicConstraints":
+            options = dict(item.split(":", 1) for item in items)
+            is_ca = options.get("CA", "false").lower() == "true"
+            path_length = int(options["pathlen"]) if "pathlen" in options else None
+            extensions.append((x509.BasicConstraints(ca=is_ca, path_length=path_length), critical))
+        elif name == "keyUsage":
+            flags = dict.fromkeys(_KEY_USAGE.values(), False)
+            for item in items:
+                flags[_KEY_USAGE[item]] = True
+            extensions.append((x509.KeyUsage(**flags), critical))
+        elif name == "extendedKeyUsage":
+            extensions.append((x509.ExtendedKeyUsage([_EXTENDED_KEY_USAGE[item] for item in items]), critical))
+        elif name == "subjectKeyIdentifier":
+            if items != ["hash"]:
+                raise ValueError(f"unsupported subjectKeyIdentifier: {value}")
+            extensions.append((None, critical))
+        elif name == "authorityKeyIdentifier":
+            # keyid：复制 CA 证书的 subjectKeyIdentifier；CA 证书没有这个扩展时按公钥计算
+            try:
+                ski = ca_cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value
+                aki = x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski)
+            except x509.ExtensionNotFound:
+                aki = x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_cert.public_key())
+            extensions.append((aki, critical))
+        else:
+            raise ValueError(f"unsupported extension: {name}")
+    return extensions
+
+
+def index_time(value):
+    """index.txt 中的时间：2049 年及以前 UTCTime（YYMMDDHHMMSSZ），之后 GeneralizedTime"""
+    if value.year < 2050:
+        return value.strftime("%y%m%d%H%M%SZ")
+    return value.strftime("%Y%m%d%H%M%SZ")
+
+
+def serial_hex(serial):
+    """与 openssl 相同的序列号写法：大写十六进制，补齐为偶数位"""
+    text = f"{serial:X}"
+    return text if len(text) % 2 == 0 else "0" + text
+
+
+def generate_key(key_type="rsa"):
+    """用户私钥：rsa 与 client/client.key 相同（2048 位），ec 为 P-256"""
+    if key_type == "ec":
+        return ec.generate_private_key(ec.SECP256R1())
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def key_pem(key):
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+def cert_pem(cert):
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# fork 出来的签名 worker 使用的 Issuer（父进程在创建进程池前设置，子进程继承）
+_worker_issuer = None
+
+
+def _sign_chunk(jobs):
+    return [_worker_issuer._sign(*job).public_bytes(serialization.Encoding.DER) for job in jobs]
+
+
+class Issuer:
+    """签发 CA：持有配置、CA 证书和私钥，签发用户证书并记入 newcerts/、certs.db 和 index.txt"""
+
+    def __init__(self, config_path=CONFIG_PATH, profile=PROFILE, password=KEY_PASSWORD, certdb_path=None):
+        sections = read_config(config_path)
+        ca = sections[sections["ca"]["default_ca"]]
+        self.dir = ca["dir"]
+        self.new_certs_dir = ca["new_certs_dir"]
+        self.database = ca["database"]
+        self.serial_path = ca["serial"]
+        self.lock_path = self.database + ".lock"
+        self.days = int(ca.get("default_days", 365))
+        self.crlnumber_path = ca.get("crlnumber", os.path.join(self.dir, "crlnumber"))
+        self.crl_days = int(ca.get("default_crl_days", 30))
+        self.hash = _HASHES[ca.get("default_md", "sha256")]()
+        self.profile = profile or ca.get("x509_extensions")
+
+        with open(ca["certificate"], "rb") as f:
+            self.ca_cert = x509.load_pem_x509_certificate(f.read())
+        with open(ca["private_key"], "rb") as f:
+            self._key = serialization.load_pem_private_key(
+                f.read(), password.encode() if password else None)
+        self._extensions = build_extensions(sections[self.profile], self.ca_cert)
+        self.unique_subject = self._read_attr().get("unique_subject", "yes") == "yes"
+        self.db = CertDB(certdb_path or os.path.join(self.dir, "certs.db"))
+        if self.db.count() == 0 and os.path.exists(self.database):
+            self.db.import_index(self.database, self.new_certs_dir)
+
+    def _read_attr(self):
+        try:
+            return read_config(self.database + ".attr")["default"]
+        except FileNotFoundError:
+            return {}
+
+    # ---------------- 签名（不访问文件） ----------------
+
+    def _sign(self, serial, common_name, public_key_der, not_before, not_after):
+        public_key = serialization.load_der_public_key(public_key_der)
+        builder = (x509.CertificateBuilder()
+                   .serial_number(serial)
+                   .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+                   .issuer_name(self.ca_cert.subject)
+                   .public_key(public_key)
+                   .not_valid_before(not_before)
+                   .not_valid_after(not_after))
+        for extension, critical in self._extensions:
+            if extension is None:
+                extension = x509.SubjectKeyIdentifier.from_public_key(public_key)
+            builder = builder.add_extension(extension, critical)
+        return builder.sign(self._key, self.hash)
+
+    def sign_crl(self, builder):
+        """签 CRL（pki/crl.py），颁发者名称取自 CA 证书"""
+        return builder.issuer_name(self.ca_cert.subject).sign(self._key, self.hash)
+
+    def sign_ocsp(self, builder):
+        """签 OCSP 响应（pki/ocsp.py）：由 CA 自己作为响应者，responderID 为公钥哈希"""
+        return builder.responder_id(ocsp.OCSPResponderEncoding.HASH, self.ca_cert).sign(self._key, self.hash)
+
+    # ---------------- 序列号与 index.txt ----------------
+
+    def _reserve(self, subjects):
+        """加锁检查 CN 是否重复，并预留 len(subjects) 个连续序列号，返回第一个"""
+        with _locked(self.lock_path):
+            if self.unique_subject:
+                duplicates = sorted(self.db.valid_subjects(subjects))
+                if duplicates:
+                    raise IssuanceError(f"subject already has a valid certificate: {duplicates[0]}")
+            with open(self.serial_path) as f:
+                current = f.read().strip()
+            first = int(current, 16)
+            with open(self.serial_path + ".old", "w") as f:
+                f.write(current + "\n")
+            tmp = self.serial_path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(serial_hex(first + len(subjects)) + "\n")
+            os.replace(tmp, self.serial_path)
+        return first
+
+    def next_crl_number(self):
+        """加锁取出并递增 crlnumber（与 openssl ca -gencrl 共用），文件不存在时从 1 开始"""
+        with _locked(self.lock_path):
+            try:
+                with open(self.crlnumber_path) as f:
+                    current = f.read().strip()
+            except FileNotFoundError:
+                current = "01"
+            number = int(current, 16)
+            with open(self.crlnumber_path + ".old", "w") as f:
+                f.write(current + "\n")
+            tmp = self.crlnumber_path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(serial_hex(number + 1) + "\n")
+            os.replace(tmp, self.crlnumber_path)
+        return number
+
+    def _record(self, certs):
+        """加锁再检查一次 CN，写 newcerts/<序列号>.pem，把整批记录写入 certs.db、一次追加到 index.txt
+
+        _reserve 的检查和这里之间锁是放开的（签名在锁外进行），另一个进程（另一个 Web 实例、
+        命令行）可能已经为同一 CN 签发并记录了证书，这时放弃这一批，已签名的证书不会写出。
+        """
+        lines = []
+        for cert in certs:
+            expires = index_time(cert.not_valid_after_utc)
+            lines.append(f"V\t{expires}\t\t{serial_hex(cert.serial_number)}\tunknown\t{subject_line(cert)}\n")
+        # certs.db 和 index.txt 在同一把锁内更新，sync_index 不会把这批证书写两遍
+        with _locked(self.lock_path):
+            if self.unique_subject:
+                duplicates = sorted(self.db.valid_subjects([subject_line(cert) for cert in certs]))
+                if duplicates:
+                    raise IssuanceError(f"subject already has a valid certificate: {duplicates[0]}")
+            for cert in certs:
+                with open(os.path.join(self.new_certs_dir, f"{serial_hex(cert.serial_number)}.pem"), "wb") as f:
+                    f.write(cert_pem(cert))
+            self.db.add(certs)
+            with open(self.database, "a") as f:
+                f.write("".join(lines))
+
+    def sync_index(self):
+        """按 certs.db 重写 index.txt（吊销后让 openssl ca 看到 R 记录），返回行数"""
+        with _locked(self.lock_path):
+            return self.db.export_index(self.database)
+
+    # ---------------- 对外接口 ----------------
+
+    def issue(self, requests, workers=1):
+        """签发一批证书；requests 是 CSR（x509.CertificateSigningRequest）或 (CN, 公钥) 的列表
+
+        返回与 requests 顺序相同的证书列表。workers > 1 时签名分给 fork 出的进程。
+        """
+        jobs = [self._prepare(request) for request in requests]
+        if not jobs:
+            return []
+        subjects = [f"/CN={common_name}" for common_name, _ in jobs]
+        if len(set(subjects)) != len(subjects) and self.unique_subject:
+            raise IssuanceError("duplicate subjects in batch")
+        first = self._reserve(subjects)
+        not_before = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        not_after = not_before + datetime.timedelta(days=self.days)
+        jobs = [(first + i, common_name, public_key, not_before, not_after)
+                for i, (common_name, public_key) in enumerate(jobs)]
+        if workers > 1 and len(jobs) > 1:
+            certs = self._sign_parallel(jobs, workers)
+        else:
+            certs = [self._sign(*job) for job in jobs]
+        self._record(certs)
+        return certs
+
+    def issue_one(self, request):
+        return self.issue([request])[0]
+
+    def _prepare(self, request):
+        if isinstance(request, x509.CertificateSigningRequest):
+            if not request.is_signature_valid:
+                raise IssuanceError("CSR signature is invalid")
+            names = request.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+            if not names or not names[0].value:
+                raise IssuanceError("CSR has no commonName (policy_any: commonName = supplied)")
+            common_name, public_key = names[0].value, request.public_key()
+        else:
+            common_name, public_key = request
+        # index.txt 一行以制表符分隔，主体写成 /CN=...：这些字符会弄乱记录或让 CN 被截断
+        if not common_name or any(ch in common_name for ch in "/\t\r\n") or not common_name.isprintable():
+            raise IssuanceError(f"commonName contains characters not allowed in index.txt: {common_name!r}")
+        der = public_key.public_bytes(serialization.Encoding.DER,
+                                      serialization.PublicFormat.SubjectPublicKeyInfo)
+        return common_name, der
+
+    def _sign_parallel(self, jobs, workers):
+        global _worker_issuer
+        _worker_issuer = self
+        size = -(-len(jobs) // (workers * 4))
+        chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = pool.map(_sign_chunk, chunks)
+        return [x509.load_der_x509_certificate(der) for chunk in results for der in chunk]
+
+
+def _generate(key_type):
+    return key_pem(generate_key(key_type))
+
+
+def generate_keys(count, key_type="rsa", workers=1):
+    """生成 count 个用户私钥；workers > 1 时分给多个进程（RSA 密钥生成是 CPU 密集的）"""
+    if workers > 1 and count > 1:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            pems = pool.map(_generate, [key_type] * count)
+        return [serialization.load_pem_private_key(pem, None) for pem in pems]
+    return [generate_key(key_type) for _ in range(count)]
+
+
+def _write(path, data, mode=0o644):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用 ca/issuing 签发用户证书（usr_cert）")
+    parser.add_argument("--config", default=CONFIG_PATH, help="openssl ca 的配置文件")
+    parser.add_argument("--workers", type=int, default=1, help="签名（和生成私钥）的进程数")
+    parser.add_argument("--profile", default=PROFILE, help=f"扩展节（{PROFILE} 或只能做客户端认证的 {CLIENT_PROFILE}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sign = sub.add_parser("sign", help="签一个 CSR")
+    sign.add_argument("csr")
+    sign.add_argument("-o", "--output", help="证书输出路径，默认打印到标准输出")
+
+    batch = sub.add_parser("batch", help="签目录中所有 *.csr，证书写成同名 .crt")
+    batch.add_argument("csr_dir")
+    batch.add_argument("--out-dir", required=True)
+
+    users = sub.add_parser("users", help="为每个用户名生成私钥并签发证书（<用户名>.key/.crt）")
+    users.add_argument("names", nargs="*")
+    users.add_argument("--count", type=int, default=0, help="另外生成 <prefix>1..<prefix>N")
+    users.add_argument("--prefix", default="user")
+    users.add_argument("--key-type", choices=("rsa", "ec"), default="rsa")
+    users.add_argument("--out-dir", required=True)
+    args = parser.parse_args()
+
+    issuer = Issuer(args.config, profile=args.profile)
+    start = time.perf_counter()
+    try:
+        if args.command == "sign":
+            with open(args.csr, "rb") as f:
+                cert = issuer.issue_one(x509.load_pem_x509_csr(f.read()))
+            if args.output:
+                _write(args.output, cert_pem(cert))
+            else:
+                sys.stdout.write(cert_pem(cert).decode())
+            certs = [cert]
+        elif args.command == "batch":
+            names = sorted(name for name in os.listdir(args.csr_dir) if name.endswith(".csr"))
+            csrs = []
+            for name in names:
+                with open(os.path.join(args.csr_dir, name), "rb") as f:
+                    csrs.append(x509.load_pem_x509_csr(f.read()))
+            certs = issuer.issue(csrs, workers=args.workers)
+            os.makedirs(args.out_dir, exist_ok=True)
+            for name, cert in zip(names, certs):
+                _write(os.path.join(args.out_dir, name[:-4] + ".crt"), cert_pem(cert))
+        else:
+            names = args.names + [f"{args.prefix}{i}" for i in range(1, args.count + 1)]
+            keys = generate_keys(len(names), args.key_type, workers=args.workers)
+            certs = issuer.issue([(name, key.public_key()) for name, key in zip(names, keys)],
+                                 workers=args.workers)
+            os.makedirs(args.out_dir, exist_ok=True)
+            for name, key, cert in zip(names, keys, certs):
+                _write(os.path.join(args.out_dir, f"{name}.key"), key_pem(key), 0o600)
+                _write(os.path.join(args.out_dir, f"{name}.crt"), cert_pem(cert))
+    except IssuanceError as e:
+        sys.exit(f"[-] {e}")
+    elapsed = time.perf_counter() - start
+    if certs:
+        print(f"[*] issued {len(certs)} certificates ({serial_hex(certs[0].serial_number)}..."
+              f"{serial_hex(certs[-1].serial_number)}) in {elapsed:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# pki/keypool.py
+"""预先生成的用户私钥池：注册时只需要签名，不再当场生成 RSA 密钥
+
+生成一把 RSA-2048 私钥要几十到几百毫秒（随机素数搜索，耗时波动很大），是签发用户证书
+最慢的一步。密钥池目录中常备 --size 把已生成的私钥，取用时拿走一把，补充进程在后台
+用多个 worker 进程（默认每核一个）补足。
+
+每把私钥一个文件 <随机名>.key：12 字节随机数 + AES-256-GCM 加密的 PKCS#8 DER，
+加密密钥由 CHAT_KEYPOOL_SECRET 经 scrypt 导出，目录被复制也拿不到明文私钥；GCM 同时
+校验完整性，所以加载时可以跳过 RSA 私钥自检（否则每次加载约 45 ms，和生成差不多慢）。
+取用时先把文件 rename 成取用者独有的名字再读取、删除：rename 是原子的，多个进程
+（多个 web 实例）同时取用也不会拿到同一把私钥。解不开的文件（口令变了）直接丢弃。
+
+    export CHAT_KEYPOOL_SECRET=<口令>
+    python pki/keypool.py fill --size 200     # 补足到 200 把后退出
+    python pki/keypool.py serve               # 常驻：低于 --size 时立即补充
+    python pki/keypool.py status
+
+web/app.py 启用证书签发时会自己启动 serve 进程（见 web/enrollment.py）。
+"""
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.issuer import generate_key
+
+KEYPOOL_DIR = os.environ.get("CHAT_KEYPOOL_DIR", "ca/keypool")
+KEYPOOL_SIZE = int(os.environ.get("CHAT_KEYPOOL_SIZE", "64"))
+KEYPOOL_WORKERS = int(os.environ.get("CHAT_KEYPOOL_WORKERS", "0")) or os.cpu_count() or 1
+KEYPOOL_SECRET = os.environ.get("CHAT_KEYPOOL_SECRET")
+# serve 进程检查池中存量的间隔（秒）
+REFILL_INTERVAL = 0.5
+
+_NONCE_SIZE = 12
+_AAD = b"chat-keypool-v1"
+_SUFFIX = ".key"
+
+
+def derive_key(secret):
+    """由口令导出 AES-256 密钥（每个进程只算一次）"""
+    return hashlib.scrypt(secret.encode("utf-8"), salt=_AAD, n=2 ** 14, r=8, p=1, dklen=32)
+
+
+def seal(aes_key, private_key):
+    nonce = os.urandom(_NONCE_SIZE)
+    der = private_key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    return nonce + AESGCM(aes_key).encrypt(nonce, der, _AAD)
+
+
+def unseal(aes_key, blob):
+    der = AESGCM(aes_key).decrypt(blob[:_NONCE_SIZE], blob[_NONCE_SIZE:], _AAD)
+    return serialization.load_der_private_key(der, None, unsafe_skip_rsa_key_validation=True)
+
+
+def _generate_sealed(args):
+    aes_key, key_type = args
+    return seal(aes_key, generate_key(key_type))
+
+
+@contextlib.contextmanager
+def _exclusive(path):
+    """只允许一个补充进程工作；持有者退出后由等待者接替"""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class KeyPool:
+    """目录中的加密私钥池：take() 取一把，fill() 补足"""
+
+    def __init__(self, directory=KEYPOOL_DIR, secret=KEYPOOL_SECRET, size=KEYPOOL_SIZE,
+                 workers=KEYPOOL_WORKERS, key_type="rsa"):
+        if not secret:
+            raise ValueError("CHAT_KEYPOOL_SECRET is not set")
+        self.directory = directory
+        self.secret = secret
+        self.size = size
+        self.workers = max(1, workers)
+        self.key_type = key_type
+        self._aes_key = derive_key(secret)
+        self._lock = threading.Lock()
+        self.taken = 0
+        self.misses = 0
+        self.discarded = 0
+        self._refiller = None
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith(_SUFFIX)]
+
+    def available(self):
+        return len(self._entries())
+
+    def take(self):
+        """取一把私钥；池为空时当场生成（计入 misses）"""
+        claim = f".{os.getpid()}.{threading.get_ident()}.taken"
+        for entry in self._entries():
+            claimed = entry.path + claim
+            try:
+                os.rename(entry.path, claimed)
+            except FileNotFoundError:
+                continue  # 被别的进程抢先取走
+            try:
+                with open(claimed, "rb") as f:
+                    blob = f.read()
+            finally:
+                os.unlink(claimed)
+            try:
+                key = unseal(self._aes_key, blob)
+            except (InvalidTag, ValueError):
+                with self._lock:
+                    self.discarded += 1
+                continue
+            with self._lock:
+                self.taken += 1
+            return key
+        with self._lock:
+            self.misses += 1
+        return generate_key(self.key_type)
+
+    def _store(self, blob):
+        name = os.urandom(8).hex()
+        tmp = os.path.join(self.directory, f".{name}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        # 写完再改成 .key，取用者不会读到写了一半的文件
+        os.rename(tmp, os.path.join(self.directory, name + _SUFFIX))
+
+    def fill(self, pool=None):
+        """补足到 size 把，返回本次生成的数量；pool 是复用的 multiprocessing.Pool"""
+        deficit = self.size - self.available()
+        if deficit <= 0:
+            return 0
+        jobs = [(self._aes_key, self.key_type)] * deficit
+        if pool is None and self.workers > 1 and deficit > 1:
+            with multiprocessing.get_context("fork").Pool(min(self.workers, deficit)) as own:
+                for blob in own.imap_unordered(_generate_sealed, jobs):
+                    self._store(blob)
+        elif pool is not None:
+            for blob in pool.imap_unordered(_generate_sealed, jobs):
+                self._store(blob)
+        else:
+            for job in jobs:
+                self._store(_generate_sealed(job))
+        return deficit
+
+    def serve(self, interval=REFILL_INTERVAL, parent_pid=None):
+        """常驻补充：持有目录锁，每 interval 秒检查一次；parent_pid 退出后随之退出"""
+        with _exclusive(os.path.join(self.directory, ".refill.lock")):
+            with multiprocessing.get_context("fork").Pool(self.workers) as pool:
+                while parent_pid is None or os.getppid() == parent_pid:
+                    self.fill(pool)
+                    time.sleep(interval)
+
+    def start_refiller(self):
+        """在独立的进程中运行 serve（不在调用者进程里 fork：web/app.py 可能打了协程补丁）"""
+        env = dict(os.environ, CHAT_KEYPOOL_SECRET=self.secret)
+        self._refiller = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "serve", "--dir", self.directory,
+             "--size", str(self.size), "--workers", str(self.workers), "--key-type", self.key_type,
+             "--parent-pid", str(os.getpid())],
+            env=env)
+        return self._refiller
+
+    def stop_refiller(self):
+        if self._refiller is not None and self._refiller.poll() is None:
+            self._refiller.send_signal(signal.SIGTERM)
+            self._refiller = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "available": self.available(),
+                "taken": self.taken,
+                "misses": self.misses,
+                "discarded": self.discarded,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="预先生成的加密私钥池（口令取自 CHAT_KEYPOOL_SECRET）")
+    parser.add_argument("command", choices=("fill", "serve", "status"))
+    parser.add_argument("--dir", default=KEYPOOL_DIR)
+    parser.add_argument("--size", type=int, default=KEYPOOL_SIZE, help="池中常备的私钥数")
+    parser.add_argument("--workers", type=int, default=KEYPOOL_WORKERS, help="生成私钥的进程数")
+    parser.add_argument("--key-type", choices=("rsa", "ec"), default="rsa")
+    parser.add_argument("--parent-pid", type=int, help="serve：该进程退出后随之退出")
+    args = parser.parse_args()
+
+    try:
+        pool = KeyPool(args.dir, size=args.size, workers=args.workers, key_type=args.key_type)
+    except ValueError as e:
+        sys.exit(f"[-] {e}")
+    if args.command == "status":
+        print(f"[*] {pool.available()} keys in {args.dir}")
+    elif args.command == "fill":
+        start = time.perf_counter()
+        count = pool.fill()
+        print(f"[*] generated {count} keys in {time.perf_counter() - start:.2f}s "
+              f"({args.workers} workers), {pool.available()} available")
+    else:
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            pool.serve(parent_pid=args.parent_pid)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+# pki/ocsp.py
+"""本地 OCSP 响应器 + 服务器端 stapling：客户端不必下载整张 CRL，握手后也不必再去问 OCSP
+
+OcspResponder 以签发 CA（ca/issuing）自己的身份签 OCSP 响应（RFC 6960），证书状态取自
+certs.db（pki/certdb.py）：有效为 good，已吊销为 revoked（带吊销时间和原因）。查不到的序列号
+回答预先编码好的 unauthorized（RFC 5019 允许），既不签名也不缓存：/ocsp 不需要登录，随便编造的
+序列号不能让响应器每次做一次 RSA-4096 签名、再留下一个缓存项。
+同一个序列号的响应只签一次，缓存 OCSP_TTL 秒（响应的 nextUpdate 是 thisUpdate + 2 × OCSP_TTL，
+缓存到期前发出的响应仍然有效），缓存最多 OCSP_CACHE_SIZE 项（LRU）；发布新 CRL 时
+（RevocationIndex 重新加载）清空缓存，吊销立即生效。
+预签的响应不带请求中的 nonce（RFC 5019 轻量模式，openssl ocsp 会提示 "no nonce in response"）。
+
+    python pki/ocsp.py serve                       # http://127.0.0.1:8889/，POST 或 GET /<base64 请求>
+    python pki/ocsp.py query client/client.crt     # 向响应器查询一张证书
+    openssl ocsp -issuer ca/issuing/certs/issuing.crt -cert client/client.crt \
+        -url http://127.0.0.1:8889/ -CAfile ca/ca-chain.pem
+
+web/app.py 已经在进程内加载签发 CA，同一个响应器也挂在 https://<web>/ocsp 上。
+
+Python 的 ssl 模块没有 OCSP stapling 的接口（TLS 的 status_request 扩展），所以 OcspStapler
+在应用层做同样的事：服务器在后台为自己的证书预取 OCSP 响应、在过期前刷新，握手后把它
+和第一条消息放在同一次发送里交给客户端（server/chat_server.py 的 "[OCSP] <base64>" 行），
+客户端用 verify_response 校验签名、序列号和有效期 —— 检查吊销不增加任何往返。
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import sys
+import threading
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.x509 import ocsp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.certdb import normalize_serial
+from pki.crl import reason_flag, utc
+
+OCSP_HOST = "127.0.0.1"
+OCSP_PORT = int(os.environ.get("CHAT_OCSP_PORT", "8889"))
+OCSP_URL = os.environ.get("CHAT_OCSP_URL", f"http://{OCSP_HOST}:{OCSP_PORT}/")
+# 每个序列号的预签响应缓存多久（秒）
+OCSP_TTL = int(os.environ.get("CHAT_OCSP_TTL", "3600"))
+# 最多缓存多少个 (序列号, 哈希算法) 的响应，超过时淘汰最久未用的
+OCSP_CACHE_SIZE = int(os.environ.get("CHAT_OCSP_CACHE_SIZE", "10000"))
+ISSUING_CA_CERT = "ca/issuing/certs/issuing.crt"
+# 校验响应时间时允许的时钟偏差（秒）
+CLOCK_SKEW = 300
+# stapler 预取失败后的重试间隔（秒）
+RETRY_INTERVAL = 10
+FETCH_TIMEOUT = 2
+
+_CONTENT_TYPE = "application/ocsp-response"
+
+
+class OcspError(ValueError):
+    """OCSP 响应无效：状态不是 successful、不是这张证书的、签名不对或已过期"""
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+
+def issuer_hashes(issuer_cert, algorithm):
+    """CertID 中的 (issuerNameHash, issuerKeyHash)（RFC 6960）
+
+    名称哈希是签发 CA 主题的 DER；公钥哈希借 OCSPRequestBuilder 计算（它取第二个参数的公钥），
+    请求里的名称哈希是第一个参数的 issuer，不能直接用。
+    """
+    name_hash = hashes.Hash(algorithm)
+    name_hash.update(issuer_cert.subject.public_bytes())
+    request = ocsp.OCSPRequestBuilder().add_certificate(issuer_cert, issuer_cert, algorithm).build()
+    return name_hash.finalize(), request.issuer_key_hash
+
+
+def build_request(cert, issuer_cert, algorithm=None):
+    """OCSP 请求（DER），CertID 默认用 SHA-1（与 openssl ocsp 相同）"""
+    builder = ocsp.OCSPRequestBuilder().add_certificate(cert, issuer_cert, algorithm or hashes.SHA1())
+    return builder.build().public_bytes(serialization.Encoding.DER)
+
+
+def _verify_signature(public_key, signature, data, algorithm):
+    if isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(signature, data, padding.PKCS1v15(), algorithm)
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        public_key.verify(signature, data, ec.ECDSA(algorithm))
+    else:
+        public_key.verify(signature, data)
+
+
+def verify_response(der, cert, issuer_cert, now=None):
+    """校验 OCSP 响应（DER）是签发 CA 为 cert 签的且仍在有效期内，返回 ocsp.OCSPResponse"""
+    try:
+        response = ocsp.load_der_ocsp_response(der)
+    except ValueError as e:
+        raise OcspError(f"malformed OCSP response: {e}")
+    if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+        raise OcspError(f"OCSP responder returned {response.response_status.name}")
+    if response.serial_number != cert.serial_number:
+        raise OcspError("OCSP response is for a different certificate")
+    if (response.issuer_name_hash, response.issuer_key_hash) != issuer_hashes(issuer_cert, response.hash_algorithm):
+        raise OcspError("OCSP response is for a different issuer")
+    try:
+        _verify_signature(issuer_cert.public_key(), response.signature, response.tbs_response_bytes,
+                          response.signature_hash_algorithm)
+    except InvalidSignature:
+        raise OcspError("OCSP response signature does not match the issuing CA")
+    now = now or _now()
+    skew = datetime.timedelta(seconds=CLOCK_SKEW)
+    if response.this_update_utc > now + skew:
+        raise OcspError("OCSP response is not yet valid")
+    if response.next_update_utc is not None and response.next_update_utc < now - skew:
+        raise OcspError("OCSP response has expired")
+    return response
+
+
+def describe(response):
+    result = {
+        "serial": normalize_serial(response.serial_number),
+        "status": response.certificate_status.name.lower(),
+        "this_update": response.this_update_utc.isoformat(),
+        "next_update": response.next_update_utc.isoformat() if response.next_update_utc else None,
+    }
+    if response.certificate_status == ocsp.OCSPCertStatus.REVOKED:
+        result["revoked_at"] = response.revocation_time_utc.isoformat()
+        if response.revocation_reason is not None:
+            result["reason"] = response.revocation_reason.value
+    return result
+
+
+class OcspResponder:
+    """为签发 CA 签 OCSP 响应，按 (序列号, CertID 哈希算法) 缓存预签的响应（LRU）"""
+
+    def __init__(self, issuer, ttl=OCSP_TTL, cache_size=OCSP_CACHE_SIZE):
+        self.issuer = issuer
+        self.ttl = ttl
+        self.cache_size = max(1, cache_size)
+        self._hashes = {}
+        # (序列号, 算法名) -> (过期时间, DER)，按最近使用排序
+        self._cache = OrderedDict()
+        self._not_found = ocsp.OCSPResponseBuilder.build_unsuccessful(
+            ocsp.OCSPResponseStatus.UNAUTHORIZED).public_bytes(serialization.Encoding.DER)
+        # clear() 时加一：清空之前开始、之后才签完的响应不再放进缓存
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.signed = 0
+        self.rejected = 0
+        self.not_found = 0
+
+    def _issuer_hashes(self, algorithm):
+        value = self._hashes.get(algorithm.name)
+        if value is None:
+            value = self._hashes[algorithm.name] = issuer_hashes(self.issuer.ca_cert, algorithm)
+        return value
+
+    def respond(self, request_der):
+        """处理一个 OCSP 请求（DER），返回响应（DER）"""
+        try:
+            request = ocsp.load_der_ocsp_request(request_der)
+            expected = self._issuer_hashes(request.hash_algorithm)
+        except (ValueError, TypeError, NotImplementedError):
+            # cryptography 只解析含一个 CertID 的请求，一次查多张证书按格式错误拒绝
+            return self._unsuccessful(ocsp.OCSPResponseStatus.MALFORMED_REQUEST)
+        if (request.issuer_name_hash, request.issuer_key_hash) != expected:
+            return self._unsuccessful(ocsp.OCSPResponseStatus.UNAUTHORIZED)
+        return self.response_for(request.serial_number, request.hash_algorithm)
+
+    def _unsuccessful(self, status):
+        with self._lock:
+            self.rejected += 1
+        return ocsp.OCSPResponseBuilder.build_unsuccessful(status).public_bytes(serialization.Encoding.DER)
+
+    def response_for(self, serial, algorithm=None):
+        """序列号的 OCSP 响应（DER）：缓存未过期时直接返回，否则按 certs.db 当前状态重签；
+        certs.db 中没有的序列号返回 unauthorized"""
+        algorithm = algorithm or hashes.SHA1()
+        key = (serial, algorithm.name)
+        now = _now()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if now < cached[0]:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return cached[1]
+                del self._cache[key]
+            generation = self._generation
+        row = self.issuer.db.by_serial(serial)
+        if row is None:
+            with self._lock:
+                self.not_found += 1
+            return self._not_found
+        der = self._sign(row, serial, algorithm, now)
+        with self._lock:
+            if generation == self._generation:
+                self._cache[key] = (now + datetime.timedelta(seconds=self.ttl), der)
+                self._cache.move_to_end(key)
+                # 先丢最久未用的；缓存项的 TTL 相同，排在前面的通常也是最早过期的
+                while self._cache and (len(self._cache) > self.cache_size
+                                       or now >= next(iter(self._cache.values()))[0]):
+                    self._cache.popitem(last=False)
+            self.signed += 1
+        return der
+
+    def _sign(self, row, serial, algorithm, now):
+        revocation_time = reason = None
+        if row["status"] == "R":
+            status = ocsp.OCSPCertStatus.REVOKED
+            revocation_time = utc(row["revoked_at"])
+            reason = reason_flag(row["reason"])
+        else:
+            status = ocsp.OCSPCertStatus.GOOD
+        name_hash, key_hash = self._issuer_hashes(algorithm)
+        builder = ocsp.OCSPResponseBuilder().add_response_by_hash(
+            issuer_name_hash=name_hash, issuer_key_hash=key_hash, serial_number=serial,
+            algorithm=algorithm, cert_status=status, this_update=now,
+            next_update=now + datetime.timedelta(seconds=2 * self.ttl),
+            revocation_time=revocation_time, revocation_reason=reason)
+        return self.issuer.sign_ocsp(builder).public_bytes(serialization.Encoding.DER)
+
+    def presign(self, serials):
+        """预先签好一批序列号的响应（例如各服务器自己的证书）"""
+        for serial in serials:
+            self.response_for(serial)
+
+    def clear(self):
+        """丢弃全部缓存（吊销后由 RevocationIndex 的监听调用）"""
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {"cached": len(self._cache), "hits": self.hits, "signed": self.signed,
+                    "rejected": self.rejected, "not_found": self.not_found,
+                    "cache_size": self.cache_size, "ttl": self.ttl}
+
+
+def decode_get_path(path):
+    """GET 请求的路径：/<URL 编码的 base64 请求>（RFC 6960 附录 A.1）"""
+    return base64.b64decode(urllib.parse.unquote(path.lstrip("/")), validate=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    responder = None
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self._reply(self.responder.respond(self.rfile.read(length)))
+
+    def do_GET(self):
+        try:
+            request_der = decode_get_path(self.path)
+        except ValueError:
+            self.send_error(400)
+            return
+        self._reply(self.responder.respond(request_der))
+
+    def _reply(self, der):
+        self.send_response(200)
+        self.send_header("Content-Type", _CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(der)))
+        self.end_headers()
+        self.wfile.write(der)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(responder, host=OCSP_HOST, port=OCSP_PORT):
+    handler = type("OcspHandler", (_Handler,), {"responder": responder})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"[*] OCSP responder for {responder.issuer.ca_cert.subject.rfc4514_string()} on http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def fetch(url, cert, issuer_cert, timeout=FETCH_TIMEOUT):
+    """POST 一个 OCSP 请求，返回响应（DER）"""
+    http_request = urllib.request.Request(
+        url, data=build_request(cert, issuer_cert),
+        headers={"Content-Type": "application/ocsp-request"})
+    with urllib.request.urlopen(http_request, timeout=timeout) as reply:
+        return reply.read()
+
+
+def load_certificate(path):
+    """PEM 文件中的第一张证书（fullchain 文件即叶子证书）"""
+    with open(path, "rb") as f:
+        return x509.load_pem_x509_certificate(f.read())
+
+
+class OcspStapler:
+    """服务器为自己的证书预取并缓存 OCSP 响应（应用层的 stapling）
+
+    后台线程在响应有效期过半时刷新，失败后每 RETRY_INTERVAL 秒重试；staple() 只返回
+    仍在有效期内的响应，拿不到时返回 None（客户端照常连接，只是没有 OCSP 状态）。
+    """
+
+    def __init__(self, certfile, issuer_cert=ISSUING_CA_CERT, url=OCSP_URL):
+        self.cert = load_certificate(certfile)
+        self.issuer_cert = load_certificate(issuer_cert)
+        self.url = url
+        self._staple = None
+        self._next_update = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._failing = False
+        self.refreshes = 0
+        self.failures = 0
+
+    def staple(self):
+        staple, next_update = self._staple, self._next_update
+        if staple is None or (next_update is not None and next_update <= _now()):
+            return None
+        return staple
+
+    def refresh(self):
+        """取一次响应，返回距下次刷新的秒数"""
+        try:
+            der = fetch(self.url, self.cert, self.issuer_cert)
+            response = verify_response(der, self.cert, self.issuer_cert)
+        except (OSError, OcspError) as e:
+            self.failures += 1
+            if not self._failing:
+                print(f"[!] OCSP stapling: cannot get a response from {self.url}: {e}")
+            self._failing = True
+            return RETRY_INTERVAL
+        if self._failing:
+            print(f"[*] OCSP stapling: got a response from {self.url}")
+        self._failing = False
+        self._staple, self._next_update = der, response.next_update_utc
+        self.refreshes += 1
+        if response.next_update_utc is None:
+            return OCSP_TTL
+        return max(RETRY_INTERVAL, (response.next_update_utc - _now()).total_seconds() / 2)
+
+    def _run(self):
+        delay = 0
+        while not self._stop.wait(delay):
+            delay = self.refresh()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ocsp-stapler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {"stapled": self.staple() is not None,
+                "next_update": self._next_update.isoformat() if self._next_update else None,
+                "refreshes": self.refreshes, "failures": self.failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ca/issuing 的本地 OCSP 响应器")
+    sub = parser.add_subparsers(dest="command", required=True)
+    srv = sub.add_parser("serve", help="运行 HTTP 响应器")
+    srv.add_argument("--host", default=OCSP_HOST)
+    srv.add_argument("--port", type=int, default=OCSP_PORT)
+    srv.add_argument("--ttl", type=int, default=OCSP_TTL, help="每个序列号的响应缓存多久（秒）")
+    srv.add_argument("--presign", nargs="*", default=[], metavar="CERT",
+                     help="启动时预签这些证书的响应（默认 server/server.crt）")
+    query = sub.add_parser("query", help="向响应器查询证书状态")
+    query.add_argument("cert")
+    query.add_argument("--url", default=OCSP_URL)
+    query.add_argument("--issuer", default=ISSUING_CA_CERT)
+    args = parser.parse_args()
+
+    if args.command == "query":
+        cert = load_certificate(args.cert)
+        issuer_cert = load_certificate(args.issuer)
+        try:
+            response = verify_response(fetch(args.url, cert, issuer_cert), cert, issuer_cert)
+        except (OSError, OcspError) as e:
+            sys.exit(f"[-] {e}")
+        print(json.dumps(describe(response), indent=2))
+        return
+
+    from pki.crl import RevocationIndex
+    from pki.issuer import Issuer
+    responder = OcspResponder(Issuer(), ttl=args.ttl)
+    # 发布新 CRL（吊销）后丢弃缓存的 good 响应
+    revocation = RevocationIndex()
+    revocation.add_listener(responder.clear)
+    revocation.start()
+    presign = args.presign or ["server/server.crt"]
+    responder.presign(load_certificate(path).serial_number for path in presign if os.path.exists(path))
+    serve(responder, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
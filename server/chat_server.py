@@ -1,113 +1,522 @@
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import signal
 import ssl
 import socket
+import sys
 import threading
+import time
+
+from cluster import Broker, BroadcastBus
+from fanout import AsyncFanout, ThreadedFanout, SLOW_CONSUMER_POLICIES
+from protocol import LineDecoder, FrameTooLarge, READ_SIZE, decode_line, encode_line
+from tls import (SESSION_TICKETS, create_revocation_index, create_server_context, create_stapler, peer_revoked,
+                 session_summary)
 
 HOST = "0.0.0.0"
 PORT = 4433
 
-# 保存在线用户：username -> (conn, addr)
-clients = {}
-lock = threading.Lock()
+# 每个客户端最多积压多少条待发送消息；超出后按 SLOW_CONSUMER_POLICY 断开它或丢弃消息
+CLIENT_QUEUE_SIZE = 256
+SLOW_CONSUMER_POLICY = "disconnect"
+# 登录和 TLS 握手超时（秒）；单行最大长度见 protocol.MAX_FRAME
+LOGIN_TIMEOUT = 30
+HANDSHAKE_TIMEOUT = 10
+# 同时进行的 TLS 握手数上限，超出的连接排队等待（最多 HANDSHAKE_TIMEOUT 秒）
+MAX_HANDSHAKES = 64
+# listen() 的积压队列长度：连接突增时内核中等待 accept 的连接数
+LISTEN_BACKLOG = 1024
+
+# ---------------- 线程模式：每个客户端一个读线程 + 一个写线程 ----------------
+
+# 在线用户：username -> 发送队列
+thread_fanout = ThreadedFanout(CLIENT_QUEUE_SIZE, SLOW_CONSUMER_POLICY)
+
+
+def format_message(sender, msg: str) -> bytes:
+    return encode_line(f"[{sender}] {msg}")
+
+
+# 当前使用的 TLS 上下文（/stats 中报告会话恢复情况）
+tls_context = None
+# 多进程模式下本进程的 worker 编号和到主进程中继的连接，单进程模式为 None
+worker_id = None
+bus = None
+# 已吊销序列号的索引（tls.create_revocation_index），握手后检查对端证书；不可用时为 None
+revocation = None
+# 服务器证书的 OCSP 响应预取器（tls.create_stapler），不可用时为 None
+stapler = None
+
+LOGIN_PROMPT = b"Please login: send 'LOGIN:<username>'\n"
+# 服务器自己发出的 "[OCSP] ..."、"[STATS] ..." 行与 "[用户名] 消息" 同形，这些名字不能登录
+RESERVED_USERNAMES = frozenset({"OCSP", "STATS"})
+
+
+def greeting():
+    """登录提示；有服务器证书的 OCSP 响应时放在它前面一起发送（stapling，不增加往返）"""
+    staple = stapler.staple() if stapler is not None else None
+    if staple is None:
+        return LOGIN_PROMPT
+    return b"[OCSP] " + base64.b64encode(staple) + b"\n" + LOGIN_PROMPT
+
+
+def format_stats(fanout, client):
+    """/stats 命令的回复：总体扇出统计、自己的积压和 TLS 会话恢复统计"""
+    data = fanout.stats()
+    data["you"] = client.stats()
+    if tls_context is not None:
+        data["tls"] = session_summary(tls_context)
+    if revocation is not None:
+        data["revocation"] = revocation.stats()
+    if stapler is not None:
+        data["ocsp"] = stapler.stats()
+    if worker_id is not None:
+        data["worker"] = worker_id
+    return f"[STATS] {json.dumps(data)}\n".encode("utf-8")
 
 
 def broadcast(sender, msg: str):
-    """给所有在线用户广播消息"""
-    with lock:
-        for username, (conn, _) in clients.items():
-            # 自己也想看到自己发的，可改成 if username != sender
-            try:
-                conn.sendall(f"[{sender}] {msg}\n".encode("utf-8"))
-            except Exception:
-                pass
+    """给所有在线用户广播消息：编码一次，放进每个人的发送队列后立即返回"""
+    # 自己也想看到自己发的，所以发送者也在订阅者里
+    thread_fanout.publish(format_message(sender, msg))
+
+
+def parse_login(frame: bytes, fanout):
+    """解析第一帧 LOGIN:<username>，返回 (用户名, None) 或 (None, 错误提示)"""
+    first = decode_line(frame)
+    if not first.startswith("LOGIN:"):
+        return None, b"Invalid login format. Bye.\n"
+    username = first.split(":", 1)[1].strip()
+    if not username:
+        return None, b"Empty username. Bye.\n"
+    if username.upper() in RESERVED_USERNAMES:
+        return None, b"Reserved username. Bye.\n"
+    if username in fanout:
+        return None, b"Username already in use.\n"
+    return username, None
+
+
+def handle_frames(fanout, client, frames):
+    """处理一次读取得到的所有完整消息，收到 /quit 时返回 False
+
+    同一次读取中的多条消息合并成一个 bytes 广播，每个订阅者的队列里只占一项。
+    """
+    outgoing = []
+    keep_going = True
+    for frame in frames:
+        msg = decode_line(frame)
+        if not msg:
+            continue
+        if msg.lower() == "/quit":
+            keep_going = False
+            break
+        if msg.lower() == "/stats":
+            fanout.send(client, format_stats(fanout, client))
+            continue
+        outgoing.append(format_message(client.name, msg))
+    if outgoing:
+        fanout.publish(b"".join(outgoing))
+    return keep_going
 
 
 def handle_client(conn: ssl.SSLSocket, addr):
     print(f"[+] TLS connection from {addr}")
+    client = None
+    decoder = LineDecoder()
 
     try:
         # 第一句话要求客户端发送：LOGIN:用户名
-        conn.sendall(b"Please login: send 'LOGIN:<username>'\n")
-        first = conn.recv(1024).decode("utf-8").strip()
-        if not first.startswith("LOGIN:"):
-            conn.sendall(b"Invalid login format. Bye.\n")
-            conn.close()
-            return
+        conn.sendall(greeting())
+        conn.settimeout(LOGIN_TIMEOUT)
+        frames = []
+        while not frames:
+            data = conn.recv(READ_SIZE)
+            if not data:
+                return
+            frames = decoder.feed(data)
 
-        username = first.split(":", 1)[1].strip()
-        if not username:
-            conn.sendall(b"Empty username. Bye.\n")
-            conn.close()
+        username, error = parse_login(frames[0], thread_fanout)
+        if error:
+            conn.sendall(error)
             return
 
-        with lock:
-            if username in clients:
-                conn.sendall(b"Username already in use.\n")
-                conn.close()
-                return
-            clients[username] = (conn, addr)
+        client = thread_fanout.register(username, conn)
+        if client is None:
+            conn.sendall(b"Username already in use.\n")
+            return
 
-        conn.sendall(f"Welcome, {username}! You can start chatting.\n".encode("utf-8"))
+        thread_fanout.send(client, f"Welcome, {username}! You can start chatting.\n".encode("utf-8"))
         broadcast("SYSTEM", f"{username} joined the chat.")
 
-        # 循环收消息
+        # 和 LOGIN 一起到达的消息
+        if not handle_frames(thread_fanout, client, frames[1:]):
+            return
+
+        # 循环收消息（与写线程互斥地读取），一次读取可能包含多条消息
         while True:
-            data = conn.recv(1024)
+            data = client.recv(READ_SIZE)
             if not data:
                 break
-            msg = data.decode("utf-8").strip()
-            if msg.lower() == "/quit":
+            if not handle_frames(thread_fanout, client, decoder.feed(data)):
                 break
-            broadcast(username, msg)
 
+    except FrameTooLarge as e:
+        print(f"[!] Protocol error with client {addr}: {e}")
     except Exception as e:
         print(f"[!] Error with client {addr}: {e}")
     finally:
-        with lock:
-            # 从在线表删掉
-            for u, (c, _) in list(clients.items()):
-                if c is conn:
-                    del clients[u]
-                    broadcast("SYSTEM", f"{u} left the chat.")
-                    break
+        # 从在线表删掉
+        if client is not None:
+            if thread_fanout.unregister(client):
+                broadcast("SYSTEM", f"{client.name} left the chat.")
+            thread_fanout.close(client)
         conn.close()
         print(f"[-] Connection from {addr} closed.")
 
 
-def main():
-    # TLS 服务器上下文
-    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+def handshake_client(context, slots, client_sock, addr):
+    """在客户端自己的线程里完成 TLS 握手，再进入 handle_client
 
-    # 用第二阶段的 fullchain 和私钥
-    context.load_cert_chain(
-        certfile="server/server_fullchain.crt",
-        keyfile="server/server.key"
-    )
+    握手不在 accept 循环中进行，慢速或恶意客户端只占用自己的线程和一个握手名额。
+    """
+    if not slots.acquire(timeout=HANDSHAKE_TIMEOUT):
+        print(f"[!] Too many TLS handshakes in progress, dropping {addr}")
+        client_sock.close()
+        return
 
-    # 验证客户端证书（仍然是双向认证）
-    context.load_verify_locations("ca/certs/root.crt")
-    context.verify_mode = ssl.CERT_REQUIRED
+    try:
+        client_sock.settimeout(HANDSHAKE_TIMEOUT)
+        tls_conn = context.wrap_socket(client_sock, server_side=True, do_handshake_on_connect=False)
+        tls_conn.do_handshake()
+    except (ssl.SSLError, OSError) as e:
+        print(f"[!] TLS handshake failed from {addr}: {e}")
+        client_sock.close()
+        return
+    finally:
+        slots.release()
+
+    # 恢复的会话不再校验证书，按序列号再查一次吊销索引
+    if peer_revoked(revocation, tls_conn.getpeercert()):
+        print(f"[!] Revoked client certificate from {addr}")
+        try:
+            tls_conn.sendall(b"Certificate revoked.\n")
+        except OSError:
+            pass
+        tls_conn.close()
+        return
+
+    handle_client(tls_conn, addr)
+
+
+def serve_threaded(host=HOST, port=PORT, session_tickets=SESSION_TICKETS,
+                   backlog=LISTEN_BACKLOG, max_handshakes=MAX_HANDSHAKES):
+    global tls_context, revocation, stapler
+    context = tls_context = create_server_context(session_tickets=session_tickets)
+    revocation = create_revocation_index(context)
+    stapler = create_stapler()
+    slots = threading.BoundedSemaphore(max_handshakes)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind((HOST, PORT))
-    sock.listen(5)
-    print(f"[*] Chat TLS server listening on {HOST}:{PORT} ...")
+    sock.bind((host, port))
+    sock.listen(backlog)
+    print(f"[*] Chat TLS server (threads) listening on {host}:{port} ...")
 
     try:
         while True:
             client_sock, addr = sock.accept()
-            # 升级为 TLS
-            try:
-                tls_conn = context.wrap_socket(client_sock, server_side=True)
-            except ssl.SSLError as e:
-                print(f"[!] TLS handshake failed from {addr}: {e}")
-                client_sock.close()
-                continue
-
-            t = threading.Thread(target=handle_client, args=(tls_conn, addr), daemon=True)
+            # 握手交给客户端线程，accept 循环立即回去接受下一个连接
+            t = threading.Thread(target=handshake_client, args=(context, slots, client_sock, addr), daemon=True)
             t.start()
     finally:
         sock.close()
 
 
+# ---------------- asyncio 模式：单线程事件循环 ----------------
+
+# 在线用户：username -> 发送队列，只在事件循环线程中访问，不需要锁
+async_fanout = AsyncFanout(CLIENT_QUEUE_SIZE, SLOW_CONSUMER_POLICY)
+
+
+def async_broadcast(sender, msg: str):
+    """给所有在线用户广播消息（只入队，不等待发送）"""
+    async_fanout.publish(format_message(sender, msg))
+
+
+async def async_login(reader, writer, decoder):
+    """等待第一帧 LOGIN:<username>，返回 (用户名或 None, 已经收到的全部帧)"""
+    writer.write(greeting())
+    await writer.drain()
+    frames = []
+    while not frames:
+        data = await asyncio.wait_for(reader.read(READ_SIZE), LOGIN_TIMEOUT)
+        if not data:
+            return None, []
+        frames = decoder.feed(data)
+
+    username, error = parse_login(frames[0], async_fanout)
+    if error:
+        writer.write(error)
+    return username, frames
+
+
+async def async_handshake(conn, context, slots):
+    """在握手名额内把已接受的明文 socket 升级为 TLS 流，排队和握手各自最多等待 HANDSHAKE_TIMEOUT 秒
+
+    不用 StreamWriter.start_tls：客户端的 ClientHello 可能在升级之前就被 StreamReader 读走，握手会卡住。
+    """
+    await asyncio.wait_for(slots.acquire(), HANDSHAKE_TIMEOUT)
+    try:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.connect_accepted_socket(
+            lambda: protocol, conn, ssl=context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+        return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+    finally:
+        slots.release()
+
+
+async def accept_async_client(conn, addr, context, slots):
+    try:
+        reader, writer = await async_handshake(conn, context, slots)
+    except (asyncio.TimeoutError, ConnectionError, ssl.SSLError, OSError) as e:
+        print(f"[!] TLS handshake failed from {addr}: {e!r}")
+        conn.close()
+        return
+    if peer_revoked(revocation, writer.get_extra_info("peercert")):
+        print(f"[!] Revoked client certificate from {addr}")
+        writer.write(b"Certificate revoked.\n")
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+        return
+    await handle_async_client(reader, writer)
+
+
+async def handle_async_client(reader, writer):
+    addr = writer.get_extra_info("peername")
+    print(f"[+] TLS connection from {addr}")
+    client = None
+    decoder = LineDecoder()
+
+    try:
+        username, frames = await async_login(reader, writer, decoder)
+        if not username:
+            await writer.drain()
+            return
+        # 多进程模式：用户名还要在所有 worker 范围内唯一
+        if bus is not None and not await bus.claim(username):
+            writer.write(b"Username already in use.\n")
+            await writer.drain()
+            return
+
+        client = async_fanout.register(username, writer)
+        async_fanout.send(client, f"Welcome, {username}! You can start chatting.\n".encode("utf-8"))
+        async_broadcast("SYSTEM", f"{username} joined the chat.")
+
+        # 和 LOGIN 一起到达的消息
+        if not handle_frames(async_fanout, client, frames[1:]):
+            return
+
+        # 循环收消息，一次读取可能包含多条消息
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            if not handle_frames(async_fanout, client, decoder.feed(data)):
+                break
+
+    except FrameTooLarge as e:
+        print(f"[!] Protocol error with client {addr}: {e}")
+    except asyncio.TimeoutError:
+        print(f"[!] Login timeout from {addr}")
+    except (ConnectionError, ssl.SSLError) as e:
+        print(f"[!] Error with client {addr}: {e}")
+    finally:
+        if client is not None:
+            if async_fanout.unregister(client):
+                async_broadcast("SYSTEM", f"{client.name} left the chat.")
+                if bus is not None:
+                    bus.release(client.name)
+            await async_fanout.close(client)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+        print(f"[-] Connection from {addr} closed.")
+
+
+async def serve_asyncio(host=HOST, port=PORT, stats_interval=0, session_tickets=SESSION_TICKETS,
+                        backlog=LISTEN_BACKLOG, max_handshakes=MAX_HANDSHAKES,
+                        context=None, bus_path=None):
+    """单进程 asyncio 服务器；传入 bus_path 时作为多进程模式的一个 worker 运行"""
+    global tls_context, bus, revocation, stapler
+    if context is None:
+        context = create_server_context(session_tickets=session_tickets)
+    tls_context = context
+    # 多进程模式下每个 worker 各自加载（后台线程不会跟着 fork 过来）
+    revocation = create_revocation_index(context)
+    stapler = create_stapler()
+    if bus_path is not None:
+        bus = BroadcastBus(bus_path, async_fanout.publish_local)
+        await bus.connect()
+        async_fanout.relay = bus.publish
+    if stats_interval > 0:
+        asyncio.ensure_future(log_stats_forever(async_fanout, stats_interval))
+
+    slots = asyncio.Semaphore(max_handshakes)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if bus is not None:
+        # 多个 worker 各自监听同一个端口，由内核分配连接
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    if bus is None:
+        print(f"[*] Chat TLS server (asyncio) listening on {host}:{port} ...")
+    else:
+        print(f"[*] Chat TLS worker {worker_id} (pid {os.getpid()}) listening on {host}:{port} ...")
+
+    try:
+        if bus is None:
+            await accept_forever(sock, context, slots)
+        else:
+            # 中继断开后无法保证用户名唯一，worker 随之退出
+            await asyncio.gather(accept_forever(sock, context, slots), bus.wait_closed())
+    finally:
+        sock.close()
+
+
+async def accept_forever(sock, context, slots):
+    """自己的 accept 循环：先接受明文连接，握手在各自的任务里进行，受握手名额限制"""
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    while True:
+        conn, addr = await loop.sock_accept(sock)
+        task = asyncio.ensure_future(accept_async_client(conn, addr, context, slots))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+# ---------------- 多进程模式：N 个 asyncio worker + 主进程中继 ----------------
+
+def run_worker(index, context, bus_path, args):
+    global worker_id
+    worker_id = index
+    try:
+        asyncio.run(serve_asyncio(args.host, args.port, args.stats_interval, args.session_tickets,
+                                  args.backlog, args.max_handshakes, context, bus_path))
+    except ConnectionError as e:
+        print(f"[!] Worker {index} exiting: {e}")
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_workers(args):
+    """fork 出 args.workers 个 worker，主进程运行广播中继
+
+    TLS 上下文在 fork 之前创建，所有 worker 共用同一组 session ticket 密钥，
+    客户端重连被分到另一个 worker 时仍然可以恢复会话。
+    """
+    context = create_server_context(session_tickets=args.session_tickets)
+    bus_path = args.bus_path or f"/tmp/chat_server_{os.getpid()}.sock"
+    broker = Broker(bus_path)
+    broker.listen()
+
+    fork = multiprocessing.get_context("fork")
+    workers = [fork.Process(target=run_worker, args=(i, context, bus_path, args), daemon=True)
+               for i in range(args.workers)]
+    for p in workers:
+        p.start()
+    # kill 主进程时也要先停掉 worker
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"[*] Chat TLS server: {args.workers} workers on {args.host}:{args.port}, relay at {bus_path}")
+
+    async def run_broker():
+        if args.stats_interval > 0:
+            asyncio.ensure_future(log_stats_forever(broker, args.stats_interval, "relay"))
+        await broker.serve_forever()
+
+    try:
+        asyncio.run(run_broker())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in workers:
+            p.terminate()
+        for p in workers:
+            p.join()
+        broker.close()
+
+
+async def log_stats_forever(fanout, interval, label="fanout"):
+    if worker_id is not None:
+        label = f"worker {worker_id} {label}"
+    while True:
+        await asyncio.sleep(interval)
+        print(f"[*] {label} {json.dumps(fanout.stats())}")
+
+
+def log_stats_thread(fanout, interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            print(f"[*] fanout {json.dumps(fanout.stats())}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS 双向认证聊天服务器")
+    parser.add_argument("--mode", choices=("asyncio", "threads"), default="asyncio",
+                        help="asyncio：单线程事件循环（默认）；threads：每个客户端一个线程")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--queue-size", type=int, default=CLIENT_QUEUE_SIZE,
+                        help="每个客户端最多积压的待发送消息数")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="发送队列满时：disconnect 断开该客户端，drop 丢弃发给它的消息")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="每隔多少秒打印一次扇出统计，0 表示不打印")
+    parser.add_argument("--session-tickets", type=int, default=SESSION_TICKETS,
+                        help="每次完整握手后发放的 TLS 1.3 session ticket 数，0 表示关闭会话恢复")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG,
+                        help="listen() 积压队列长度（受内核 net.core.somaxconn 限制）")
+    parser.add_argument("--max-handshakes", type=int, default=MAX_HANDSHAKES,
+                        help="同时进行的 TLS 握手数上限")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker 进程数（asyncio 模式），大于 1 时通过 SO_REUSEPORT 共用端口")
+    parser.add_argument("--bus-path", default=None,
+                        help="多进程模式下广播中继的 Unix socket 路径")
+    args = parser.parse_args()
+    if args.workers > 1 and args.mode != "asyncio":
+        parser.error("--workers 只支持 asyncio 模式")
+
+    for fanout in (thread_fanout, async_fanout):
+        fanout.queue_size = args.queue_size
+        fanout.policy = args.slow_consumer
+
+    if args.workers > 1:
+        serve_workers(args)
+    elif args.mode == "threads":
+        if args.stats_interval > 0:
+            log_stats_thread(thread_fanout, args.stats_interval)
+        serve_threaded(args.host, args.port, args.session_tickets, args.backlog, args.max_handshakes)
+    else:
+        try:
+            asyncio.run(serve_asyncio(args.host, args.port, args.stats_interval, args.session_tickets,
+                                      args.backlog, args.max_handshakes))
+        except KeyboardInterrupt:
+            pass
+
+
 if __name__ == "__main__":
     main()
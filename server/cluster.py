@@ -0,0 +1,168 @@
+# server/cluster.py
+"""多进程模式：N 个 worker 进程通过 SO_REUSEPORT 共用同一个端口，主进程做广播中继
+
+每个 worker 是一个完整的 asyncio 聊天服务器，只管理连到自己的客户端；内核把新连接
+分散到各个 worker，TLS 加解密因此可以用上多个核。worker 之间通过主进程上的
+Unix socket 中继（Broker）交换两类信息：
+    广播    worker 先投递给本地客户端，再交给中继转发给其他 worker
+    用户名  登录时向中继申请（全局唯一），断开时释放；worker 掉线时中继释放它的全部用户名
+
+中继连接上的帧：1 字节类型 + 4 字节长度（网络字节序）+ 内容
+    worker -> 中继   C 申请用户名   R 释放用户名   P 广播
+    中继 -> worker   Y/N 申请结果（按请求顺序应答）   P 其他 worker 的广播
+"""
+import asyncio
+import collections
+import os
+import socket
+import struct
+
+_HEADER = struct.Struct("!cI")
+
+CLAIM = b"C"
+RELEASE = b"R"
+PUBLISH = b"P"
+GRANTED = b"Y"
+DENIED = b"N"
+
+
+def _frame(kind, payload=b""):
+    return _HEADER.pack(kind, len(payload)) + payload
+
+
+async def _read_frame(reader):
+    """读一帧，连接关闭时返回 (None, None)"""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        kind, length = _HEADER.unpack(header)
+        payload = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError:
+        return None, None
+    return kind, payload
+
+
+class Broker:
+    """主进程上的中继：全局在线用户名表 + 广播转发"""
+
+    def __init__(self, path):
+        self.path = path
+        self.owners = {}    # username -> 持有它的 worker 连接
+        self.workers = set()
+        self._totals = {'relayed': 0, 'claims': 0, 'denied': 0}
+
+    def listen(self):
+        """在 fork 出 worker 之前创建监听 socket，worker 启动后可以立即连上来"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen()
+
+    async def serve_forever(self):
+        server = await asyncio.start_unix_server(self._handle_worker, sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle_worker(self, reader, writer):
+        self.workers.add(writer)
+        try:
+            while True:
+                kind, payload = await _read_frame(reader)
+                if kind is None:
+                    break
+                if kind == PUBLISH:
+                    self._totals['relayed'] += 1
+                    data = _frame(PUBLISH, payload)
+                    for other in self.workers:
+                        if other is not writer:
+                            other.write(data)
+                elif kind == CLAIM:
+                    name = payload.decode("utf-8")
+                    self._totals['claims'] += 1
+                    if name in self.owners:
+                        self._totals['denied'] += 1
+                        writer.write(_frame(DENIED))
+                    else:
+                        self.owners[name] = writer
+                        writer.write(_frame(GRANTED))
+                elif kind == RELEASE:
+                    name = payload.decode("utf-8")
+                    if self.owners.get(name) is writer:
+                        del self.owners[name]
+        except ConnectionError:
+            pass
+        finally:
+            # worker 退出：它的客户端都已断开，释放它持有的用户名
+            self.workers.discard(writer)
+            for name in [n for n, w in self.owners.items() if w is writer]:
+                del self.owners[name]
+            writer.close()
+
+    def stats(self):
+        data = dict(self._totals)
+        data['workers'] = len(self.workers)
+        data['online'] = len(self.owners)
+        return data
+
+
+class BroadcastBus:
+    """worker 端的中继连接
+
+    publish() 和 release() 只写入发送缓冲，不等待；claim() 等待中继应答。
+    收到其他 worker 的广播时调用 on_publish(data)。
+    """
+
+    def __init__(self, path, on_publish):
+        self.path = path
+        self.on_publish = on_publish
+        self._pending = collections.deque()
+        self._writer = None
+        self._task = None
+
+    async def connect(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._task = asyncio.ensure_future(self._read_loop(reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                kind, payload = await _read_frame(reader)
+                if kind is None:
+                    break
+                if kind == PUBLISH:
+                    self.on_publish(payload)
+                elif kind in (GRANTED, DENIED):
+                    name, future = self._pending.popleft()
+                    if not future.done():
+                        future.set_result(kind == GRANTED)
+                    elif kind == GRANTED:
+                        # 申请方已经放弃（连接断开），把用户名还回去
+                        self.release(name)
+        finally:
+            while self._pending:
+                _, future = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError("broker connection lost"))
+        raise ConnectionError("broker connection lost")
+
+    async def wait_closed(self):
+        """中继断开时抛出 ConnectionError：worker 无法再保证用户名唯一，应当退出"""
+        await self._task
+
+    async def claim(self, name):
+        """向中继申请用户名，返回是否成功（全局唯一）"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((name, future))
+        self._writer.write(_frame(CLAIM, name.encode("utf-8")))
+        return await future
+
+    def release(self, name):
+        self._writer.write(_frame(RELEASE, name.encode("utf-8")))
+
+    def publish(self, data: bytes):
+        self._writer.write(_frame(PUBLISH, data))
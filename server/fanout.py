@@ -0,0 +1,372 @@
+# server/fanout.py
+"""广播扇出：每条消息只编码一次，同一个 bytes 对象放进每个客户端的有界发送队列
+
+发送由每个客户端自己的写线程/写协程完成，广播本身从不阻塞在某个客户端的 socket 上，
+广播耗时与客户端各自的发送耗时无关。队列满（客户端读得太慢）时按策略处理：
+    disconnect  断开该客户端（默认），避免它无限积压
+    drop        丢弃发给它的这条消息，连接保留
+"""
+import abc
+import asyncio
+import queue
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+SLOW_CONSUMER_POLICIES = ('disconnect', 'drop')
+
+# 写线程/写协程每次最多合并多少条已排队的消息一起发送
+WRITE_BATCH = 64
+# 客户端断开时最多等多少秒把它队列里剩下的消息（如 /quit 之前的回复）发完
+DRAIN_TIMEOUT = 2.0
+
+
+class FanoutClient(abc.ABC):
+    """一个订阅者的发送队列和统计"""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.max_backlog = 0
+        self.evicted = False
+        self.closed = False
+        self.connected_at = time.time()
+
+    @abc.abstractmethod
+    def backlog(self):
+        """队列中等待发送的消息数"""
+
+    def stats(self):
+        return {
+            'backlog': self.backlog(),
+            'max_backlog': self.max_backlog,
+            'sent': self.sent,
+            'bytes_sent': self.bytes_sent,
+            'dropped': self.dropped,
+            'evicted': self.evicted,
+        }
+
+
+class _Fanout(abc.ABC):
+    """线程版和 asyncio 版共用的订阅表、溢出处理和统计"""
+
+    def __init__(self, queue_size=256, policy='disconnect'):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"unknown slow consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self._clients = {}
+        self._totals = {'published': 0, 'deliveries': 0, 'dropped': 0, 'evicted': 0}
+
+    def __contains__(self, name):
+        return name in self._clients
+
+    def names(self):
+        return list(self._clients)
+
+    @abc.abstractmethod
+    def _deliver(self, client, data):
+        """把 data 放进 client 的队列，返回是否成功"""
+
+    @abc.abstractmethod
+    def _evict(self, client):
+        """断开积压过多的客户端"""
+
+    def _offer(self, client, data):
+        if client.closed:
+            return
+        if self._deliver(client, data):
+            self._totals['deliveries'] += 1
+            backlog = client.backlog()
+            if backlog > client.max_backlog:
+                client.max_backlog = backlog
+            return
+        self._totals['dropped'] += 1
+        client.dropped += 1
+        if self.policy == 'disconnect' and not client.evicted:
+            client.evicted = True
+            self._totals['evicted'] += 1
+            print(f"[!] {client.name} is too slow (backlog {client.backlog()}), disconnecting")
+            self._evict(client)
+
+    def stats(self, per_client=False):
+        """总体统计；per_client=True 时附带每个客户端的积压情况"""
+        clients = list(self._clients.values())
+        data = dict(self._totals)
+        data['clients'] = len(clients)
+        data['backlog'] = sum(client.backlog() for client in clients)
+        data['max_backlog'] = max((client.max_backlog for client in clients), default=0)
+        if per_client:
+            data['per_client'] = {client.name: client.stats() for client in clients}
+        return data
+
+
+# ---------------- 线程模式 ----------------
+
+class ThreadedClient(FanoutClient):
+    """线程模式的订阅者：读线程（handle_client）和写线程共用一个 TLS 连接
+
+    OpenSSL 不允许两个线程同时读写同一个 SSL 对象，所以连接改为非阻塞，
+    每次 recv/send 都在 io_lock 内完成；等待可读/可写时不持有锁，读写互不阻塞。
+    """
+
+    def __init__(self, name, conn, maxsize):
+        super().__init__(name, maxsize)
+        self.conn = conn
+        self.queue = queue.Queue(maxsize)
+        self.io_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def _wait(self, event, timeout=1.0):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.conn, event)
+            selector.select(timeout)
+
+    def recv(self, bufsize):
+        """读取数据，连接关闭时返回 b''"""
+        # 自己的发送队列里有数据时先让出 GIL，否则读线程连续抢到 io_lock，写线程会饿死
+        if not self.queue.empty():
+            time.sleep(0)
+        while True:
+            with self.io_lock:
+                try:
+                    return self.conn.recv(bufsize)
+                except ssl.SSLWantReadError:
+                    event = selectors.EVENT_READ
+                except ssl.SSLWantWriteError:
+                    event = selectors.EVENT_WRITE
+            self._wait(event)
+
+    def _sendall(self, data):
+        view = memoryview(data)
+        while view:
+            with self.io_lock:
+                try:
+                    view = view[self.conn.send(view):]
+                    continue
+                except ssl.SSLWantWriteError:
+                    event = selectors.EVENT_WRITE
+                except ssl.SSLWantReadError:
+                    event = selectors.EVENT_READ
+            if self.closed:
+                raise ConnectionError("client closed")
+            self._wait(event)
+
+    def _write_loop(self):
+        try:
+            while not self.closed:
+                batch = [self.queue.get()]
+                # 把已经排队的消息合并成一次发送，减少加锁和系统调用次数
+                while len(batch) < WRITE_BATCH and batch[-1] is not None:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is None
+                if stop:
+                    batch.pop()
+                if batch:
+                    data = b"".join(batch)
+                    self._sendall(data)
+                    self.sent += len(batch)
+                    self.bytes_sent += len(data)
+                if stop:
+                    break
+        except OSError as e:
+            if not self.closed:
+                print(f"[!] Send to {self.name} failed: {e}")
+            _shutdown(self.conn)
+
+
+def _shutdown(conn):
+    """关闭底层 TCP 连接，让读线程的 recv 立即返回
+
+    不调用 SSLSocket.shutdown：它会丢弃 SSL 对象，另一个线程随后的 recv 会读到未解密的原始数据。
+    """
+    try:
+        socket.socket.shutdown(conn, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class ThreadedFanout(_Fanout):
+    """线程模式的扇出：每个客户端一个写线程，锁只保护订阅表，不包住任何发送"""
+
+    def __init__(self, queue_size=256, policy='disconnect'):
+        super().__init__(queue_size, policy)
+        self._lock = threading.Lock()
+
+    def register(self, name, conn):
+        """登记订阅者，用户名已被占用时返回 None
+
+        登记后连接变为非阻塞，读线程必须改用 client.recv()。
+        """
+        with self._lock:
+            if name in self._clients:
+                return None
+            client = ThreadedClient(name, conn, self.queue_size)
+            self._clients[name] = client
+        conn.setblocking(False)
+        client.thread.start()
+        return client
+
+    def unregister(self, client):
+        """注销订阅者（不再收到广播），返回是否确实移除了；之后调用 close() 停止写线程"""
+        with self._lock:
+            removed = self._clients.get(client.name) is client
+            if removed:
+                del self._clients[client.name]
+        return removed
+
+    def close(self, client, timeout=DRAIN_TIMEOUT):
+        """让写线程把队列里剩下的消息发完后退出，最多等 timeout 秒；之后才能关闭连接"""
+        if not client.closed:
+            deadline = time.monotonic() + timeout
+            try:
+                client.queue.put(None, timeout=timeout)
+                client.thread.join(max(0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        # 超时仍未发完时写线程在下一次等待可写后退出
+        client.closed = True
+
+    def send(self, client, data: bytes):
+        with self._lock:
+            self._offer(client, data)
+
+    def publish(self, data: bytes):
+        """把同一个 bytes 对象放进所有订阅者的队列"""
+        with self._lock:
+            self._totals['published'] += 1
+            for client in self._clients.values():
+                self._offer(client, data)
+
+    def _deliver(self, client, data):
+        try:
+            client.queue.put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    def _evict(self, client):
+        client.closed = True
+        _shutdown(client.conn)
+
+    def stats(self, per_client=False):
+        with self._lock:
+            return super().stats(per_client)
+
+
+# ---------------- asyncio 模式 ----------------
+
+class AsyncClient(FanoutClient):
+    def __init__(self, name, writer, maxsize):
+        super().__init__(name, maxsize)
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize)
+        self.task = None
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    async def write_loop(self):
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                # 已经排队的消息一起写入传输缓冲（每批最多 WRITE_BATCH 条），再统一等待发送
+                while len(batch) < WRITE_BATCH and batch[-1] is not None and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                # None 由 close() 放入：之前的消息发完后退出
+                stop = batch[-1] is None
+                if stop:
+                    batch.pop()
+                for data in batch:
+                    self.writer.write(data)
+                    self.bytes_sent += len(data)
+                self.sent += len(batch)
+                await self.writer.drain()
+                if stop:
+                    return
+        except (ConnectionError, OSError) as e:
+            if not self.closed:
+                print(f"[!] Send to {self.name} failed: {e}")
+            self.writer.transport.abort()
+
+
+class AsyncFanout(_Fanout):
+    """asyncio 模式的扇出：只在事件循环线程中调用，不需要锁
+
+    relay 不为 None 时（多进程模式），publish() 在本地投递后把消息交给它转发给其他进程；
+    其他进程转来的消息用 publish_local() 投递，不再转发。
+    """
+
+    def __init__(self, queue_size=256, policy='disconnect'):
+        super().__init__(queue_size, policy)
+        self.relay = None
+
+    def register(self, name, writer):
+        """登记订阅者并启动它的写协程，用户名已被占用时返回 None"""
+        if name in self._clients:
+            return None
+        client = AsyncClient(name, writer, self.queue_size)
+        self._clients[name] = client
+        client.task = asyncio.ensure_future(client.write_loop())
+        return client
+
+    def unregister(self, client):
+        """注销订阅者（不再收到广播），返回是否确实移除了；之后调用 close() 停止写协程"""
+        removed = self._clients.get(client.name) is client
+        if removed:
+            del self._clients[client.name]
+        return removed
+
+    async def close(self, client, timeout=DRAIN_TIMEOUT):
+        """让写协程把队列里剩下的消息发完后退出，最多等 timeout 秒，超时则取消"""
+        task = client.task
+        if task is not None and not task.done() and not client.closed:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            try:
+                await asyncio.wait_for(client.queue.put(None), timeout)
+                # asyncio.wait 不会把本协程的取消传给写协程，也不抛出它的异常
+                await asyncio.wait({task}, timeout=max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+        client.closed = True
+        if task is not None:
+            task.cancel()
+
+    def send(self, client, data: bytes):
+        self._offer(client, data)
+
+    def publish(self, data: bytes):
+        self.publish_local(data)
+        if self.relay is not None:
+            self.relay(data)
+
+    def publish_local(self, data: bytes):
+        self._totals['published'] += 1
+        for client in self._clients.values():
+            self._offer(client, data)
+
+    def _deliver(self, client, data):
+        try:
+            client.queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def _evict(self, client):
+        client.closed = True
+        if client.task is not None:
+            client.task.cancel()
+        # 慢客户端的发送缓冲里可能还积压着数据，直接中止连接而不是等它读完
+        client.writer.transport.abort()
@@ -0,0 +1,62 @@
+# server/protocol.py
+"""聊天协议的分帧：每条消息是一行 UTF-8 文本，以 \\n 结尾（容忍 \\r\\n）
+
+TCP/TLS 不保留消息边界：一次 recv 可能只有半条消息，也可能有很多条。
+LineDecoder 把收到的字节追加到缓冲区，每次返回其中所有完整的行，
+剩下的半行留到下一次；单行超过 max_frame 时抛出 FrameTooLarge。
+客户端因此可以在一个 TLS 记录里连续发送成百上千条消息。
+"""
+
+# 客户端发往服务器的单行最大字节数（不含换行符）
+MAX_FRAME = 4096
+# 服务器转发时会加上 "[用户名] " 前缀，客户端接收时放宽一些
+MAX_INCOMING_FRAME = MAX_FRAME * 2 + 16
+# 每次从连接读取的字节数
+READ_SIZE = 64 * 1024
+
+
+class FrameTooLarge(ValueError):
+    """一行超过了允许的最大长度"""
+
+
+class LineDecoder:
+    """增量的按行分帧解码器"""
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.max_frame = max_frame
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes):
+        """追加收到的数据，返回其中所有完整的帧（bytes，不含行尾）"""
+        if b"\n" not in data:
+            self._buffer += data
+            if len(self._buffer) > self.max_frame:
+                raise FrameTooLarge(f"frame exceeds {self.max_frame} bytes")
+            return []
+
+        self._buffer += data
+        *frames, rest = self._buffer.split(b"\n")
+        self._buffer = bytearray(rest)
+        if len(rest) > self.max_frame:
+            raise FrameTooLarge(f"frame exceeds {self.max_frame} bytes")
+
+        result = []
+        for frame in frames:
+            if frame.endswith(b"\r"):
+                frame = frame[:-1]
+            if len(frame) > self.max_frame:
+                raise FrameTooLarge(f"frame exceeds {self.max_frame} bytes")
+            result.append(bytes(frame))
+        return result
+
+    def pending(self):
+        """缓冲区中尚未组成完整一行的字节数"""
+        return len(self._buffer)
+
+
+def encode_line(text: str) -> bytes:
+    return (text + "\n").encode("utf-8")
+
+
+def decode_line(frame: bytes) -> str:
+    return frame.decode("utf-8", errors="replace").strip()
@@ -1,45 +1,81 @@
+import argparse
 import ssl
 import socket
+import threading
+
+from tls import create_revocation_index, create_server_context, peer_revoked
 
 HOST = "0.0.0.0"
 PORT = 4433
+# 握手超时（秒）、同时握手数上限和 listen() 积压队列长度，含义同 chat_server.py
+HANDSHAKE_TIMEOUT = 10
+MAX_HANDSHAKES = 64
+LISTEN_BACKLOG = 1024
 
-def main():
-    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
 
-    context.load_cert_chain(
-        "server/server_fullchain.crt",
-        "server/server.key"
-    )
+def handle_client(context, slots, revocation, client_socket, addr):
+    """每个客户端一个线程：先握手（限时、限并发），再回显收到的数据"""
+    print(f"[+] Connection from {addr}")
+    if not slots.acquire(timeout=HANDSHAKE_TIMEOUT):
+        print(f"[!] Too many TLS handshakes in progress, dropping {addr}")
+        client_socket.close()
+        return
+
+    try:
+        client_socket.settimeout(HANDSHAKE_TIMEOUT)
+        tls_conn = context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+        tls_conn.do_handshake()
+    except (ssl.SSLError, OSError) as e:
+        print("[!] TLS Error:", e)
+        client_socket.close()
+        return
+    finally:
+        slots.release()
+
+    try:
+        # 恢复的会话跳过了证书校验，按序列号查一次吊销索引
+        if peer_revoked(revocation, tls_conn.getpeercert()):
+            print(f"[!] Revoked client certificate from {addr}")
+            return
+        tls_conn.settimeout(None)
+        resumed = " (session resumed)" if tls_conn.session_reused else ""
+        print(f"[✓] TLS Handshake OK{resumed} with:", tls_conn.getpeercert())
+
+        while True:
+            data = tls_conn.recv(1024)
+            if not data:
+                break
+            print("Received:", data.decode())
+            tls_conn.sendall(b"Echo: " + data)
 
-    context.load_verify_locations("ca/certs/root.crt")
+    except (ssl.SSLError, OSError) as e:
+        print("[!] TLS Error:", e)
+    finally:
+        tls_conn.close()
 
-    context.verify_mode = ssl.CERT_REQUIRED
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS 双向认证回显服务器")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG)
+    parser.add_argument("--max-handshakes", type=int, default=MAX_HANDSHAKES)
+    args = parser.parse_args()
+
+    # 双向认证，并发放 session ticket 供客户端重连时恢复会话
+    context = create_server_context()
+    revocation = create_revocation_index(context)
+    slots = threading.BoundedSemaphore(args.max_handshakes)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind((HOST, PORT))
-    sock.listen(5)
-    print(f"[*] TLS Server running on port {PORT} ...")
+    sock.bind((HOST, args.port))
+    sock.listen(args.backlog)
+    print(f"[*] TLS Server running on port {args.port} ...")
 
     while True:
         client_socket, addr = sock.accept()
-        print(f"[+] Connection from {addr}")
-
-        try:
-            tls_conn = context.wrap_socket(client_socket, server_side=True)
-            print("[✓] TLS Handshake OK with:", tls_conn.getpeercert())
-
-            while True:
-                data = tls_conn.recv(1024)
-                if not data:
-                    break
-                print("Received:", data.decode())
-                tls_conn.sendall(b"Echo: " + data)
-
-        except ssl.SSLError as e:
-            print("[!] TLS Error:", e)
-        finally:
-            client_socket.close()
+        # 握手和收发都在客户端线程中进行，accept 循环不会被某个客户端卡住
+        threading.Thread(target=handle_client, args=(context, slots, revocation, client_socket, addr), daemon=True).start()
+
 
 if __name__ == "__main__":
     main()
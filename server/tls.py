@@ -0,0 +1,158 @@
+# server/tls.py
+"""TLS 上下文：服务器端双向认证 + 会话恢复，客户端复用会话
+
+完整握手要做 ECDHE 密钥交换、签名，以及双方证书链校验；断线重连时用上次握手得到的
+会话（TLS 1.3 的 session ticket，TLS 1.2 的 ticket 或服务器会话缓存）可以跳过证书
+交换和校验。恢复的会话仍然带着当初校验过的客户端证书，getpeercert() 照常可用。
+
+签发 CA 发布了 CRL（python pki/crl.py publish）时，服务器上下文还按 CRL 检查客户端证书是否
+已吊销（VERIFY_CRL_CHECK_LEAF，完整 CRL + 增量 CRL），见 CrlVerifier。恢复的会话跳过了证书
+校验，所以握手后还要用 RevocationIndex 按序列号再查一次（create_revocation_index）。
+
+ssl 模块没有 OCSP stapling 的接口，create_stapler 在后台为服务器证书预取 OCSP 响应
+（pki/ocsp.py），由服务器在握手后的第一次发送中交给客户端。
+"""
+import os
+import ssl
+import sys
+
+SERVER_CERT = "server/server_fullchain.crt"
+SERVER_KEY = "server/server.key"
+CA_ROOT = "ca/certs/root.crt"
+
+# 每次完整握手后服务器发给客户端的 TLS 1.3 session ticket 数量（每个 ticket 可用于一次重连）
+SESSION_TICKETS = 2
+
+# 签发 CA 的完整 CRL 和增量 CRL（pki/crl.py 发布），不存在的文件跳过
+CRL_PATHS = ("ca/issuing/crl/issuing.crl.pem", "ca/issuing/crl/issuing-delta.crl.pem")
+# ssl 模块没有导出的 OpenSSL 校验标志：X509_V_FLAG_USE_DELTAS 同时使用增量 CRL；
+# X509_V_FLAG_EXTENDED_CRL_SUPPORT —— 不设置时 OpenSSL 会把（lastUpdate 更新的）增量 CRL
+# 当成完整 CRL 用，完整 CRL 里的吊销记录就被漏掉了
+VERIFY_USE_DELTAS = 0x2000
+VERIFY_EXTENDED_CRL_SUPPORT = 0x1000
+CRL_VERIFY_FLAGS = ssl.VERIFY_CRL_CHECK_LEAF | VERIFY_USE_DELTAS | VERIFY_EXTENDED_CRL_SUPPORT
+
+# pki/ 在仓库根目录：吊销索引和 OCSP 预取需要 cryptography，用到时才导入
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
+
+def create_server_context(certfile=SERVER_CERT, keyfile=SERVER_KEY, cafile=CA_ROOT,
+                          session_tickets=SESSION_TICKETS, crl_paths=CRL_PATHS):
+    """TLS 服务器上下文：要求客户端证书，并开启会话恢复
+
+    session_tickets=0 时不发 ticket，TLS 1.3 客户端只能完整握手（用于压测对照）。
+    TLS 1.2 的会话缓存由 OpenSSL 在上下文内维护，命中情况见 context.session_stats()。
+    crl_paths 中有 CRL 文件时按 CRL 检查客户端证书，CrlVerifier 保存在 context.crl_verifier。
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+
+    # 验证客户端证书（双向认证）
+    context.load_verify_locations(cafile)
+    context.verify_mode = ssl.CERT_REQUIRED
+
+    context.num_tickets = session_tickets
+    if session_tickets == 0:
+        context.options |= ssl.OP_NO_TICKET
+    if crl_paths:
+        context.crl_verifier = CrlVerifier(
+            context, lambda: create_server_context(certfile, keyfile, cafile, session_tickets, crl_paths=()),
+            crl_paths)
+    return context
+
+
+class CrlVerifier:
+    """握手时按 CRL 检查客户端证书；reload() 换用只装着当前 CRL 文件的证书库
+
+    OpenSSL 的证书库只能添加不能删除：把新发布的 CRL 加进原来的上下文，旧的增量 CRL 还在，
+    而 OpenSSL 用找到的第一份基准匹配的增量 CRL，新吊销的证书可能漏掉。所以每次 reload()
+    都新建一个校验用的上下文（同样的证书和 CA，加上当前的 CRL），在 sni_callback 中把连接
+    切换过去（客户端不发 SNI 时回调也会执行）。切换只换证书库；校验标志、session ticket
+    密钥和会话缓存仍属于原来的上下文，重新加载不影响会话恢复，多进程 worker 也继续共用 ticket 密钥。
+    """
+
+    def __init__(self, context, make_context, crl_paths=CRL_PATHS):
+        self.context = context
+        self._make_context = make_context
+        self.crl_paths = crl_paths
+        self._current = None
+        self.loaded = []
+        context.sni_callback = self._select
+        self.reload()
+
+    def _select(self, ssl_object, server_name, context):
+        current = self._current
+        if current is not None:
+            ssl_object.context = current
+
+    def reload(self):
+        """按当前的 CRL 文件重建校验用的证书库，返回加载的文件列表"""
+        paths = [path for path in self.crl_paths if os.path.exists(path)]
+        if not paths:
+            # 先关校验标志再撤掉证书库：没有 CRL 时开着 CRL_CHECK 会拒绝所有客户端
+            self.context.verify_flags &= ~CRL_VERIFY_FLAGS
+            self._current = None
+        else:
+            current = self._make_context()
+            for path in paths:
+                current.load_verify_locations(cafile=path)
+            self._current = current
+            self.context.verify_flags |= CRL_VERIFY_FLAGS
+        self.loaded = paths
+        return paths
+
+
+def create_revocation_index(context=None):
+    """已吊销序列号的索引（pki/crl.py 的 RevocationIndex），后台线程在 CRL 更新后重新加载
+
+    同时让 context 的 CrlVerifier 换用新的 CRL。需要 cryptography；不可用时返回 None，
+    握手时仍按启动时加载的 CRL 检查，只是发布新 CRL 后要重启服务器。
+    """
+    try:
+        from pki.crl import RevocationIndex
+    except ImportError as e:
+        print(f"[!] Revocation index disabled (pip install cryptography): {e}")
+        return None
+    index = RevocationIndex(CRL_PATHS)
+    verifier = getattr(context, "crl_verifier", None)
+    if verifier is not None:
+        # 上下文创建以后 CRL 可能已经更新过
+        verifier.reload()
+        index.add_listener(verifier.reload)
+    return index.start()
+
+
+def create_stapler(certfile=SERVER_CERT):
+    """服务器证书的 OCSP 响应预取器（pki/ocsp.py 的 OcspStapler），不可用时返回 None"""
+    try:
+        from pki.ocsp import OcspStapler
+    except ImportError as e:
+        print(f"[!] OCSP stapling disabled (pip install cryptography): {e}")
+        return None
+    return OcspStapler(certfile).start()
+
+
+def peer_revoked(index, peercert):
+    """握手后的 O(1) 检查：对端证书的序列号是否已被吊销（恢复的会话也适用）"""
+    return index is not None and bool(peercert) and index.is_revoked(peercert["serialNumber"])
+
+
+def create_client_context(certfile, keyfile, cafile=CA_ROOT):
+    """TLS 客户端上下文：校验服务器证书，出示客户端证书"""
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return context
+
+
+def session_summary(context):
+    """服务器端会话缓存统计中和恢复相关的几项"""
+    stats = context.session_stats()
+    return {
+        "accept": stats["accept"],
+        "accept_good": stats["accept_good"],
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "timeouts": stats["timeouts"],
+    }
@@ -0,0 +1,147 @@
+# tests/test_cache.py
+"""web/cache.py：加载期间发生失效时，加载到的旧结果不能写回缓存"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+from cache import KeyedCache, RoomCatalog, RoomHistoryCache
+
+
+class KeyedCacheTest(unittest.TestCase):
+    def test_hit_after_load(self):
+        calls = []
+        cache = KeyedCache(lambda key: calls.append(key) or [key], ttl=0)
+        self.assertEqual(cache.get('alice'), ['alice'])
+        self.assertEqual(cache.get('alice'), ['alice'])
+        self.assertEqual(calls, ['alice'])
+
+    def test_invalidate_during_load_is_not_cached(self):
+        version = [1]
+
+        def loader(key):
+            value = [version[0]]
+            # 加载读到旧值之后、写回之前，另一个请求修改了数据并让缓存失效
+            version[0] += 1
+            cache.invalidate(key)
+            return value
+
+        cache = KeyedCache(loader, ttl=0)
+        self.assertEqual(cache.get('alice'), [1])
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache._loading, {})
+
+    def test_invalidate_other_key_does_not_block_write_back(self):
+        def loader(key):
+            cache.invalidate('bob')
+            return [key]
+
+        cache = KeyedCache(loader, ttl=0)
+        cache.get('alice')
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_clear_during_load_is_not_cached(self):
+        def loader(key):
+            cache.clear()
+            return [key]
+
+        cache = KeyedCache(loader, ttl=0)
+        cache.get('alice')
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_loader_error_releases_loading_state(self):
+        def loader(key):
+            raise RuntimeError('database is locked')
+
+        cache = KeyedCache(loader, ttl=0)
+        with self.assertRaises(RuntimeError):
+            cache.get('alice')
+        self.assertEqual(cache._loading, {})
+
+    def test_overlapping_loads(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def loader(key):
+            if threading.current_thread().name == 'slow':
+                started.set()
+                release.wait(5)
+                return ['old']
+            return ['new']
+
+        cache = KeyedCache(loader, ttl=0)
+        slow = threading.Thread(target=cache.get, args=('alice',), name='slow')
+        slow.start()
+        started.wait(5)
+        cache.invalidate('alice')
+        # 失效之后开始的加载读到的是新值，可以写回
+        self.assertEqual(cache.get('alice'), ['new'])
+        release.set()
+        slow.join(5)
+        # 失效之前开始的慢加载不能覆盖新值
+        self.assertEqual(cache.get('alice'), ['new'])
+        self.assertEqual(cache._loading, {})
+
+
+class RoomCatalogTest(unittest.TestCase):
+    def test_invalidate_during_load_is_not_cached(self):
+        rows = [{'name': 'general', 'created_by': 'system', 'created_at': None, 'room_type': 'public'}]
+        loads = []
+
+        def loader():
+            loads.append(1)
+            if len(loads) == 1:
+                catalog.invalidate()
+            return rows
+
+        catalog = RoomCatalog(loader, ttl=0)
+        self.assertTrue(catalog.exists('general'))
+        self.assertTrue(catalog.exists('general'))
+        self.assertEqual(len(loads), 2)
+        self.assertTrue(catalog.exists('general'))
+        self.assertEqual(len(loads), 2)
+
+
+def room_message(message_id):
+    return {'id': message_id, 'user': 'alice', 'text': str(message_id)}
+
+
+class RoomHistoryCacheTest(unittest.TestCase):
+    def test_load_merges_broadcast_messages(self):
+        cache = RoomHistoryCache(capacity=10)
+        # 已广播、尚未提交的消息
+        cache.append('general', room_message(3))
+        history, has_more = cache.load('general', 5, lambda: [room_message(1), room_message(2)])
+        self.assertEqual([msg['id'] for msg in history], [1, 2, 3])
+        self.assertFalse(has_more)
+        self.assertIsNotNone(cache.get('general', 5))
+
+    def test_discard_during_load_is_not_cached(self):
+        cache = RoomHistoryCache(capacity=10)
+
+        def loader():
+            rows = [room_message(1), room_message(2)]
+            cache.discard('general', 2)
+            return rows
+
+        cache.load('general', 5, loader)
+        self.assertIsNone(cache.get('general', 5))
+        history, _ = cache.load('general', 5, lambda: [room_message(1)])
+        self.assertEqual([msg['id'] for msg in history], [1])
+        self.assertEqual(cache._loading, {})
+
+    def test_invalidate_during_load_is_not_cached(self):
+        cache = RoomHistoryCache(capacity=10)
+
+        def loader():
+            cache.invalidate('general')
+            return [room_message(1)]
+
+        cache.load('general', 5, loader)
+        self.assertIsNone(cache.get('general', 5))
+        self.assertEqual(cache.stats()['rooms'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# tests/test_history_codec.py
+"""web/history_codec.py 的列式编码：encode_history / decode_history 往返不丢信息"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+from history_codec import CompactJSON, decode_history, encode_history
+
+
+def room_message(message_id, user, text, timestamp):
+    return {
+        'id': message_id,
+        'user': user,
+        'text': text,
+        'time': timestamp.split(' ')[-1],
+        'timestamp': timestamp,
+        'room': 'general',
+        'type': 'room',
+    }
+
+
+class HistoryCodecTest(unittest.TestCase):
+    def round_trip(self, messages, **fields):
+        # 经过 Socket.IO 使用的 JSON 模块，和实际发出的帧一样
+        columns = CompactJSON.loads(CompactJSON.dumps(encode_history(messages)))
+        return columns, decode_history(columns, **fields)
+
+    def test_round_trip(self):
+        messages = [
+            room_message(41, 'alice', 'hello', '2026-03-01 23:59:58'),
+            room_message(42, 'bob', '你好', '2026-03-02 00:00:03'),
+            room_message(45, 'alice', '', '2026-03-02 00:00:03'),
+            room_message(46, 'carol', 'a "quoted" line\nnext', '2026-03-02 01:00:00'),
+        ]
+        columns, decoded = self.round_trip(messages, room='general', type='room')
+        self.assertEqual(decoded, messages)
+        self.assertEqual(columns['id'], [41, 1, 3, 1])
+        self.assertEqual(columns['users'], ['alice', 'bob', 'carol'])
+        self.assertEqual(columns['user'], [0, 1, 0, 2])
+        self.assertEqual(columns['ts'], [0, 5, 0, 3597])
+
+    def test_unparseable_timestamps_are_kept_verbatim(self):
+        messages = [
+            room_message(1, 'alice', 'a', '2026-03-01 10:00:00'),
+            room_message(2, 'bob', 'b', '未知时间'),
+        ]
+        columns, decoded = self.round_trip(messages, room='general', type='room')
+        self.assertNotIn('ts', columns)
+        self.assertEqual(decoded, messages)
+
+    def test_empty_page(self):
+        columns, decoded = self.round_trip([])
+        self.assertEqual(decoded, [])
+        self.assertIsNone(columns['t0'])
+
+    def test_non_ascii_is_not_escaped(self):
+        text = CompactJSON.dumps(encode_history([room_message(1, '用户', '中文', '2026-03-01 10:00:00')]))
+        self.assertIn('中文', text)
+        self.assertNotIn('\\u', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# tests/test_protocol.py
+"""server/protocol.py 的按行分帧：半行、多行、超长帧"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.protocol import FrameTooLarge, LineDecoder, decode_line, encode_line
+
+
+class LineDecoderTest(unittest.TestCase):
+    def test_partial_frame_is_kept_until_newline(self):
+        decoder = LineDecoder()
+        self.assertEqual(decoder.feed(b"hel"), [])
+        self.assertEqual(decoder.pending(), 3)
+        self.assertEqual(decoder.feed(b"lo\nwor"), [b"hello"])
+        self.assertEqual(decoder.pending(), 3)
+        self.assertEqual(decoder.feed(b"ld\n"), [b"world"])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_many_frames_in_one_chunk(self):
+        decoder = LineDecoder()
+        data = b"".join(encode_line(f"msg {i}") for i in range(1000))
+        frames = decoder.feed(data)
+        self.assertEqual(len(frames), 1000)
+        self.assertEqual(decode_line(frames[-1]), "msg 999")
+
+    def test_crlf_and_empty_lines(self):
+        decoder = LineDecoder()
+        self.assertEqual(decoder.feed(b"a\r\n\nb\r\n"), [b"a", b"", b"b"])
+
+    def test_byte_at_a_time(self):
+        decoder = LineDecoder()
+        frames = []
+        for byte in "你好\nbye\n".encode("utf-8"):
+            frames += decoder.feed(bytes([byte]))
+        self.assertEqual([decode_line(frame) for frame in frames], ["你好", "bye"])
+
+    def test_frame_of_max_size_is_accepted(self):
+        decoder = LineDecoder(max_frame=8)
+        self.assertEqual(decoder.feed(b"x" * 8), [])
+        self.assertEqual(decoder.feed(b"\r\n"), [b"x" * 8])
+
+    def test_oversized_partial_frame(self):
+        decoder = LineDecoder(max_frame=8)
+        decoder.feed(b"x" * 5)
+        with self.assertRaises(FrameTooLarge):
+            decoder.feed(b"x" * 4)
+
+    def test_oversized_complete_frame(self):
+        decoder = LineDecoder(max_frame=8)
+        with self.assertRaises(FrameTooLarge):
+            decoder.feed(b"ok\n" + b"x" * 9 + b"\n")
+
+    def test_oversized_rest_after_newline(self):
+        decoder = LineDecoder(max_frame=8)
+        with self.assertRaises(FrameTooLarge):
+            decoder.feed(b"ok\n" + b"x" * 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+# tests/test_query_plans.py
+"""查询计划回归：web/schema.py --check-plans 发现消息类大表被全表扫描时失败"""
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class QueryPlanTest(unittest.TestCase):
+    def test_no_full_scans(self):
+        # 单独的进程：检查会切换工作目录并导入 app.py
+        result = subprocess.run(
+            [sys.executable, os.path.join('web', 'schema.py'), '--check-plans'],
+            cwd=ROOT, capture_output=True, text=True, timeout=300,
+        )
+        failures = [line for line in result.stdout.splitlines() if line.startswith('[FAIL]')]
+        self.assertEqual(result.returncode, 0, '\n'.join(failures) or result.stdout[-2000:] + result.stderr[-2000:])
+        self.assertIn('发现 0 处全表扫描', result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
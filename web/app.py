@@ -1,21 +1,57 @@
 # web/app.py
+# 协程模式（CHAT_ASYNC_MODE=eventlet/gevent）要在导入其他模块之前打补丁
+from serving import ASYNC_MODE, LoopCallbacks, monkey_patch, offload, offloaded, run as run_server
+monkey_patch()
+
+import atexit
+import base64
+import binascii
 import os
 import sqlite3
 import secrets
 import string
-from datetime import datetime
+from datetime import datetime, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from database import users_pool, chat_pool, chat_writer, chat_ids, enable_wal, pool_stats
+from schema import CHAT_MIGRATIONS, ensure_message_fts, migrate
+from cache import RoomHistoryCache, RoomCatalog, KeyedCache
+from presence import PresenceRegistry, PresenceBatcher, SharedPresenceRegistry, PRESENCE_HEARTBEAT_INTERVAL
+from cluster import MESSAGE_QUEUE, ClusterEvents, socketio_options
+from history_codec import HISTORY_FORMAT, CompactJSON, pack_history
+from enrollment import create_enrollment
+
 # ---------------- 基础配置 ----------------
 app = Flask(__name__)
-app.secret_key = os.urandom(24)  # 简单用随机 secret，正式可以写死
+# 多个实例必须使用相同的 secret，否则一个实例签发的 session cookie 在其他实例上无效
+app.secret_key = os.environ.get('CHAT_SECRET_KEY') or os.urandom(24)  # 简单用随机 secret，正式可以写死
+
+# 异步引擎由 CHAT_ASYNC_MODE 选择，见 serving.py；
+# 设置 CHAT_MESSAGE_QUEUE 后事件经消息队列转发，可以运行多个实例，见 cluster.py
+socketio = SocketIO(app, async_mode=ASYNC_MODE, json=CompactJSON, **socketio_options())
+cluster = ClusterEvents(socketio)
+# 写线程中落盘失败的通知经此交回事件循环再 emit
+loop_callbacks = LoopCallbacks()
+socketio.start_background_task(loop_callbacks.run_forever)
+
+# 每页历史消息条数
+ROOM_HISTORY_LIMIT = 100
+PRIVATE_HISTORY_LIMIT = 50
 
-# 让 SocketIO 用 eventlet 作为异步引擎
-socketio = SocketIO(app, async_mode="threading")
+# 消息全文搜索：trigram 分词最少 3 个字符；摘要中用私用区字符标记高亮，由前端转义后替换
+FTS_MIN_TERM_LENGTH = 3
+SNIPPET_MARK_START = '\ue000'
+SNIPPET_MARK_END = '\ue001'
+
+# 热门聊天室最近历史的内存缓冲
+room_history_cache = RoomHistoryCache()
+
+# 注册时签发用户证书（密钥池 + 进程内签发 CA），不可用时为 None，见 enrollment.py
+enrollment = create_enrollment()
 
 # 生成随机token函数
 def generate_token(length=10):
@@ -30,151 +66,276 @@ def init_db():
     os.makedirs('./web/db', exist_ok=True)
     
     # 初始化用户数据库
-    users_conn = sqlite3.connect('./web/db/users.db')
-    users_cursor = users_conn.cursor()
-    
-    users_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    users_conn.commit()
-    users_conn.close()
+    with users_pool.connection() as users_conn:
+        enable_wal(users_conn)
+        users_cursor = users_conn.cursor()
+        
+        users_cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # 注册时签发的客户端证书：PEM 文件（用登录密码加密的私钥 + 证书 + 签发 CA 证书）
+        users_cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_certificates (
+                username TEXT PRIMARY KEY,
+                serial TEXT NOT NULL,
+                not_after TEXT NOT NULL,
+                bundle BLOB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        users_conn.commit()
     
     # 初始化聊天记录数据库
-    chat_conn = sqlite3.connect('./web/db/chat_messages.db')
-    chat_cursor = chat_conn.cursor()
-    
-    chat_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            message TEXT NOT NULL,
-            room_id TEXT DEFAULT 'general',
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建聊天室表 - 增加room_type和token字段
-    chat_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_rooms (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            created_by TEXT NOT NULL,
-            room_type TEXT DEFAULT 'public',
-            token TEXT UNIQUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建私人消息表
-    chat_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS private_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_user TEXT NOT NULL,
-            to_user TEXT NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 创建用户-聊天室关系表
-    chat_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_rooms (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            room_id TEXT NOT NULL,
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(username, room_id)
-        )
-    ''')
-    
-    # 插入默认聊天室（公共）
-    chat_cursor.execute('''
-        INSERT OR IGNORE INTO chat_rooms (name, created_by, room_type) 
-        VALUES ('general', 'system', 'public')
-    ''')
-    
-    chat_conn.commit()
-    chat_conn.close()
+    with chat_pool.connection() as chat_conn:
+        enable_wal(chat_conn)
+        chat_cursor = chat_conn.cursor()
+        
+        chat_cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                message TEXT NOT NULL,
+                room_id TEXT DEFAULT 'general',
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # 创建聊天室表 - 增加room_type和token字段
+        chat_cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_rooms (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                created_by TEXT NOT NULL,
+                room_type TEXT DEFAULT 'public',
+                token TEXT UNIQUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # 创建私人消息表
+        chat_cursor.execute('''
+            CREATE TABLE IF NOT EXISTS private_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_user TEXT NOT NULL,
+                to_user TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # 创建用户-聊天室关系表
+        chat_cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_rooms (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                room_id TEXT NOT NULL,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(username, room_id)
+            )
+        ''')
+        
+        # 插入默认聊天室（公共）
+        chat_cursor.execute('''
+            INSERT OR IGNORE INTO chat_rooms (name, created_by, room_type) 
+            VALUES ('general', 'system', 'public')
+        ''')
+        
+        chat_conn.commit()
+        
+        # 升级已有数据库文件的结构（索引等）
+        migrate(chat_conn, CHAT_MIGRATIONS)
+        ensure_message_fts(chat_conn)
 
 # 初始化数据库
 init_db()
 
-# 记录在线用户：sid -> username
-online_users = {}
+# 记录在线用户：sid -> username、username -> 该用户的所有 sid，以及每个会话当前所在的聊天室；
+# 多进程模式下成员关系存放在共享的数据库表中
+if MESSAGE_QUEUE:
+    presence = SharedPresenceRegistry(chat_writer, chat_pool, default_room='general', offload=offload)
+else:
+    presence = PresenceRegistry(default_room='general')
+
+
+def emit_presence_delta(room_name, joined, left):
+    """向聊天室推送合并后的成员进出增量"""
+    socketio.emit("presence_delta", {"room": room_name, "joined": joined, "left": left}, to=room_name)
+
+
+presence_batcher = PresenceBatcher(
+    emit_presence_delta,
+    spawn=socketio.start_background_task,
+    sleep=socketio.sleep,
+)
+
+def user_room(username):
+    """每个用户的所有会话都加入的 Socket.IO 房间（聊天室名来自用户输入，用 \\0 前缀避免重名）"""
+    return f"\0user:{username}"
+
 
 def emit_to_username(target_username, event_name, payload):
-    """向指定用户的所有会话发送Socket事件"""
-    for sid, online_username in online_users.items():
-        if online_username == target_username:
-            socketio.emit(event_name, payload, to=sid)
+    """向指定用户的所有会话发送Socket事件（多进程模式下包括其他进程上的会话）"""
+    socketio.emit(event_name, payload, to=user_room(target_username))
+
+
+def prune_presence_forever():
+    """多进程模式：定期心跳，并替已退出的进程推送其用户离开聊天室的增量"""
+    while True:
+        try:
+            for room_name, username in presence.heartbeat():
+                presence_batcher.left(room_name, username)
+        except Exception as e:
+            print(f"[!] 在线状态心跳失败: {e}")
+        socketio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
 
 # ---------------- 用户认证函数 ----------------
 
+@offloaded
 def register_user(username, password):
     """注册新用户"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/users.db')
-        cursor = conn.cursor()
+        # 密码哈希很慢，先算好再借连接，避免长时间占用连接池
         password_hash = generate_password_hash(password)
-        cursor.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', 
-                      (username, password_hash))
-        conn.commit()
-        return True
+        with users_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', 
+                          (username, password_hash))
+            conn.commit()
+            return True
     except sqlite3.IntegrityError:
         return False  # 用户名已存在
     except Exception as e:
         print(f"注册用户时出错: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
+def issue_user_certificate(username, password):
+    """为新用户签发客户端证书并保存；失败只记录日志，不影响注册"""
+    try:
+        serial, not_after, bundle = enrollment.enroll(username, password)
+        with users_pool.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO user_certificates (username, serial, not_after, bundle) VALUES (?, ?, ?, ?)',
+                (username, serial, not_after, bundle))
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"签发用户证书时出错: {e}")
+        return False
+
+@offloaded
+def get_user_certificate(username):
+    """返回用户证书 {'serial', 'not_after', 'bundle'}，没有时返回 None"""
+    try:
+        with users_pool.connection() as conn:
+            row = conn.execute(
+                'SELECT serial, not_after, bundle FROM user_certificates WHERE username = ?',
+                (username,)).fetchone()
+        if row is None:
+            return None
+        return {'serial': row[0], 'not_after': row[1], 'bundle': row[2]}
+    except Exception as e:
+        print(f"获取用户证书时出错: {e}")
+        return None
+
+@offloaded
+def ocsp_response(request_der):
+    """签发 CA 的 OCSP 响应（预签缓存未命中时要查 certs.db、签名）"""
+    return enrollment.ocsp_response(request_der)
+
+@offloaded
 def authenticate_user(username, password):
     """验证用户凭据"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/users.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT password_hash FROM users WHERE username = ?', (username,))
-        result = cursor.fetchone()
-        
+        with users_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT password_hash FROM users WHERE username = ?', (username,))
+            result = cursor.fetchone()
+
+        # 校验密码时已经归还连接
         if result and check_password_hash(result[0], password):
             return True
         return False
     except Exception as e:
         print(f"用户认证时出错: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
-
-def save_chat_message(username, message, room_id='general'):
-    """保存聊天消息到数据库并返回消息ID"""
-    conn = None
-    message_id = None
+
+@offloaded
+def get_all_usernames():
+    """获取所有注册用户名"""
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO chat_messages (username, message, room_id) VALUES (?, ?, ?)',
-            (username, message, room_id)
-        )
-        conn.commit()
-        message_id = cursor.lastrowid
+        with users_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT username FROM users ORDER BY username')
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"获取用户列表时出错: {e}")
+        return []
+
+def message_timestamp():
+    """消息时间：与列默认值 CURRENT_TIMESTAMP 同一时钟（UTC），秒级"""
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+@offloaded
+def save_chat_message(username, message, room_id='general', on_error=None, timestamp=None):
+    """保存聊天消息并返回消息ID
+
+    ID 预先分配后立即返回，消息交给写线程批量提交；
+    落盘失败时调用 on_error(message_id, exception)。
+    多实例时见 _insert_committed：提交后才返回，失败直接返回 None。
+    timestamp 显式写入，广播和历史缓冲中的消息用同一个值（默认取 message_timestamp()）。
+    """
+    timestamp = timestamp or message_timestamp()
+    if MESSAGE_QUEUE:
+        return _insert_committed(
+            'INSERT INTO chat_messages (username, message, room_id, timestamp) VALUES (?, ?, ?, ?)',
+            (username, message, room_id, timestamp.strftime('%Y-%m-%d %H:%M:%S')), '保存聊天消息时出错')
+
+    try:
+        message_id = chat_ids.next_id('chat_messages')
     except Exception as e:
-        print(f'保存聊天消息时出错: {e}')
-    finally:
-        if conn:
-            conn.close()
+        print(f'分配聊天消息ID时出错: {e}')
+        return None
+
+    future = chat_writer.submit_insert(
+        'INSERT INTO chat_messages (id, username, message, room_id, timestamp) VALUES (?, ?, ?, ?, ?)',
+        (message_id, username, message, room_id, timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    future.add_done_callback(lambda f: _report_write_failure(f, '保存聊天消息时出错', message_id, on_error))
     return message_id
 
+def _insert_row(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+def _insert_committed(sql, params, label):
+    """多个实例共用消息库时的写入：ID 由 SQLite 在写线程的事务里分配，等提交后返回
+
+    各实例的写事务由数据库写锁串行化，ID 与提交顺序一致、跨实例按时间递增
+    （历史排序、before_id/after_id 翻页都依赖它），也不必为每条消息单独开连接预留ID。
+    调用方在提交之后才广播，失败返回 None。
+    """
+    try:
+        return chat_writer.execute(_insert_row, sql, params)
+    except Exception as e:
+        print(f'{label}: {e}')
+        return None
+
+def _report_write_failure(future, label, message_id, on_error):
+    """异步写入完成后的回调（在写线程中执行）：记录写入失败，on_error 交回事件循环执行"""
+    error = future.exception()
+    if error is None:
+        return
+    print(f'{label}: {error}')
+    if on_error:
+        loop_callbacks.call(on_error, message_id, error)
+
 def format_timestamp_parts(timestamp_value):
     """返回消息展示时间和完整时间字符串"""
     default_display = '未知时间'
@@ -198,190 +359,229 @@ def format_timestamp_parts(timestamp_value):
     except Exception:
         return default_display, default_full
 
-def load_chat_history(room_id='general', limit=100):
-    """从数据库加载指定聊天室的历史"""
-    conn = None
+@offloaded
+def load_chat_history(room_id='general', limit=100, before_id=None, after_id=None):
+    """从数据库加载指定聊天室的历史（按 id 升序）
+
+    默认返回最新的 limit 条；before_id / after_id 为游标，
+    分别返回该 id 之前 / 之后相邻的 limit 条，走 (room_id, id) 索引定位。
+    """
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, username, message, room_id, timestamp 
-            FROM chat_messages 
-            WHERE room_id = ?
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (room_id, limit))
-        messages = cursor.fetchall()
-        history = []
-        for message_id, username, message, room, timestamp in reversed(messages):
-            time_str, full_time = format_timestamp_parts(timestamp)
-            history.append({
-                'id': message_id,
-                'user': username,
-                'text': message,
-                'time': time_str,
-                'timestamp': full_time,
-                'room': room,
-                'type': 'room'
-            })
-        return history
+        with chat_pool.connection() as conn:
+            cursor = conn.cursor()
+            query = '''
+                SELECT id, username, message, room_id, timestamp 
+                FROM chat_messages 
+                WHERE room_id = ?
+            '''
+            params = [room_id]
+            if after_id:
+                query += ' AND id > ? ORDER BY id ASC LIMIT ?'
+                params += [after_id, limit]
+            else:
+                if before_id:
+                    query += ' AND id < ?'
+                    params.append(before_id)
+                query += ' ORDER BY id DESC LIMIT ?'
+                params.append(limit)
+            cursor.execute(query, params)
+            messages = cursor.fetchall()
+            if not after_id:
+                messages.reverse()
+            history = []
+            for message_id, username, message, room, timestamp in messages:
+                time_str, full_time = format_timestamp_parts(timestamp)
+                history.append({
+                    'id': message_id,
+                    'user': username,
+                    'text': message,
+                    'time': time_str,
+                    'timestamp': full_time,
+                    'room': room,
+                    'type': 'room'
+                })
+            return history
     except Exception as e:
         print(f'加载聊天历史时出错: {e}')
         return []
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
 def create_chat_room(room_name, created_by):
     """创建新聊天室"""
-    conn = None
+    def insert(conn):
+        conn.execute('INSERT INTO chat_rooms (name, created_by) VALUES (?, ?)', 
+                     (room_name, created_by))
+
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO chat_rooms (name, created_by) VALUES (?, ?)', 
-                      (room_name, created_by))
-        conn.commit()
+        chat_writer.execute(insert)
+        room_catalog.invalidate()
         return True
     except sqlite3.IntegrityError:
         return False  # 聊天室名已存在
     except Exception as e:
         print(f"创建聊天室时出错: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+
+@offloaded
+def load_room_catalog():
+    """从数据库读取全部聊天室（供 room_catalog 加载，出错时抛出异常，不缓存错误结果）"""
+    with chat_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, created_by, created_at, room_type FROM chat_rooms ORDER BY created_at DESC')
+        return [{"name": name, "created_by": created_by, "created_at": created_at, "room_type": room_type}
+                for name, created_by, created_at, room_type in cursor.fetchall()]
+
+# 聊天室目录：创建/删除聊天室时失效
+room_catalog = RoomCatalog(load_room_catalog)
 
 def get_chat_rooms():
     """获取所有聊天室列表"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name, created_by, created_at FROM chat_rooms ORDER BY created_at DESC')
-        rooms = cursor.fetchall()
-        return [{"name": name, "created_by": created_by, "created_at": created_at} 
-                for name, created_by, created_at in rooms]
+        return room_catalog.all_rooms()
     except Exception as e:
         print(f"获取聊天室列表时出错: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
+def chat_room_exists(room_name):
+    """聊天室是否存在"""
+    try:
+        return room_catalog.exists(room_name)
+    except Exception as e:
+        print(f"检查聊天室是否存在时出错: {e}")
+        return False
+
+@offloaded
 def join_chat_room(username, room_id):
     """用户加入聊天室"""
-    conn = None
+    def insert(conn):
+        conn.execute('INSERT OR IGNORE INTO user_rooms (username, room_id) VALUES (?, ?)', 
+                     (username, room_id))
+
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO user_rooms (username, room_id) VALUES (?, ?)', 
-                      (username, room_id))
-        conn.commit()
+        chat_writer.execute(insert)
+        user_rooms_cache.invalidate(username)
         return True
     except Exception as e:
         print(f"加入聊天室时出错: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
 def leave_chat_room(username, room_id):
     """用户离开聊天室"""
-    conn = None
+    def delete(conn):
+        conn.execute('DELETE FROM user_rooms WHERE username = ? AND room_id = ?', 
+                     (username, room_id))
+
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM user_rooms WHERE username = ? AND room_id = ?', 
-                      (username, room_id))
-        conn.commit()
+        chat_writer.execute(delete)
+        user_rooms_cache.invalidate(username)
         return True
     except Exception as e:
         print(f"离开聊天室时出错: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
-def get_user_rooms(username):
-    """获取用户加入的聊天室"""
-    conn = None
-    try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
+@offloaded
+def query_user_rooms(username):
+    """从数据库读取用户加入的聊天室（供 user_rooms_cache 加载）"""
+    with chat_pool.connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT room_id FROM user_rooms 
             WHERE username = ? 
             ORDER BY joined_at DESC
         ''', (username,))
-        rooms = cursor.fetchall()
-        return [room[0] for room in rooms]
+        return [room[0] for room in cursor.fetchall()]
+
+# 用户加入的聊天室：加入/离开/删除聊天室时失效
+user_rooms_cache = KeyedCache(query_user_rooms)
+
+def get_user_rooms(username):
+    """获取用户加入的聊天室"""
+    try:
+        return user_rooms_cache.get(username)
     except Exception as e:
         print(f"获取用户聊天室时出错: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
-
-def save_private_message(from_user, to_user, message):
-    """保存私人消息到数据库并返回消息ID"""
-    conn = None
-    message_id = None
+
+@offloaded
+def save_private_message(from_user, to_user, message, on_error=None, timestamp=None):
+    """保存私人消息并返回消息ID（异步批量提交，timestamp、多实例时的行为同 save_chat_message）"""
+    timestamp = timestamp or message_timestamp()
+    if MESSAGE_QUEUE:
+        message_id = _insert_committed(
+            'INSERT INTO private_messages (from_user, to_user, message, timestamp) VALUES (?, ?, ?, ?)',
+            (from_user, to_user, message, timestamp.strftime('%Y-%m-%d %H:%M:%S')), '保存私人消息失败')
+        private_chats_cache.invalidate(from_user, to_user)
+        return message_id
+
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO private_messages (from_user, to_user, message) VALUES (?, ?, ?)',
-            (from_user, to_user, message)
-        )
-        conn.commit()
-        message_id = cursor.lastrowid
+        message_id = chat_ids.next_id('private_messages')
     except Exception as e:
-        print(f'保存私人消息失败: {e}')
-    finally:
-        if conn:
-            conn.close()
+        print(f'分配私人消息ID时出错: {e}')
+        return None
+
+    future = chat_writer.submit_insert(
+        'INSERT INTO private_messages (id, from_user, to_user, message, timestamp) VALUES (?, ?, ?, ?, ?)',
+        (message_id, from_user, to_user, message, timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    future.add_done_callback(lambda f: _report_write_failure(f, '保存私人消息失败', message_id, on_error))
+    # 提交后会话列表的顺序（以及可能的新会话）变了
+    future.add_done_callback(lambda f: private_chats_cache.invalidate(from_user, to_user))
     return message_id
 
-def load_private_messages(user1, user2, limit=50):
-    """加载两个用户之间的私人消息历史"""
-    conn = None
+@offloaded
+def load_private_messages(user1, user2, limit=50, before_id=None, after_id=None):
+    """加载两个用户之间的私人消息历史（按 id 升序，游标语义同 load_chat_history）"""
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, from_user, to_user, message, timestamp 
-            FROM private_messages 
-            WHERE (from_user = ? AND to_user = ?) OR (from_user = ? AND to_user = ?)
-            ORDER BY timestamp ASC 
-            LIMIT ?
-        ''', (user1, user2, user2, user1, limit))
-        messages = cursor.fetchall()
-        history = []
-        for message_id, from_user, to_user, message, timestamp in messages:
-            time_str, full_time = format_timestamp_parts(timestamp)
-            history.append({
-                'id': message_id,
-                'user': from_user,
-                'text': message,
-                'time': time_str,
-                'timestamp': full_time,
-                'type': 'private',
-                'direction': 'outgoing' if from_user == user1 else 'incoming',
-                'partner': user2
-            })
-        return history
+        with chat_pool.connection() as conn:
+            cursor = conn.cursor()
+            condition = ''
+            params = [user1, user2]
+            if after_id:
+                condition = ' AND id > ?'
+                params.append(after_id)
+            elif before_id:
+                condition = ' AND id < ?'
+                params.append(before_id)
+            params = params + [user2, user1] + params[2:]
+            order = 'ASC' if after_id else 'DESC'
+            # 两个方向分别走 (from_user, to_user, id) 索引，按 id 归并
+            cursor.execute(f'''
+                SELECT id, from_user, to_user, message, timestamp 
+                FROM private_messages 
+                WHERE from_user = ? AND to_user = ?{condition}
+                UNION ALL
+                SELECT id, from_user, to_user, message, timestamp 
+                FROM private_messages 
+                WHERE from_user = ? AND to_user = ?{condition}
+                ORDER BY id {order} 
+                LIMIT ?
+            ''', params + [limit])
+            messages = cursor.fetchall()
+            if not after_id:
+                messages.reverse()
+            history = []
+            for message_id, from_user, to_user, message, timestamp in messages:
+                time_str, full_time = format_timestamp_parts(timestamp)
+                history.append({
+                    'id': message_id,
+                    'user': from_user,
+                    'text': message,
+                    'time': time_str,
+                    'timestamp': full_time,
+                    'type': 'private',
+                    'direction': 'outgoing' if from_user == user1 else 'incoming',
+                    'partner': user2
+                })
+            return history
     except Exception as e:
         print(f'加载私人消息历史时出错: {e}')
         return []
-    finally:
-        if conn:
-            conn.close()
 
-def get_private_chats(username):
-    """获取用户的私聊会话列表"""
-    conn = None
-    try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
+@offloaded
+def query_private_chats(username):
+    """从数据库读取用户的私聊会话列表（供 private_chats_cache 加载）"""
+    with chat_pool.connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT DISTINCT 
@@ -395,147 +595,274 @@ def get_private_chats(username):
             GROUP BY chat_partner
             ORDER BY last_message_time DESC
         ''', (username, username, username))
-        chats = cursor.fetchall()
-        
         return [{"partner": partner, "last_message_time": last_time} 
-                for partner, last_time in chats]
+                for partner, last_time in cursor.fetchall()]
+
+# 私聊会话列表：收发、删除私人消息后失效
+private_chats_cache = KeyedCache(query_private_chats)
+
+def get_private_chats(username):
+    """获取用户的私聊会话列表"""
+    try:
+        return private_chats_cache.get(username)
     except Exception as e:
         print(f"获取私聊会话列表时出错: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
-def fetch_user_room_messages(username, room_id=None, keyword=None, limit=100):
+@offloaded
+def fetch_user_room_messages(username, room_id=None, keyword=None, limit=100, before_id=None, after_id=None):
     """获取用户在聊天室中发送的消息"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        query = '''
-            SELECT id, message, room_id, timestamp
-            FROM chat_messages
-            WHERE username = ?
-        '''
-        params = [username]
-        if room_id:
-            query += ' AND room_id = ?'
-            params.append(room_id)
-        if keyword:
-            query += ' AND message LIKE ?'
-            params.append(f'%{keyword}%')
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        messages = []
-        for message_id, message, room, timestamp in rows:
-            time_str, full_time = format_timestamp_parts(timestamp)
-            messages.append({
-                "id": message_id,
-                "text": message,
-                "time": time_str,
-                "timestamp": full_time,
-                "room": room,
-                "type": "room"
-            })
-        return messages
+        with chat_pool.connection() as conn:
+            cursor = conn.cursor()
+            query = '''
+                SELECT id, message, room_id, timestamp
+                FROM chat_messages
+                WHERE username = ?
+            '''
+            params = [username]
+            if room_id:
+                query += ' AND room_id = ?'
+                params.append(room_id)
+            if keyword:
+                query += ' AND message LIKE ?'
+                params.append(f'%{keyword}%')
+            if after_id:
+                query += ' AND id > ? ORDER BY id ASC LIMIT ?'
+                params += [after_id, limit]
+            else:
+                if before_id:
+                    query += ' AND id < ?'
+                    params.append(before_id)
+                query += ' ORDER BY id DESC LIMIT ?'
+                params.append(limit)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            if after_id:
+                # 统一按 id 降序（新消息在前）返回
+                rows.reverse()
+            messages = []
+            for message_id, message, room, timestamp in rows:
+                time_str, full_time = format_timestamp_parts(timestamp)
+                messages.append({
+                    "id": message_id,
+                    "text": message,
+                    "time": time_str,
+                    "timestamp": full_time,
+                    "room": room,
+                    "type": "room"
+                })
+            return messages
     except Exception as e:
         print(f"获取用户聊天室消息时出错: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
-def fetch_user_private_messages(username, partner=None, keyword=None, limit=100):
+@offloaded
+def fetch_user_private_messages(username, partner=None, keyword=None, limit=100, before_id=None, after_id=None):
     """获取用户发送的私人消息"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        query = '''
-            SELECT id, to_user, message, timestamp
-            FROM private_messages
-            WHERE from_user = ?
-        '''
-        params = [username]
-        if partner:
-            query += ' AND to_user = ?'
-            params.append(partner)
-        if keyword:
-            query += ' AND message LIKE ?'
-            params.append(f'%{keyword}%')
-        query += ' ORDER BY timestamp DESC LIMIT ?'
-        params.append(limit)
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        messages = []
-        for message_id, to_user, message, timestamp in rows:
-            time_str, full_time = format_timestamp_parts(timestamp)
-            messages.append({
-                "id": message_id,
-                "text": message,
-                "time": time_str,
-                "timestamp": full_time,
-                "partner": to_user,
-                "type": "private",
-                "direction": "outgoing"
-            })
-        return messages
+        with chat_pool.connection() as conn:
+            cursor = conn.cursor()
+            query = '''
+                SELECT id, to_user, message, timestamp
+                FROM private_messages
+                WHERE from_user = ?
+            '''
+            params = [username]
+            if partner:
+                query += ' AND to_user = ?'
+                params.append(partner)
+            if keyword:
+                query += ' AND message LIKE ?'
+                params.append(f'%{keyword}%')
+            if after_id:
+                query += ' AND id > ? ORDER BY id ASC LIMIT ?'
+                params += [after_id, limit]
+            else:
+                if before_id:
+                    query += ' AND id < ?'
+                    params.append(before_id)
+                query += ' ORDER BY id DESC LIMIT ?'
+                params.append(limit)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            if after_id:
+                # 统一按 id 降序（新消息在前）返回
+                rows.reverse()
+            messages = []
+            for message_id, to_user, message, timestamp in rows:
+                time_str, full_time = format_timestamp_parts(timestamp)
+                messages.append({
+                    "id": message_id,
+                    "text": message,
+                    "time": time_str,
+                    "timestamp": full_time,
+                    "partner": to_user,
+                    "type": "private",
+                    "direction": "outgoing"
+                })
+            return messages
     except Exception as e:
         print(f"获取私人消息列表时出错: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
+def message_fts_enabled():
+    """数据库中是否已经建立了消息全文索引"""
+    try:
+        with chat_pool.connection() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'"
+            ).fetchone()
+            return row is not None
+    except Exception as e:
+        print(f"检查全文索引时出错: {e}")
+        return False
+
+MESSAGE_FTS_ENABLED = message_fts_enabled()
+
+def build_fts_query(keyword, column, user_column=None, username=None):
+    """把关键词转换为 FTS5 MATCH 表达式，无法走 trigram 索引时返回 None
+
+    每个空格分隔的词作为一个短语（AND 组合）；trigram 至少需要 3 个字符，
+    更短的词只能用 LIKE 匹配。用户名足够长时一并写入 MATCH 以缩小候选集。
+    """
+    terms = (keyword or '').split()
+    if not terms or any(len(term) < FTS_MIN_TERM_LENGTH for term in terms):
+        return None
+    clauses = [f'{column} : "' + term.replace('"', '""') + '"' for term in terms]
+    if user_column and username and len(username) >= FTS_MIN_TERM_LENGTH:
+        clauses.append(f'{user_column} : "' + username.replace('"', '""') + '"')
+    return ' AND '.join(clauses)
+
+@offloaded
+def search_user_room_messages(username, keyword, room_id=None, limit=50, offset=0):
+    """全文搜索用户在聊天室中发送的消息，按相关度排序并附带高亮摘要"""
+    match = build_fts_query(keyword, 'message', 'username', username)
+    if not match:
+        return []
+    try:
+        with chat_pool.connection() as conn:
+            query = '''
+                SELECT m.id, m.message, m.room_id, m.timestamp,
+                       snippet(chat_messages_fts, 0, ?, ?, '…', 24),
+                       bm25(chat_messages_fts, 1.0, 0.0) AS score
+                FROM chat_messages_fts
+                JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+                WHERE chat_messages_fts MATCH ? AND m.username = ?
+            '''
+            params = [SNIPPET_MARK_START, SNIPPET_MARK_END, match, username]
+            if room_id:
+                query += ' AND m.room_id = ?'
+                params.append(room_id)
+            query += ' ORDER BY score, m.id DESC LIMIT ? OFFSET ?'
+            params += [limit, offset]
+            rows = conn.execute(query, params).fetchall()
+            messages = []
+            for message_id, message, room, timestamp, snippet, score in rows:
+                time_str, full_time = format_timestamp_parts(timestamp)
+                messages.append({
+                    "id": message_id,
+                    "text": message,
+                    "snippet": snippet,
+                    "score": round(-score, 4),
+                    "time": time_str,
+                    "timestamp": full_time,
+                    "room": room,
+                    "type": "room"
+                })
+            return messages
+    except Exception as e:
+        print(f"搜索聊天室消息时出错: {e}")
+        return []
+
+@offloaded
+def search_user_private_messages(username, keyword, partner=None, limit=50, offset=0):
+    """全文搜索用户发送的私人消息，按相关度排序并附带高亮摘要"""
+    match = build_fts_query(keyword, 'message', 'from_user', username)
+    if not match:
+        return []
+    try:
+        with chat_pool.connection() as conn:
+            query = '''
+                SELECT m.id, m.to_user, m.message, m.timestamp,
+                       snippet(private_messages_fts, 0, ?, ?, '…', 24),
+                       bm25(private_messages_fts, 1.0, 0.0) AS score
+                FROM private_messages_fts
+                JOIN private_messages m ON m.id = private_messages_fts.rowid
+                WHERE private_messages_fts MATCH ? AND m.from_user = ?
+            '''
+            params = [SNIPPET_MARK_START, SNIPPET_MARK_END, match, username]
+            if partner:
+                query += ' AND m.to_user = ?'
+                params.append(partner)
+            query += ' ORDER BY score, m.id DESC LIMIT ? OFFSET ?'
+            params += [limit, offset]
+            rows = conn.execute(query, params).fetchall()
+            messages = []
+            for message_id, to_user, message, timestamp, snippet, score in rows:
+                time_str, full_time = format_timestamp_parts(timestamp)
+                messages.append({
+                    "id": message_id,
+                    "text": message,
+                    "snippet": snippet,
+                    "score": round(-score, 4),
+                    "time": time_str,
+                    "timestamp": full_time,
+                    "partner": to_user,
+                    "type": "private",
+                    "direction": "outgoing"
+                })
+            return messages
+    except Exception as e:
+        print(f"搜索私人消息时出错: {e}")
+        return []
+
+@offloaded
 def delete_room_message_by_user(message_id, username):
     """删除用户在聊天室内发送的消息"""
-    conn = None
-    try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute(
+    def delete(conn):
+        row = conn.execute(
             'SELECT room_id FROM chat_messages WHERE id = ? AND username = ?',
             (message_id, username)
-        )
-        row = cursor.fetchone()
+        ).fetchone()
         if not row:
             return {"success": False, "error": "找不到消息或无权删除"}
         room_id = row[0]
-        cursor.execute('DELETE FROM chat_messages WHERE id = ?', (message_id,))
-        conn.commit()
+        conn.execute('DELETE FROM chat_messages WHERE id = ?', (message_id,))
         return {"success": True, "room_id": room_id}
+
+    try:
+        result = chat_writer.execute(delete)
+        if result.get("success"):
+            room_history_cache.discard(result["room_id"], message_id)
+        return result
     except Exception as e:
         print(f"删除聊天室消息时出错: {e}")
         return {"success": False, "error": "服务器内部错误"}
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
 def delete_private_message_by_user(message_id, username):
     """删除用户发送的私人消息"""
-    conn = None
-    try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute(
+    def delete(conn):
+        row = conn.execute(
             'SELECT to_user FROM private_messages WHERE id = ? AND from_user = ?',
             (message_id, username)
-        )
-        row = cursor.fetchone()
+        ).fetchone()
         if not row:
             return {"success": False, "error": "找不到消息或无权删除"}
         other_user = row[0]
-        cursor.execute('DELETE FROM private_messages WHERE id = ?', (message_id,))
-        conn.commit()
+        conn.execute('DELETE FROM private_messages WHERE id = ?', (message_id,))
         return {"success": True, "other_user": other_user}
+
+    try:
+        result = chat_writer.execute(delete)
+        if result.get("success"):
+            private_chats_cache.invalidate(username, result["other_user"])
+        return result
     except Exception as e:
         print(f"删除私人消息时出错: {e}")
         return {"success": False, "error": "服务器内部错误"}
-    finally:
-        if conn:
-            conn.close()
 
 def normalize_limit(raw_value, default=50, max_limit=500):
     """规范化分页参数"""
@@ -545,22 +872,38 @@ def normalize_limit(raw_value, default=50, max_limit=500):
         return default
     return max(1, min(value, max_limit))
 
-# ---------------- 私有聊天室相关函数 ----------------
-
+def parse_cursor(source):
+    """从请求参数中解析 before_id / after_id 游标，非法值视为未提供"""
+    def to_id(raw_value):
+        try:
+            value = int(raw_value)
+        except (TypeError, ValueError):
+            return None
+        return value if value > 0 else None
+
+    source = source or {}
+    return to_id(source.get('before_id')), to_id(source.get('after_id'))
+
+def paginate_history(history, limit, after_id=None):
+    """history 是按 limit + 1 条查询得到的升序列表，裁剪为一页并判断是否还有更多"""
+    has_more = len(history) > limit
+    if has_more:
+        # 向后翻页多出来的是最新的一条，其余情况多出来的是最旧的一条
+        history = history[:limit] if after_id else history[1:]
+    return history, has_more
+
+@offloaded
 def create_chat_room_with_type(room_name, created_by, room_type='public'):
     """创建新聊天室（支持公共/私有类型）"""
-    conn = sqlite3.connect('./web/db/chat_messages.db')
-    cursor = conn.cursor()
-    try:
+    def insert(conn):
         if room_type == 'private':
             # 为私有聊天室生成唯一token，重试3次以避免token重复
             max_retries = 3
             for attempt in range(max_retries):
                 token = generate_token()
                 try:
-                    cursor.execute('INSERT INTO chat_rooms (name, created_by, room_type, token) VALUES (?, ?, ?, ?)', 
-                                  (room_name, created_by, room_type, token))
-                    conn.commit()
+                    conn.execute('INSERT INTO chat_rooms (name, created_by, room_type, token) VALUES (?, ?, ?, ?)', 
+                                 (room_name, created_by, room_type, token))
                     return {'success': True, 'token': token}
                 except sqlite3.IntegrityError:
                     # 可能是token重复或房间名重复，如果是最后一次重试，返回错误
@@ -569,50 +912,42 @@ def create_chat_room_with_type(room_name, created_by, room_type='public'):
                     # 否则重试生成token
                     continue
         else:
-            cursor.execute('INSERT INTO chat_rooms (name, created_by, room_type) VALUES (?, ?, ?)', 
-                          (room_name, created_by, room_type))
-            conn.commit()
+            conn.execute('INSERT INTO chat_rooms (name, created_by, room_type) VALUES (?, ?, ?)', 
+                         (room_name, created_by, room_type))
             return {'success': True, 'token': None}
+
+    try:
+        result = chat_writer.execute(insert)
+        if result.get('success'):
+            room_catalog.invalidate()
+        return result
     except sqlite3.IntegrityError:
         return {'success': False, 'error': '聊天室名已存在'}
-    finally:
-        conn.close()
 
 def get_chat_rooms_public_only():
     """获取所有公共聊天室列表（私有聊天室不显示）"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name, created_by, created_at FROM chat_rooms WHERE room_type = "public" ORDER BY created_at DESC')
-        rooms = cursor.fetchall()
-        return [{"name": name, "created_by": created_by, "created_at": created_at} 
-                for name, created_by, created_at in rooms]
+        return room_catalog.public_rooms()
     except Exception as e:
         print(f"获取公共聊天室列表时出错: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
 def get_chat_room_by_token(token):
     """通过token获取私有聊天室信息"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name, created_by, room_type FROM chat_rooms WHERE token = ?', (token,))
-        result = cursor.fetchone()
-        if result:
-            return {"name": result[0], "created_by": result[1], "room_type": result[2]}
-        return None
+        with chat_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name, created_by, room_type FROM chat_rooms WHERE token = ?', (token,))
+            result = cursor.fetchone()
+            if result:
+                return {"name": result[0], "created_by": result[1], "room_type": result[2]}
+            return None
     except Exception as e:
         print(f"通过token获取聊天室信息时出错: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
 def join_chat_room_by_token(username, token):
     """通过token加入私有聊天室"""
     try:
@@ -631,16 +966,12 @@ def join_chat_room_by_token(username, token):
         print(f"通过token加入聊天室时出错: {e}")
         return {'success': False, 'error': '加入聊天室时发生错误'}
 
+@offloaded
 def delete_chat_room(room_name, username):
     """删除聊天室（只有创建者可以删除）"""
-    conn = None
-    try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        
+    def delete(conn):
         # 检查用户是否是创建者
-        cursor.execute('SELECT created_by FROM chat_rooms WHERE name = ?', (room_name,))
-        result = cursor.fetchone()
+        result = conn.execute('SELECT created_by FROM chat_rooms WHERE name = ?', (room_name,)).fetchone()
         
         if not result:
             return {'success': False, 'error': '聊天室不存在'}
@@ -653,37 +984,68 @@ def delete_chat_room(room_name, username):
             return {'success': False, 'error': '不能删除默认聊天室'}
         
         # 删除聊天室
-        cursor.execute('DELETE FROM chat_rooms WHERE name = ?', (room_name,))
+        conn.execute('DELETE FROM chat_rooms WHERE name = ?', (room_name,))
         # 删除用户-聊天室关系
-        cursor.execute('DELETE FROM user_rooms WHERE room_id = ?', (room_name,))
+        conn.execute('DELETE FROM user_rooms WHERE room_id = ?', (room_name,))
         # 删除聊天消息
-        cursor.execute('DELETE FROM chat_messages WHERE room_id = ?', (room_name,))
-        
-        conn.commit()
+        conn.execute('DELETE FROM chat_messages WHERE room_id = ?', (room_name,))
         return {'success': True}
+
+    try:
+        result = chat_writer.execute(delete)
+        if result.get('success'):
+            room_history_cache.invalidate(room_name)
+            room_catalog.invalidate()
+            # 所有成员的聊天室列表都变了
+            user_rooms_cache.clear()
+        return result
     except Exception as e:
         print(f"删除聊天室时出错: {e}")
         return {'success': False, 'error': str(e)}
-    finally:
-        if conn:
-            conn.close()
 
+@offloaded
 def get_user_created_rooms(username):
     """获取用户创建的聊天室"""
-    conn = None
     try:
-        conn = sqlite3.connect('./web/db/chat_messages.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name, room_type, token FROM chat_rooms WHERE created_by = ? ORDER BY created_at DESC', (username,))
-        rooms = cursor.fetchall()
-        return [{"name": name, "room_type": room_type, "token": token} 
-                for name, room_type, token in rooms]
+        with chat_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name, room_type, token FROM chat_rooms WHERE created_by = ? ORDER BY created_at DESC', (username,))
+            rooms = cursor.fetchall()
+            return [{"name": name, "room_type": room_type, "token": token} 
+                    for name, room_type, token in rooms]
     except Exception as e:
         print(f"获取用户创建的聊天室时出错: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
+
+# ---------------- 多进程模式：同步各进程的缓存 ----------------
+# 其他进程的聊天室广播同样追加进本进程的历史缓冲；改变聊天室目录、成员关系的操作
+# 由发起的进程发布内部事件，收到的进程让对应的缓存失效（单进程模式下不会触发）
+
+def on_remote_chat_message(room_name, msg):
+    room_history_cache.append(room_name, msg)
+
+
+def on_remote_message_deleted(room_name, payload):
+    if payload.get("type") == "room":
+        room_history_cache.discard(payload.get("room"), payload.get("id"))
+
+
+def on_remote_rooms_changed(room_name, payload):
+    room_catalog.invalidate()
+    deleted = payload.get("deleted")
+    if deleted:
+        room_history_cache.invalidate(deleted)
+        user_rooms_cache.clear()
+
+
+def on_remote_user_rooms_changed(room_name, payload):
+    user_rooms_cache.invalidate(payload.get("username"))
+
+
+cluster.on("chat_message", on_remote_chat_message)
+cluster.on("chat_message_deleted", on_remote_message_deleted)
+cluster.on("rooms_changed", on_remote_rooms_changed)
+cluster.on("user_rooms_changed", on_remote_user_rooms_changed)
 
 # ---------------- HTTP 路由：登录 / 注册 / 聊天页 ----------------
 
@@ -727,16 +1089,15 @@ def dashboard():
         user_rooms = get_user_rooms(username)
     
     # 获取在线用户列表（从数据库查询活跃用户）
-    conn = sqlite3.connect('./web/db/users.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT username FROM users ORDER BY username')
-    all_users = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    all_users = get_all_usernames()
     
     # 移除当前用户
     other_users = [user for user in all_users if user != username]
     
     private_partners = [chat['partner'] for chat in get_private_chats(username)]
+    certificate = get_user_certificate(username) if enrollment is not None else None
+    if certificate is not None:
+        certificate['revoked'] = enrollment.is_revoked(certificate['serial'])
 
     return render_template(
         "dashboard.html",
@@ -744,9 +1105,42 @@ def dashboard():
         public_rooms=public_rooms,
         user_rooms=user_rooms,
         other_users=other_users,
-        private_partners=private_partners
+        private_partners=private_partners,
+        certificate=certificate
     )
 
+
+@app.route("/certificate")
+def download_certificate():
+    """下载注册时签发的客户端证书（PEM：加密私钥 + 证书 + 签发 CA 证书）"""
+    if "username" not in session:
+        return redirect(url_for("login"))
+
+    username = session["username"]
+    certificate = get_user_certificate(username)
+    if certificate is None:
+        return jsonify({"success": False, "error": "没有签发过证书"}), 404
+    if enrollment is not None and enrollment.is_revoked(certificate['serial']):
+        return jsonify({"success": False, "error": "证书已吊销"}), 410
+
+    return Response(
+        certificate['bundle'],
+        mimetype="application/x-pem-file",
+        headers={"Content-Disposition": f"attachment; filename={certificate['serial']}.pem"},
+    )
+
+@app.route("/ocsp", methods=["POST"])
+@app.route("/ocsp/<path:encoded>", methods=["GET"])
+def ocsp_responder(encoded=None):
+    """签发 CA 的 OCSP 响应器（RFC 6960）：POST 请求体，或 GET /ocsp/<base64 请求>，不需要登录"""
+    if enrollment is None:
+        return jsonify({"success": False, "error": "未启用签发 CA"}), 404
+    try:
+        request_der = request.get_data() if encoded is None else base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        return jsonify({"success": False, "error": "无效的 OCSP 请求"}), 400
+    return Response(ocsp_response(request_der), mimetype="application/ocsp-response")
+
 @app.route("/register", methods=["GET", "POST"])
 def register():
     """用户注册"""
@@ -765,6 +1159,8 @@ def register():
             return render_template("register.html", error="密码长度至少6位")
         
         if register_user(username, password):
+            if enrollment is not None:
+                issue_user_certificate(username, password)
             session["username"] = username
             return redirect(url_for("dashboard"))
         else:
@@ -791,7 +1187,7 @@ def chat():
         user_rooms = get_user_rooms(username)
     
     # 从数据库加载默认聊天室的历史
-    history = load_chat_history('general')
+    history, _ = get_recent_room_history('general')
 
     return render_template(
         "chat.html",
@@ -815,23 +1211,64 @@ def api_get_my_messages():
     keyword = request.args.get("q", "").strip()
     room_id = request.args.get("room", "").strip()
     partner = request.args.get("partner", "").strip()
+    before_id, after_id = parse_cursor(request.args)
+    
+    # 关键词可以走全文索引时按相关度排序，用 offset 分页
+    if keyword and MESSAGE_FTS_ENABLED and build_fts_query(keyword, 'message'):
+        try:
+            offset = max(0, int(request.args.get("offset", 0)))
+        except (TypeError, ValueError):
+            offset = 0
+        if message_type == "private":
+            messages = search_user_private_messages(
+                username, keyword, partner=partner or None, limit=limit + 1, offset=offset
+            )
+        else:
+            messages = search_user_room_messages(
+                username, keyword, room_id=room_id or None, limit=limit + 1, offset=offset
+            )
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        return jsonify({
+            "success": True,
+            "messages": messages,
+            "has_more": has_more,
+            "ranked": True,
+            "next_offset": offset + len(messages) if has_more else None
+        })
     
+    # 多取一条用来判断是否还有下一页
     if message_type == "private":
         messages = fetch_user_private_messages(
             username,
             partner=partner or None,
             keyword=keyword or None,
-            limit=limit,
+            limit=limit + 1,
+            before_id=before_id,
+            after_id=after_id,
         )
     else:
         messages = fetch_user_room_messages(
             username,
             room_id=room_id or None,
             keyword=keyword or None,
-            limit=limit,
+            limit=limit + 1,
+            before_id=before_id,
+            after_id=after_id,
         )
     
-    return jsonify({"success": True, "messages": messages})
+    # 结果按 id 降序：向前翻页多出的是最旧的一条，向后翻页多出的是最新的一条
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[1:] if after_id else messages[:limit]
+    
+    return jsonify({
+        "success": True,
+        "messages": messages,
+        "has_more": has_more,
+        "next_before_id": messages[-1]["id"] if messages else None,
+        "next_after_id": messages[0]["id"] if messages else None
+    })
 
 
 @app.route("/api/my-messages/<int:message_id>", methods=["DELETE"])
@@ -871,14 +1308,75 @@ def api_delete_my_message(message_id):
     return jsonify({"success": True, "deleted_id": message_id})
 
 
+@app.route("/api/metrics", methods=["GET"])
+def api_metrics():
+    """返回服务端运行指标（数据库连接池等）"""
+    if "username" not in session:
+        return jsonify({"success": False, "error": "未登录"}), 401
+
+    return jsonify({
+        "success": True,
+        "db": pool_stats(),
+        "history_cache": room_history_cache.stats(),
+        "presence": presence.stats(),
+        "presence_deltas": presence_batcher.stats(),
+        "room_catalog": room_catalog.stats(),
+        "user_rooms_cache": user_rooms_cache.stats(),
+        "private_chats_cache": private_chats_cache.stats(),
+        "keypool": enrollment.stats() if enrollment is not None else None,
+        "revocation": enrollment.revocation_stats() if enrollment is not None else None,
+        "ocsp": enrollment.ocsp_stats() if enrollment is not None else None
+    })
+
+
 @app.route("/logout")
 def logout():
     session.pop("username", None)
     return redirect(url_for("login"))
 
 
-# 记录用户当前所在的聊天室：sid -> room_id
-user_current_rooms = {}
+def enter_room(username, room_name):
+    """把当前会话切换到 room_name：更换 Socket.IO 房间、记录成员进出，并发送新聊天室的在线成员"""
+    sid = request.sid
+    current_room = presence.current_room(sid)
+    if current_room == room_name:
+        return
+    leave_room(current_room)
+    join_room(room_name)
+    old_room, left_old, joined_new = presence.move(sid, room_name)
+    if left_old:
+        presence_batcher.left(old_room, username)
+    if joined_new:
+        presence_batcher.joined(room_name, username)
+    emit_room_presence(room_name)
+
+
+def emit_room_presence(room_name):
+    """向当前会话发送聊天室在线成员的全量快照，之后只推送增量"""
+    emit("room_presence", {"room": room_name, "users": presence.room_members(room_name)})
+
+
+def get_recent_room_history(room_name, limit=ROOM_HISTORY_LIMIT):
+    """最近一页聊天室历史：优先读内存环形缓冲，未命中时查库并回填，返回 (history, has_more)"""
+    return room_history_cache.load(room_name, limit,
+                                   lambda: load_chat_history(room_name, limit + 1))
+
+
+def emit_room_history(room_name, before_id=None, after_id=None):
+    """向当前连接发送一页聊天室历史；带游标时客户端把这一页拼接到已有消息上"""
+    if before_id or after_id:
+        history = load_chat_history(room_name, ROOM_HISTORY_LIMIT + 1, before_id=before_id, after_id=after_id)
+        history, has_more = paginate_history(history, ROOM_HISTORY_LIMIT, after_id)
+    else:
+        history, has_more = get_recent_room_history(room_name)
+    emit("room_history", {
+        "room": room_name,
+        "format": HISTORY_FORMAT,
+        "history": pack_history(history),
+        "has_more": has_more,
+        "before_id": before_id,
+        "after_id": after_id
+    })
 
 # ---------------- Socket.IO 事件：在线用户 & 聊天 ----------------
 
@@ -890,11 +1388,14 @@ def handle_connect():
         # 没登录的连接直接拒绝
         return False
 
-    online_users[request.sid] = username
-    user_current_rooms[request.sid] = 'general'  # 默认加入general聊天室
+    # 默认加入general聊天室
+    came_online, joined_room = presence.add(request.sid, username, 'general')
     
-    # 加入默认聊天室的Socket.IO房间
+    # 加入默认聊天室和该用户自己的Socket.IO房间
     join_room('general')
+    join_room(user_room(username))
+    if joined_room:
+        presence_batcher.joined('general', username)
     print(f"[+] {username} connected, sid={request.sid}, joined room: general")
 
     # 发送聊天室列表给新连接的用户（只显示公共聊天室）
@@ -906,34 +1407,32 @@ def handle_connect():
     # 发送私聊会话列表
     emit("private_chats_list", get_private_chats(username))
 
-    # 广播系统消息 & 在线列表
-    emit(
-        "system_message",
-        {"text": f"{username} 加入了聊天室"},
-        room='general',
-        broadcast=True,
-    )
-    emit_online_users()
-
+    # 只给新连接发送在线成员全量快照，其他人通过合并后的 presence_delta 得知
+    emit_room_presence('general')
 
-@socketio.on("disconnect")
-def handle_disconnect():
-    username = online_users.pop(request.sid, None)
-    user_current_rooms.pop(request.sid, None)
-    if username:
-        print(f"[-] {username} disconnected, sid={request.sid}")
+    # 同一用户打开多个页面时，只在第一个会话上线时广播系统消息
+    if came_online:
         emit(
             "system_message",
-            {"text": f"{username} 离开了聊天室"},
+            {"text": f"{username} 加入了聊天室"},
+            room='general',
             broadcast=True,
         )
-        emit_online_users()
 
 
-def emit_online_users():
-    """广播在线用户列表"""
-    users = sorted(set(online_users.values()))
-    emit("online_users", users, broadcast=True)
+@socketio.on("disconnect")
+def handle_disconnect():
+    username, room_name, went_offline, left_room = presence.remove(request.sid)
+    if username:
+        print(f"[-] {username} disconnected, sid={request.sid}")
+        if left_room:
+            presence_batcher.left(room_name, username)
+        if went_offline:
+            emit(
+                "system_message",
+                {"text": f"{username} 离开了聊天室"},
+                broadcast=True,
+            )
 
 
 @socketio.on("chat_message")
@@ -944,15 +1443,22 @@ def handle_chat_message(data):
     if not text:
         return
 
-    current_room = user_current_rooms.get(request.sid, 'general')
+    current_room = presence.current_room(request.sid)
+    sid = request.sid
+
+    def on_save_failed(message_id, error):
+        # 消息已经广播出去，落盘失败时让所有客户端撤回这条消息
+        room_history_cache.discard(current_room, message_id)
+        socketio.emit("chat_message_deleted", {"id": message_id, "type": "room", "room": current_room}, room=current_room)
+        socketio.emit("system_message", {"text": "消息保存失败，已撤回"}, to=sid)
     
-    # 保存消息到数据库
-    message_id = save_chat_message(username, text, current_room)
+    # 分配消息ID并交给写线程批量落盘，广播不必等待提交；
+    # 广播、历史缓冲和数据库中的时间是同一个值（UTC），缓存命中与否显示一致
+    now = message_timestamp()
+    message_id = save_chat_message(username, text, current_room, on_error=on_save_failed, timestamp=now)
     if not message_id:
         emit("system_message", {"text": "消息发送失败，请稍后重试"})
         return
-    
-    now = datetime.now()
 
     # 构建消息对象用于广播
     msg = {
@@ -967,6 +1473,7 @@ def handle_chat_message(data):
 
     # 广播聊天消息到当前聊天室的所有用户
     emit("chat_message", msg, room=current_room, broadcast=True)
+    room_history_cache.append(current_room, msg)
 
 
 @socketio.on("create_room")
@@ -981,13 +1488,11 @@ def handle_create_room(data):
     if create_chat_room(room_name, username):
         # 自动加入创建的聊天室
         join_chat_room(username, room_name)
+        cluster.publish("rooms_changed", {})
+        cluster.publish("user_rooms_changed", {"username": username})
         
         # 离开当前房间，加入新房间
-        current_room = user_current_rooms.get(request.sid, 'general')
-        if current_room != room_name:
-            leave_room(current_room)
-            join_room(room_name)
-            user_current_rooms[request.sid] = room_name
+        enter_room(username, room_name)
         
         # 通知所有用户更新聊天室列表
         emit("chat_rooms_list", get_chat_rooms(), broadcast=True)
@@ -1002,8 +1507,7 @@ def handle_create_room(data):
         )
         
         # 加载新聊天室的历史
-        history = load_chat_history(room_name)
-        emit("room_history", {"room": room_name, "history": history})
+        emit_room_history(room_name)
     else:
         emit("system_message", {"text": f"聊天室 '{room_name}' 已存在"})
 
@@ -1018,22 +1522,22 @@ def handle_join_room(data):
         return
     
     # 检查聊天室是否存在
-    rooms = get_chat_rooms()
-    room_exists = any(room["name"] == room_name for room in rooms)
-    
-    if not room_exists:
+    if not chat_room_exists(room_name):
         emit("system_message", {"text": f"聊天室 '{room_name}' 不存在"})
         return
     
+    # 带游标的请求只是在当前聊天室里翻页
+    before_id, after_id = parse_cursor(data)
+    if (before_id or after_id) and presence.current_room(request.sid) == room_name:
+        emit_room_history(room_name, before_id, after_id)
+        return
+    
     # 加入数据库记录
     join_chat_room(username, room_name)
+    cluster.publish("user_rooms_changed", {"username": username})
     
     # 离开当前房间，加入新房间
-    current_room = user_current_rooms.get(request.sid, 'general')
-    if current_room != room_name:
-        leave_room(current_room)
-        join_room(room_name)
-        user_current_rooms[request.sid] = room_name
+    enter_room(username, room_name)
     
     # 更新用户聊天室列表
     emit("user_rooms_list", get_user_rooms(username))
@@ -1047,8 +1551,7 @@ def handle_join_room(data):
     )
     
     # 加载新聊天室的历史
-    history = load_chat_history(room_name)
-    emit("room_history", {"room": room_name, "history": history})
+    emit_room_history(room_name)
 
 
 @socketio.on("leave_room")
@@ -1067,16 +1570,14 @@ def handle_leave_room(data):
     
     # 离开聊天室
     leave_chat_room(username, room_name)
+    cluster.publish("user_rooms_changed", {"username": username})
     
     # 如果当前在这个聊天室，切换到默认聊天室并离开Socket.IO房间
-    if user_current_rooms.get(request.sid) == room_name:
-        leave_room(room_name)  # 离开Socket.IO房间
-        user_current_rooms[request.sid] = 'general'
-        join_room('general')   # 加入默认聊天室
+    if presence.current_room(request.sid) == room_name:
+        enter_room(username, 'general')
         
         # 加载默认聊天室的历史
-        history = load_chat_history('general')
-        emit("room_history", {"room": 'general', "history": history})
+        emit_room_history('general')
     
     # 更新用户聊天室列表
     emit("user_rooms_list", get_user_rooms(username))
@@ -1105,16 +1606,17 @@ def handle_switch_room(data):
         emit("system_message", {"text": f"您还没有加入聊天室 '{room_name}'"})
         return
     
+    # 带游标的请求只是在当前聊天室里翻页
+    before_id, after_id = parse_cursor(data)
+    if before_id or after_id:
+        emit_room_history(room_name, before_id, after_id)
+        return
+    
     # 离开当前房间，加入新房间
-    current_room = user_current_rooms.get(request.sid, 'general')
-    if current_room != room_name:
-        leave_room(current_room)
-        join_room(room_name)
-        user_current_rooms[request.sid] = room_name
+    enter_room(username, room_name)
     
     # 加载新聊天室的历史
-    history = load_chat_history(room_name)
-    emit("room_history", {"room": room_name, "history": history})
+    emit_room_history(room_name)
     
     emit("system_message", {"text": f"已切换到聊天室 '{room_name}'"})
 
@@ -1129,14 +1631,21 @@ def handle_private_message(data):
     if not username or not to_user or not text:
         return
     
-    # 保存私人消息（无论用户是否在线）
-    message_id = save_private_message(username, to_user, text)
+    sid = request.sid
+
+    def on_save_failed(message_id, error):
+        payload = {"id": message_id, "type": "private", "partner": to_user}
+        emit_to_username(username, "private_message_deleted", payload)
+        emit_to_username(to_user, "private_message_deleted", payload)
+        socketio.emit("system_message", {"text": "私人消息保存失败，已撤回"}, to=sid)
+
+    # 保存私人消息（无论用户是否在线），落盘在后台批量完成；时间与数据库中的一致
+    now = message_timestamp()
+    message_id = save_private_message(username, to_user, text, on_error=on_save_failed, timestamp=now)
     if not message_id:
         emit("system_message", {"text": "私人消息发送失败，请稍后重试"})
         return
     
-    now = datetime.now()
-    
     # 构建私人消息对象
     msg = {
         "id": message_id,
@@ -1151,12 +1660,9 @@ def handle_private_message(data):
     # 发送给发送者
     emit("private_message", msg)
     
-    # 如果目标用户在线，发送给接收者
-    if to_user in set(online_users.values()):
-        for sid, online_username in online_users.items():
-            if online_username == to_user:
-                emit("private_message", msg, room=sid)
-                break
+    # 如果目标用户在线，发送给接收者的所有会话
+    if presence.is_online(to_user):
+        emit_to_username(to_user, "private_message", msg)
     else:
         # 发送系统消息通知发送者用户不在线，但消息已保存
         emit("system_message", {"text": f"用户 '{to_user}' 不在线，消息已保存"})
@@ -1171,9 +1677,20 @@ def handle_load_private_history(data):
     if not username or not other_user:
         return
     
-    # 加载私人消息历史
-    history = load_private_messages(username, other_user)
-    emit("private_history", {"other_user": other_user, "history": history})
+    # 加载私人消息历史（可带 before_id / after_id 游标翻页）
+    before_id, after_id = parse_cursor(data)
+    history = load_private_messages(
+        username, other_user, PRIVATE_HISTORY_LIMIT + 1, before_id=before_id, after_id=after_id
+    )
+    history, has_more = paginate_history(history, PRIVATE_HISTORY_LIMIT, after_id)
+    emit("private_history", {
+        "other_user": other_user,
+        "format": HISTORY_FORMAT,
+        "history": pack_history(history),
+        "has_more": has_more,
+        "before_id": before_id,
+        "after_id": after_id
+    })
 
 
 # ---------------- 私有聊天室相关Socket.IO事件 ----------------
@@ -1194,13 +1711,11 @@ def handle_create_room_with_type(data):
     if result['success']:
         # 自动加入创建的聊天室
         join_chat_room(username, room_name)
+        cluster.publish("rooms_changed", {})
+        cluster.publish("user_rooms_changed", {"username": username})
         
         # 离开当前房间，加入新房间
-        current_room = user_current_rooms.get(request.sid, 'general')
-        if current_room != room_name:
-            leave_room(current_room)
-            join_room(room_name)
-            user_current_rooms[request.sid] = room_name
+        enter_room(username, room_name)
         
         # 通知所有用户更新聊天室列表（只显示公共聊天室）
         emit("chat_rooms_list", get_chat_rooms_public_only(), broadcast=True)
@@ -1215,8 +1730,7 @@ def handle_create_room_with_type(data):
         )
         
         # 加载新聊天室的历史
-        history = load_chat_history(room_name)
-        emit("room_history", {"room": room_name, "history": history})
+        emit_room_history(room_name)
         
         # 返回创建结果（包括私有聊天室的token）
         emit("room_created", {
@@ -1250,13 +1764,10 @@ def handle_join_room_by_token(data):
     
     if result['success']:
         room_name = result['room_name']
+        cluster.publish("user_rooms_changed", {"username": username})
         
         # 离开当前房间，加入新房间
-        current_room = user_current_rooms.get(request.sid, 'general')
-        if current_room != room_name:
-            leave_room(current_room)
-            join_room(room_name)
-            user_current_rooms[request.sid] = room_name
+        enter_room(username, room_name)
         
         # 更新用户聊天室列表
         emit("user_rooms_list", get_user_rooms(username))
@@ -1270,8 +1781,7 @@ def handle_join_room_by_token(data):
         )
         
         # 加载新聊天室的历史
-        history = load_chat_history(room_name)
-        emit("room_history", {"room": room_name, "history": history})
+        emit_room_history(room_name)
         
         emit("join_by_token_result", {
             "success": True,
@@ -1314,15 +1824,13 @@ def handle_delete_chat_room(data):
     result = delete_chat_room(room_name, username)
     
     if result['success']:
+        cluster.publish("rooms_changed", {"deleted": room_name})
         # 如果当前在这个聊天室，切换到默认聊天室
-        if user_current_rooms.get(request.sid) == room_name:
-            leave_room(room_name)
-            user_current_rooms[request.sid] = 'general'
-            join_room('general')
+        if presence.current_room(request.sid) == room_name:
+            enter_room(username, 'general')
             
             # 加载默认聊天室的历史
-            history = load_chat_history('general')
-            emit("room_history", {"room": 'general', "history": history})
+            emit_room_history('general')
         
         # 通知所有用户更新聊天室列表
         emit("chat_rooms_list", get_chat_rooms_public_only(), broadcast=True)
@@ -1354,11 +1862,16 @@ if __name__ == "__main__":
     cert_path = os.path.join("server", "server_fullchain.crt")
     key_path  = os.path.join("server", "server.key")
 
-    # 8443 只是避免和原来 4433 的原生 TLS 聊天端口冲突
-    socketio.run(
-        app,
-        host="0.0.0.0",
-        port=8443,
-        ssl_context=(cert_path, key_path),
-        allow_unsafe_werkzeug=True,
-    )
+    # 8443 只是避免和原来 4433 的原生 TLS 聊天端口冲突；多进程模式下每个实例用不同端口
+    port = int(os.environ.get("CHAT_WEB_PORT", "8443"))
+
+    if MESSAGE_QUEUE:
+        socketio.start_background_task(prune_presence_forever)
+        atexit.register(presence.retire)
+
+    # 密钥池的补充进程（随本进程退出）和 CRL 的重新加载线程
+    if enrollment is not None:
+        enrollment.start()
+        atexit.register(enrollment.stop)
+
+    run_server(socketio, app, "0.0.0.0", port, cert_path, key_path)
@@ -0,0 +1,308 @@
+# web/cache.py
+"""进程内缓存：热门聊天室的最近历史、聊天室目录、按用户缓存的聊天室/私聊列表"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# 每个聊天室缓存的消息条数、最多缓存多少个聊天室
+ROOM_BUFFER_SIZE = int(os.environ.get('CHAT_HISTORY_BUFFER_SIZE', '100'))
+MAX_CACHED_ROOMS = int(os.environ.get('CHAT_HISTORY_CACHED_ROOMS', '64'))
+
+# 聊天室目录、用户聊天室列表的兜底过期时间（秒），0 表示只靠显式失效；
+# 多个进程共用一个数据库时，其他进程的修改最多延迟这么久可见
+ROOM_CATALOG_TTL = float(os.environ.get('CHAT_ROOM_CATALOG_TTL', '60'))
+USER_CACHE_TTL = float(os.environ.get('CHAT_USER_CACHE_TTL', '60'))
+MAX_CACHED_USERS = int(os.environ.get('CHAT_CACHED_USERS', '10000'))
+
+
+class _RoomBuffer:
+    __slots__ = ('messages', 'loaded', 'complete')
+
+    def __init__(self, capacity):
+        # 已经格式化好、可直接发给客户端的消息字典，按 id 升序
+        self.messages = deque(maxlen=capacity)
+        # 是否已经从数据库加载过；未加载的缓冲只记录最近广播的新消息
+        self.loaded = False
+        # 缓冲中是否包含该聊天室的全部消息
+        self.complete = False
+
+
+class RoomHistoryCache:
+    """按聊天室划分的有界环形缓冲，LRU 淘汰冷门聊天室
+
+    handle_chat_message 把广播出去的消息追加进来；切换/加入聊天室时直接
+    从缓冲返回最近一页，不再查询 SQLite 和逐行格式化时间。
+    消息是异步落盘的，所以未加载的聊天室也会先记下新消息，
+    第一次从数据库加载时与查询结果合并，避免漏掉尚未提交的消息。
+    加载期间发生过 discard/invalidate 的聊天室不写回查询结果，避免把已删除的消息放回缓冲。
+    """
+
+    def __init__(self, capacity=ROOM_BUFFER_SIZE, max_rooms=MAX_CACHED_ROOMS):
+        self.capacity = max(1, capacity)
+        self.max_rooms = max(1, max_rooms)
+        self._rooms = OrderedDict()
+        # 正在加载的聊天室 -> [进行中的加载数, 加载期间的失效次数]，加载全部结束后删除
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def _buffer(self, room_id):
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            buffer = _RoomBuffer(self.capacity)
+            self._rooms[room_id] = buffer
+            while len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+                self._stats['evictions'] += 1
+        self._rooms.move_to_end(room_id)
+        return buffer
+
+    def get(self, room_id, limit):
+        """命中时返回 (最近 limit 条消息, 是否还有更早的消息)，未命中返回 None"""
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if (buffer is None or not buffer.loaded
+                    or (len(buffer.messages) < limit and not buffer.complete)):
+                self._stats['misses'] += 1
+                return None
+            self._rooms.move_to_end(room_id)
+            self._stats['hits'] += 1
+            messages = list(buffer.messages)
+            has_more = len(messages) > limit or not buffer.complete
+            return messages[-limit:], has_more
+
+    def load(self, room_id, limit, loader):
+        """get 未命中时调用 loader()（返回数据库中最近 limit + 1 条消息，升序）并回填缓冲，
+        返回与 get 相同的结果"""
+        cached = self.get(room_id, limit)
+        if cached is not None:
+            return cached
+        with self._lock:
+            loading = self._loading.setdefault(room_id, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+        try:
+            history = loader()
+        except BaseException:
+            with self._lock:
+                self._finish_loading(room_id, loading)
+            raise
+        with self._lock:
+            try:
+                return self._fill(room_id, history, limit, store=generation == loading[1])
+            finally:
+                self._finish_loading(room_id, loading)
+
+    def _finish_loading(self, room_id, loading):
+        loading[0] -= 1
+        if loading[0] == 0:
+            del self._loading[room_id]
+
+    def _fill(self, room_id, history, limit, store):
+        merged = {msg['id']: msg for msg in history}
+        buffer = self._buffer(room_id) if store else self._rooms.get(room_id)
+        # 合并缓冲中已广播、可能尚未提交的消息
+        if buffer is not None:
+            for msg in buffer.messages:
+                merged.setdefault(msg['id'], msg)
+        messages = [merged[message_id] for message_id in sorted(merged)]
+        complete = len(history) <= limit and len(messages) <= self.capacity
+        if store:
+            buffer.complete = complete
+            buffer.messages.clear()
+            buffer.messages.extend(messages[-self.capacity:])
+            buffer.loaded = True
+        has_more = len(messages) > limit or not complete
+        return messages[-limit:], has_more
+
+    def append(self, room_id, message):
+        """追加一条新消息；缓冲满时最旧的消息被挤出"""
+        with self._lock:
+            buffer = self._buffer(room_id)
+            if len(buffer.messages) == buffer.messages.maxlen:
+                buffer.complete = False
+            buffer.messages.append(message)
+
+    def _bump(self, room_id):
+        # 只有正在加载的聊天室需要记下这次失效，其他聊天室没有可能写回的旧结果
+        loading = self._loading.get(room_id)
+        if loading is not None:
+            loading[1] += 1
+
+    def discard(self, room_id, message_id):
+        """从缓冲中移除一条已删除的消息"""
+        with self._lock:
+            self._bump(room_id)
+            buffer = self._rooms.get(room_id)
+            if buffer is None:
+                return
+            for msg in buffer.messages:
+                if msg['id'] == message_id:
+                    buffer.messages.remove(msg)
+                    self._stats['invalidations'] += 1
+                    break
+
+    def invalidate(self, room_id):
+        """丢弃整个聊天室的缓冲（聊天室被删除时）"""
+        with self._lock:
+            self._bump(room_id)
+            if self._rooms.pop(room_id, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['rooms'] = len(self._rooms)
+        lookups = data['hits'] + data['misses']
+        data['hit_rate'] = round(data['hits'] / lookups, 4) if lookups else 0.0
+        return data
+
+
+class RoomCatalog:
+    """chat_rooms 表的进程内副本，按名称索引
+
+    连接建立、加入聊天室时的列表和存在性检查都读这里，不再查询 SQLite；
+    创建/删除聊天室后调用 invalidate()，下次读取时由 loader 重新加载。
+    loader() 返回按 created_at 倒序排列、含 name/created_by/created_at/room_type 的字典列表。
+    """
+
+    def __init__(self, loader, ttl=ROOM_CATALOG_TTL):
+        self._loader = loader
+        self.ttl = ttl
+        self._rooms = None
+        self._by_name = {}
+        self._public = []
+        self._loaded_at = 0.0
+        # 每次失效加一；加载期间发生过失效的结果不写回，避免缓存旧数据
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'loads': 0, 'invalidations': 0}
+
+    def _fresh(self):
+        return self._rooms is not None and (
+            self.ttl <= 0 or time.monotonic() - self._loaded_at < self.ttl)
+
+    def _snapshot(self):
+        with self._lock:
+            if self._fresh():
+                self._stats['hits'] += 1
+                return self._rooms, self._by_name, self._public
+            generation = self._generation
+        rows = self._loader()
+        rooms = [
+            {"name": row["name"], "created_by": row["created_by"], "created_at": row["created_at"]}
+            for row in rows
+        ]
+        by_name = {row["name"]: row for row in rows}
+        public = [room for room, row in zip(rooms, rows) if row["room_type"] == 'public']
+        with self._lock:
+            self._stats['loads'] += 1
+            if generation == self._generation:
+                self._rooms, self._by_name, self._public = rooms, by_name, public
+                self._loaded_at = time.monotonic()
+        return rooms, by_name, public
+
+    def all_rooms(self):
+        return list(self._snapshot()[0])
+
+    def public_rooms(self):
+        return list(self._snapshot()[2])
+
+    def get(self, room_name):
+        """按名称查找聊天室，不存在时返回 None"""
+        room = self._snapshot()[1].get(room_name)
+        return dict(room) if room else None
+
+    def exists(self, room_name):
+        return room_name in self._snapshot()[1]
+
+    def invalidate(self):
+        with self._lock:
+            self._rooms = None
+            self._generation += 1
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['rooms'] = len(self._by_name) if self._rooms is not None else 0
+        return data
+
+
+class KeyedCache:
+    """按键缓存查询结果（如用户加入的聊天室），LRU 淘汰，支持 TTL 兜底和按键失效"""
+
+    def __init__(self, loader, ttl=USER_CACHE_TTL, max_entries=MAX_CACHED_USERS):
+        self._loader = loader
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        # 正在加载的键 -> [进行中的加载数, 加载期间的失效次数]，加载全部结束后删除；
+        # 加上 clear() 的全局计数：加载期间发生过失效的结果不写回
+        self._loading = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """返回 key 对应结果的副本（列表），未命中时调用 loader(key) 加载"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl <= 0 or time.monotonic() - entry[1] < self.ttl):
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return list(entry[0])
+            self._stats['misses'] += 1
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            generation = (self._epoch, loading[1])
+        try:
+            value = self._loader(key)
+        except BaseException:
+            with self._lock:
+                self._finish_loading(key, loading)
+            raise
+        with self._lock:
+            if generation == (self._epoch, loading[1]):
+                self._entries[key] = (value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+            self._finish_loading(key, loading)
+        return list(value)
+
+    def _finish_loading(self, key, loading):
+        loading[0] -= 1
+        if loading[0] == 0:
+            del self._loading[key]
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                # 只有正在加载的键需要记下这次失效，其他键没有可能写回的旧结果
+                loading = self._loading.get(key)
+                if loading is not None:
+                    loading[1] += 1
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['entries'] = len(self._entries)
+        lookups = data['hits'] + data['misses']
+        data['hit_rate'] = round(data['hits'] / lookups, 4) if lookups else 0.0
+        return data
@@ -0,0 +1,259 @@
+# web/cluster.py
+"""多进程模式：多个 web/app.py 实例通过消息队列转发 Socket.IO 事件
+
+    python web/cluster.py --port 7001 &                                   # 本地替身中继
+    CHAT_MESSAGE_QUEUE=local://127.0.0.1:7001 CHAT_WEB_PORT=8443 python web/app.py &
+    CHAT_MESSAGE_QUEUE=local://127.0.0.1:7001 CHAT_WEB_PORT=8444 python web/app.py &
+
+CHAT_MESSAGE_QUEUE 设置后，Flask-SocketIO 把每次 emit 发布到消息队列，各进程再投递给
+自己的客户端，聊天室广播、按用户名推送因此覆盖所有进程。redis:// 等地址使用
+python-socketio 对应的管理器（需要安装对应的客户端库）；local:// 使用本模块的
+LocalQueueManager，连接本模块的中继 QueueBroker，只依赖标准库，用于测试和单机部署。
+两种情况下管理器都混入 ClusterHooks，把其他进程的事件交给 ClusterEvents。
+
+中继连接上的帧：4 字节长度（网络字节序）+ JSON；中继把每一帧原样转发给所有连接（包括发送者）。
+"""
+import argparse
+import asyncio
+import os
+import socket
+import struct
+from urllib.parse import urlparse
+
+import socketio
+from socketio import PubSubManager
+
+MESSAGE_QUEUE = os.environ.get('CHAT_MESSAGE_QUEUE') or None
+QUEUE_CHANNEL = os.environ.get('CHAT_MESSAGE_QUEUE_CHANNEL', 'flask-socketio')
+DEFAULT_QUEUE_PORT = 7001
+# 中继为每个连接最多积压多少帧，超过时断开该连接（读得慢的实例之后重连）
+BROKER_BACKLOG = int(os.environ.get('CHAT_MESSAGE_QUEUE_BACKLOG', '4096'))
+
+# 只在进程之间传递的内部事件使用的 Socket.IO 房间，没有客户端会加入
+# （聊天室名来自用户输入，用 \0 前缀避免重名）
+CLUSTER_ROOM = '\x00cluster'
+
+_LENGTH = struct.Struct('!I')
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('message queue connection closed')
+        data += chunk
+    return bytes(data)
+
+
+class ClusterHooks:
+    """混入 PubSubManager 子类：其他进程发出的 emit 先交给 on_remote_emit，再照常投递
+
+    挂在 _listen 上 —— 这是自定义消息队列管理器本来就要实现的接口；
+    消息在这里解析一次，以字典交给 PubSubManager，不会重复解析。
+    """
+    on_remote_emit = None
+
+    def _listen(self):
+        for message in super()._listen():
+            if not isinstance(message, dict):
+                try:
+                    message = self.json.loads(message)
+                except ValueError:
+                    continue
+            if (self.on_remote_emit is not None and message.get('method') == 'emit'
+                    and message.get('host_id') != self.host_id):
+                self.on_remote_emit(message)
+            yield message
+
+
+class LocalQueueManager(PubSubManager):
+    """连接 QueueBroker 的 Socket.IO 客户端管理器（local://host:port）
+
+    发布的消息先放进队列，由单独的后台任务写出：协程模式下多个协程同时 emit 时
+    不需要在套接字上加锁。中继断开时接收任务每秒重连一次，断开期间发布的消息被丢弃。
+    """
+    name = 'local'
+
+    def __init__(self, url, channel=QUEUE_CHANNEL, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or '127.0.0.1', parsed.port or DEFAULT_QUEUE_PORT)
+        self._sock = None
+        self._outbox = None
+
+    def initialize(self):
+        self._outbox = self.server.eio.create_queue()
+        super().initialize()
+        self.server.start_background_task(self._send_forever)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _publish(self, data):
+        body = self.json.dumps(data).encode('utf-8')
+        self._outbox.put(_LENGTH.pack(len(body)) + body)
+
+    def _send_forever(self):
+        while True:
+            frame = self._outbox.get()
+            sock = self._sock
+            if sock is None:
+                self._get_logger().error('Message queue is not connected, message dropped')
+                continue
+            try:
+                sock.sendall(frame)
+            except OSError as e:
+                self._get_logger().error(f'Cannot publish to message queue: {e}')
+
+    def _listen(self):
+        while True:
+            try:
+                self._sock = self._connect()
+                while True:
+                    length, = _LENGTH.unpack(_recv_exactly(self._sock, _LENGTH.size))
+                    yield _recv_exactly(self._sock, length)
+            except OSError as e:
+                self._get_logger().error(f'Cannot receive from message queue, retrying in 1 sec: {e}')
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+                self.server.sleep(1)
+
+
+def _manager_class(url):
+    """与 Flask-SocketIO 相同的按地址选择管理器，混入 ClusterHooks"""
+    if url.startswith('local://'):
+        base = LocalQueueManager
+    elif url.startswith(('redis://', 'rediss://')):
+        base = socketio.RedisManager
+    elif url.startswith('kafka://'):
+        base = socketio.KafkaManager
+    elif url.startswith('zmq'):
+        base = socketio.ZmqManager
+    else:
+        base = socketio.KombuManager
+    return type(f'Cluster{base.__name__}', (ClusterHooks, base), {})
+
+
+def socketio_options(url=MESSAGE_QUEUE, channel=QUEUE_CHANNEL):
+    """按消息队列地址生成 SocketIO(...) 的参数；未设置时为单进程模式"""
+    if not url:
+        return {}
+    return {'client_manager': _manager_class(url)(url, channel=channel)}
+
+
+class ClusterEvents:
+    """进程之间的内部通知，随 Socket.IO 事件一起经消息队列转发
+
+    on(event, handler) 注册的 handler(room, payload) 在其他进程发出同名事件时调用：
+    既包括发给客户端的事件（例如聊天室广播，用来同步本进程的缓存），
+    也包括 publish() 发往 CLUSTER_ROOM、不会投递给任何客户端的内部事件。
+    单进程模式下 publish() 什么也不做。
+    """
+
+    def __init__(self, socketio):
+        self.socketio = socketio
+        self._handlers = {}
+        manager = socketio.server.manager
+        # 管理器由 socketio_options() 创建
+        self.enabled = isinstance(manager, ClusterHooks)
+        if self.enabled:
+            manager.on_remote_emit = self._dispatch
+
+    def _dispatch(self, message):
+        handler = self._handlers.get(message.get('event'))
+        if handler is None:
+            return
+        data = message.get('data') or [None]
+        try:
+            handler(message.get('room'), data[0])
+        except Exception as e:
+            print(f"[!] 处理其他进程的事件 {message.get('event')} 失败: {e}")
+
+    def on(self, event, handler):
+        self._handlers[event] = handler
+
+    def publish(self, event, payload):
+        if self.enabled:
+            self.socketio.emit(event, payload, to=CLUSTER_ROOM)
+
+
+class QueueBroker:
+    """local:// 消息队列的中继：把收到的每一帧转发给所有连接
+
+    同 server/fanout.py：每个连接一个有界发送队列和写协程（写完 drain），
+    转发只是把同一个 bytes 放进各个队列；队列满（实例读得太慢）时断开该连接，
+    中继内存不会因为一个卡住的实例无限增长，被断开的实例一秒后重连。
+    """
+
+    def __init__(self, backlog=BROKER_BACKLOG):
+        self.backlog = max(1, backlog)
+        # writer -> 发送队列
+        self.clients = {}
+        self.relayed = 0
+        self.evicted = 0
+
+    async def _write_loop(self, writer, queue):
+        try:
+            while True:
+                writer.write(await queue.get())
+                while not queue.empty():
+                    writer.write(queue.get_nowait())
+                await writer.drain()
+        except ConnectionError:
+            writer.transport.abort()
+
+    def _evict(self, writer):
+        if self.clients.pop(writer, None) is None:
+            return
+        self.evicted += 1
+        print(f"[!] Message queue client {writer.get_extra_info('peername')} is too slow "
+              f"(backlog {self.backlog}), disconnecting")
+        writer.transport.abort()
+
+    async def handle_client(self, reader, writer):
+        queue = self.clients[writer] = asyncio.Queue(self.backlog)
+        sender = asyncio.create_task(self._write_loop(writer, queue))
+        try:
+            while True:
+                header = await reader.readexactly(_LENGTH.size)
+                length, = _LENGTH.unpack(header)
+                frame = header + await reader.readexactly(length)
+                self.relayed += 1
+                for client, client_queue in list(self.clients.items()):
+                    try:
+                        client_queue.put_nowait(frame)
+                    except asyncio.QueueFull:
+                        self._evict(client)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            sender.cancel()
+            writer.close()
+
+
+async def serve_broker(host, port):
+    broker = QueueBroker()
+    server = await asyncio.start_server(broker.handle_client, host, port)
+    print(f"[*] Message queue broker listening on local://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="web/app.py 多进程模式的本地消息队列中继")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_QUEUE_PORT)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve_broker(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
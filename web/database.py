@@ -0,0 +1,461 @@
+# web/database.py
+"""SQLite 连接层：为每个数据库文件维护一组长连接，所有数据函数共享；
+写操作统一交给单独的写线程串行执行"""
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+USERS_DB_PATH = './web/db/users.db'
+CHAT_DB_PATH = './web/db/chat_messages.db'
+
+# 连接池参数，可通过环境变量调整
+POOL_SIZE = int(os.environ.get('CHAT_DB_POOL_SIZE', '8'))
+POOL_TIMEOUT = float(os.environ.get('CHAT_DB_POOL_TIMEOUT', '5'))
+HEALTH_CHECK_INTERVAL = float(os.environ.get('CHAT_DB_HEALTH_CHECK_INTERVAL', '30'))
+# 每个连接缓存的预编译语句数量（sqlite3 模块按 SQL 文本缓存 prepared statement）
+STATEMENT_CACHE_SIZE = 256
+
+# 每个连接建立时设置的 PRAGMA（journal_mode=WAL 是持久化的，在 init_db 中设置一次即可）
+BUSY_TIMEOUT_MS = int(os.environ.get('CHAT_DB_BUSY_TIMEOUT_MS', '5000'))
+CACHE_SIZE_KIB = int(os.environ.get('CHAT_DB_CACHE_SIZE_KIB', '16384'))
+MMAP_SIZE = int(os.environ.get('CHAT_DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+CONNECTION_PRAGMAS = (
+    f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}',
+    # WAL 模式下 NORMAL 只在 checkpoint 时 fsync，事务仍然是原子的
+    'PRAGMA synchronous = NORMAL',
+    # 负数表示以 KiB 为单位
+    f'PRAGMA cache_size = -{CACHE_SIZE_KIB}',
+    f'PRAGMA mmap_size = {MMAP_SIZE}',
+    'PRAGMA temp_store = MEMORY',
+)
+
+
+# 写线程组提交参数：最多等待多少秒、一个事务最多包含多少个任务
+WRITE_BATCH_DELAY = float(os.environ.get('CHAT_DB_BATCH_DELAY_MS', '5')) / 1000
+WRITE_BATCH_MAX = int(os.environ.get('CHAT_DB_BATCH_MAX', '256'))
+# 每次从 sqlite_sequence 预留的消息ID数量
+ID_BLOCK_SIZE = int(os.environ.get('CHAT_DB_ID_BLOCK_SIZE', '1000'))
+
+
+# 语句跟踪回调（查询计划检查用），只对设置之后新建的连接生效
+_trace_callback = None
+
+
+def set_trace_callback(callback):
+    """设置 SQL 语句跟踪回调 callback(sql)，传 None 取消"""
+    global _trace_callback
+    _trace_callback = callback
+
+
+def _dispatch_trace(sql):
+    callback = _trace_callback
+    if callback is not None:
+        callback(sql)
+
+
+def configure_connection(conn):
+    """为新连接设置性能相关的 PRAGMA"""
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    if _trace_callback is not None:
+        conn.set_trace_callback(_dispatch_trace)
+    return conn
+
+
+def enable_wal(conn):
+    """把数据库切换为 WAL 日志模式，读写互不阻塞"""
+    mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+    if mode.lower() != 'wal':
+        print(f"[!] 无法启用 WAL 模式，当前为: {mode}")
+    return mode
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """等待空闲连接超时"""
+
+
+class ConnectionPool:
+    """线程安全的 SQLite 连接池
+
+    连接在线程之间借出/归还（check_same_thread=False），同一时刻只会被一个线程使用。
+    空闲连接按后进先出复用，让最近用过的连接（及其语句缓存）保持热度。
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        # 元素为 (conn, 上次归还时间)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {
+            'acquired': 0,
+            'waited': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        configure_connection(conn)
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """借出一个连接；池满时阻塞等待，超时抛出 PoolTimeout"""
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    can_create = True
+                else:
+                    can_create = False
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+                last_used = time.monotonic()
+            else:
+                started = time.monotonic()
+                try:
+                    conn, last_used = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['waited'] += 1
+                        self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'等待数据库连接超时: {self.db_path}')
+                with self._lock:
+                    self._stats['waited'] += 1
+                    self._stats['wait_time'] += time.monotonic() - started
+
+        # 空闲太久的连接先做健康检查，失效则重建
+        if time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(conn):
+            self._discard(conn)
+            with self._lock:
+                self._created += 1
+                self._stats['recycled'] += 1
+            conn = self._connect()
+
+        with self._lock:
+            self._stats['acquired'] += 1
+        return conn
+
+    def release(self, conn):
+        """归还连接；未提交的事务会被回滚"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as conn: ..."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        """返回连接池的统计信息"""
+        with self._lock:
+            data = dict(self._stats)
+            data['open'] = self._created
+        data['idle'] = self._idle.qsize()
+        data['size'] = self.size
+        return data
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+class _WriteJob:
+    """写线程队列中的一个任务：要么是可调用对象，要么是一行 INSERT"""
+    __slots__ = ('fn', 'args', 'kwargs', 'sql', 'params', 'future')
+
+    def __init__(self, fn=None, args=(), kwargs=None, sql=None, params=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.sql = sql
+        self.params = params
+        self.future = Future()
+
+
+class DatabaseWriter:
+    """单写线程：独占一个连接，串行执行所有 INSERT/UPDATE/DELETE
+
+    SQLite 同一时刻只允许一个写事务。把写操作集中到一个线程后，
+    请求线程之间不再争抢写锁，读操作（WAL 模式）也不会被写操作阻塞。
+
+    写线程做组提交（group commit）：收到一条 INSERT 后最多再等待 batch_delay 秒
+    或凑满 max_batch 个任务，然后在同一个事务里执行、一次提交。
+    相邻的同一条 INSERT 语句合并为 executemany；每个任务用 SAVEPOINT 隔离，
+    单个任务失败只回滚它自己。Future 在事务提交后才完成，即"已落盘"的确认。
+    """
+
+    def __init__(self, db_path, max_batch=WRITE_BATCH_MAX, batch_delay=WRITE_BATCH_DELAY):
+        self.db_path = db_path
+        self.max_batch = max(1, max_batch)
+        self.batch_delay = batch_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats = {
+            'jobs': 0,
+            'failed': 0,
+            'transactions': 0,
+            'batched_rows': 0,
+            'largest_batch': 0,
+        }
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f'db-writer:{os.path.basename(self.db_path)}', daemon=True
+                )
+                self._thread.start()
+
+    def _put(self, job):
+        self.start()
+        self._queue.put(job)
+        return job.future
+
+    def submit(self, fn, *args, **kwargs):
+        """提交写任务 fn(conn, *args, **kwargs)，返回 Future（事务提交后完成）"""
+        return self._put(_WriteJob(fn=fn, args=args, kwargs=kwargs))
+
+    def submit_insert(self, sql, params):
+        """提交一行 INSERT，返回 Future；同一批次内相同的 SQL 会用 executemany 合并执行"""
+        return self._put(_WriteJob(sql=sql, params=params))
+
+    def execute(self, fn, *args, **kwargs):
+        """提交写任务并等待结果；任务抛出的异常会在调用方重新抛出"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def stop(self, timeout=5):
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def stats(self):
+        data = dict(self._stats)
+        data['pending'] = self._queue.qsize()
+        return data
+
+    def _collect(self):
+        """阻塞等待第一个任务，再收集同一批次的其他任务
+
+        第一个任务是 INSERT 时在 batch_delay 窗口内继续等待更多任务；
+        普通写任务通常有调用方在同步等待，只取走已经积压的部分，不额外等待。
+        """
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + (self.batch_delay if first.sql is not None else 0)
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            isolation_level=None,
+        )
+        configure_connection(conn)
+        try:
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    break
+                self._run_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _run_inserts(self, conn, jobs):
+        """用 executemany 执行一组相同的 INSERT；整体失败时逐行重试以定位坏行"""
+        conn.execute('SAVEPOINT job')
+        try:
+            conn.executemany(jobs[0].sql, [job.params for job in jobs])
+            conn.execute('RELEASE job')
+            self._stats['batched_rows'] += len(jobs)
+            return [(job.future, None, None) for job in jobs]
+        except Exception:
+            conn.execute('ROLLBACK TO job')
+            conn.execute('RELEASE job')
+        return [self._run_job(conn, job) for job in jobs]
+
+    def _run_job(self, conn, job):
+        conn.execute('SAVEPOINT job')
+        try:
+            if job.sql is not None:
+                conn.execute(job.sql, job.params)
+                result = None
+            else:
+                result = job.fn(conn, *job.args, **job.kwargs)
+            conn.execute('RELEASE job')
+            return job.future, result, None
+        except Exception as e:
+            conn.execute('ROLLBACK TO job')
+            conn.execute('RELEASE job')
+            return job.future, None, e
+
+    def _run_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            i = 0
+            while i < len(batch):
+                job = batch[i]
+                if job.sql is None:
+                    results.append(self._run_job(conn, job))
+                    i += 1
+                    continue
+                j = i + 1
+                while j < len(batch) and batch[j].sql == job.sql:
+                    j += 1
+                results.extend(self._run_inserts(conn, batch[i:j]))
+                i = j
+            conn.execute('COMMIT')
+        except Exception as e:
+            # 提交失败：整个批次都没有落盘
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            print(f"[!] 数据库写事务失败: {e}")
+            results = [(job.future, None, e) for job in batch]
+
+        self._stats['transactions'] += 1
+        self._stats['largest_batch'] = max(self._stats['largest_batch'], len(batch))
+        for future, result, error in results:
+            self._stats['jobs'] += 1
+            if error is not None:
+                self._stats['failed'] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class IdAllocator:
+    """预先分配 AUTOINCREMENT 表的主键，让消息在落盘前就拥有ID
+
+    每次在 sqlite_sequence 中原子地预留一段ID（BEGIN IMMEDIATE 事务），
+    之后在进程内递增分配。多个进程共享同一数据库文件时各自预留不同的区间，
+    不会冲突，但ID不再跨进程按时间递增，所以多实例部署不使用它，
+    而是由写线程在事务里插入、让 SQLite 分配ID（见 app.py 的 _insert_committed）；
+    进程重启只会在ID序列中留下空洞。
+    """
+
+    def __init__(self, db_path, block_size=ID_BLOCK_SIZE):
+        self.db_path = db_path
+        self.block_size = max(1, block_size)
+        self._lock = threading.Lock()
+        # table -> [下一个可用ID, 区间上界（含）]
+        self._ranges = {}
+
+    def _reserve(self, table):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            configure_connection(conn)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+                max_id = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                start = max(row[0] if row else 0, max_id) + 1
+                end = start + self.block_size - 1
+                if row:
+                    conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (end, table))
+                else:
+                    conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, end))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return [start, end]
+
+    def next_id(self, table):
+        with self._lock:
+            current = self._ranges.get(table)
+            if current is None or current[0] > current[1]:
+                current = self._reserve(table)
+                self._ranges[table] = current
+            value = current[0]
+            current[0] += 1
+            return value
+
+
+users_pool = ConnectionPool(USERS_DB_PATH)
+chat_pool = ConnectionPool(CHAT_DB_PATH)
+chat_writer = DatabaseWriter(CHAT_DB_PATH)
+chat_ids = IdAllocator(CHAT_DB_PATH)
+atexit.register(chat_writer.stop)
+
+
+def pool_stats():
+    """汇总数据库连接池和写线程的统计信息"""
+    return {
+        'users': users_pool.stats(),
+        'chat': chat_pool.stats(),
+        'chat_writer': chat_writer.stats(),
+    }
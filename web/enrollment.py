@@ -0,0 +1,114 @@
+# web/enrollment.py
+"""注册时为用户签发自己的客户端证书（CN=用户名），代替所有人共用的 client/client.crt
+
+私钥从密钥池（pki/keypool.py）取现成的，证书由进程内的签发 CA（pki/issuer.py）签名，
+注册请求只多花几毫秒。私钥用用户的登录密码加密（PKCS#8），和证书、签发 CA 证书一起
+拼成一个 PEM 文件存入 users.db，用户在仪表盘下载后可以直接交给 ssl.load_cert_chain。
+同一个签发 CA 还作为 OCSP 响应器（pki/ocsp.py，每个序列号的响应预签后缓存）挂在 /ocsp 上。
+证书被吊销（python pki/crl.py revoke）后，仪表盘按已发布的 CRL（pki/crl.py 的 RevocationIndex，
+CRL 更新后自动重新加载）显示"已吊销"，不再提供下载。
+
+    CHAT_ENROLL_CERTS=1         开启（默认关闭：每次注册都会改写 ca/issuing 下的 serial、index.txt
+                                和 newcerts/；没有 cryptography 或 CA 私钥时自动关闭）
+    CHAT_KEYPOOL_SECRET=<口令>   密钥池的加密口令，开启时必须设置并且每次启动相同，
+                                否则上次启动留下的私钥解不开，整个池子都要重新生成
+"""
+import os
+import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pki.certdb import normalize_serial
+
+ENROLL_CERTS = os.environ.get('CHAT_ENROLL_CERTS', '0') == '1'
+# 用户名直接作为证书 CN，只签字母、数字（含中文）、下划线、点和连字符组成的
+ENROLL_USERNAME = re.compile(r'[\w.-]{1,64}')
+
+
+class EnrollmentError(ValueError):
+    """用户名不能作为证书的 CN"""
+
+
+class Enrollment:
+    """密钥池 + 签发 CA"""
+
+    def __init__(self, issuer, pool, revocation=None, ocsp=None):
+        self.issuer = issuer
+        self.pool = pool
+        self.revocation = revocation
+        self.ocsp = ocsp
+        if revocation is not None and ocsp is not None:
+            # 发布新 CRL（吊销）后丢弃缓存的 OCSP 响应
+            revocation.add_listener(ocsp.clear)
+        from cryptography.hazmat.primitives import serialization
+        self._serialization = serialization
+        self._chain = issuer.ca_cert.public_bytes(serialization.Encoding.PEM)
+
+    def enroll(self, username, password):
+        """签发证书，返回 (序列号, 到期时间, PEM 文件内容)
+
+        用户名不符合 ENROLL_USERNAME 时抛出 EnrollmentError，CN 已有有效证书时抛出 IssuanceError。
+        """
+        if not ENROLL_USERNAME.fullmatch(username):
+            raise EnrollmentError(f"username not allowed as certificate CN: {username!r}")
+        serialization = self._serialization
+        key = self.pool.take()
+        cert = self.issuer.issue_one((username, key.public_key()))
+        bundle = (
+            key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                              serialization.BestAvailableEncryption(password.encode('utf-8')))
+            + cert.public_bytes(serialization.Encoding.PEM)
+            + self._chain
+        )
+        return normalize_serial(cert.serial_number), cert.not_valid_after_utc.strftime('%Y-%m-%d %H:%M:%S'), bundle
+
+    def is_revoked(self, serial):
+        return self.revocation is not None and self.revocation.is_revoked(serial)
+
+    def start(self):
+        self.pool.start_refiller()
+        if self.revocation is not None:
+            self.revocation.start()
+
+    def stop(self):
+        self.pool.stop_refiller()
+        if self.revocation is not None:
+            self.revocation.stop()
+
+    def stats(self):
+        return self.pool.stats()
+
+    def revocation_stats(self):
+        return self.revocation.stats() if self.revocation is not None else None
+
+    def ocsp_response(self, request_der):
+        """OCSP 请求（DER） -> 响应（DER）"""
+        return self.ocsp.respond(request_der)
+
+    def ocsp_stats(self):
+        return self.ocsp.stats() if self.ocsp is not None else None
+
+
+def create_enrollment():
+    """按配置创建 Enrollment；关闭或依赖不可用时返回 None（注册照常进行，只是不签发证书）"""
+    if not ENROLL_CERTS:
+        return None
+    if not os.environ.get('CHAT_KEYPOOL_SECRET'):
+        print("[!] 注册时不签发客户端证书：CHAT_ENROLL_CERTS=1 时必须设置 CHAT_KEYPOOL_SECRET")
+        return None
+    try:
+        from pki.crl import RevocationIndex
+        from pki.issuer import CLIENT_PROFILE, Issuer
+        from pki.keypool import KeyPool, KEYPOOL_SECRET
+        from pki.ocsp import OcspResponder
+    except ImportError as e:
+        print(f"[!] 注册时不签发客户端证书（需要 pip install cryptography）: {e}")
+        return None
+    try:
+        # 只含 clientAuth：用户名是用户自己选的，证书不能拿去冒充服务器
+        issuer = Issuer(profile=CLIENT_PROFILE)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"[!] 注册时不签发客户端证书（无法加载签发 CA）: {e}")
+        return None
+    return Enrollment(issuer, KeyPool(secret=KEYPOOL_SECRET), RevocationIndex(),
+                      OcspResponder(issuer))
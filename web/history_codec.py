@@ -0,0 +1,109 @@
+# web/history_codec.py
+"""历史消息的列式编码：room_history / private_history 事件中的 history 字段
+
+逐条的字典在每个元素里重复 id、user、text、time、timestamp、room、type 等键，
+其中 time 可以从 timestamp 推出，room、type、partner 对整页都相同，私聊的 direction
+由发送者是不是当前用户推出。列式编码按字段拆成数组：
+    id       第一条的 ID，之后是与前一条的差值（同一聊天室的 ID 大多连续，差值是很短的整数）
+    users    本页出现过的用户名（去重），user 列是其中的下标
+    text     正文
+    t0, ts   第一条的时间戳，之后每条与前一条相差的秒数；
+             有无法解析的时间戳时改为 timestamp 列，原样保存字符串
+客户端（static/js/history.js 的 decodeHistory）把它还原成原来的字典，页面其余代码不变。
+CHAT_HISTORY_FORMAT=rows 时仍发送逐条字典，便于对比和兼容旧客户端。
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+HISTORY_FORMATS = ('columns', 'rows')
+HISTORY_FORMAT = os.environ.get('CHAT_HISTORY_FORMAT', 'columns')
+if HISTORY_FORMAT not in HISTORY_FORMATS:
+    raise ValueError(f"unknown CHAT_HISTORY_FORMAT: {HISTORY_FORMAT}")
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# 时间戳按不带时区的时间做加减，不经过本地时区（避免夏令时切换处的误差）
+_EPOCH = datetime(1970, 1, 1)
+
+
+class CompactJSON:
+    """Socket.IO 使用的 JSON 模块：中文等非 ASCII 字符直接以 UTF-8 输出（3 字节），
+    不转义成 \\uXXXX（6 字节）"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        kwargs.setdefault('ensure_ascii', False)
+        return json.dumps(obj, **kwargs)
+
+    loads = staticmethod(json.loads)
+
+
+def encode_history(messages):
+    """把按 id 升序的消息字典列表编码成列式结构"""
+    ids = []
+    users = {}
+    user_column = []
+    texts = []
+    previous = 0
+    for msg in messages:
+        ids.append(msg['id'] - previous)
+        previous = msg['id']
+        user_column.append(users.setdefault(msg['user'], len(users)))
+        texts.append(msg['text'])
+    columns = {'id': ids, 'users': list(users), 'user': user_column, 'text': texts}
+    columns.update(_encode_timestamps([msg['timestamp'] for msg in messages]))
+    return columns
+
+
+def _parse_timestamp(value):
+    # fromisoformat 是 C 实现，比 strptime 快一个数量级；长度检查排除带小数秒、时区的写法
+    if len(value) != 19:
+        raise ValueError(value)
+    return datetime.fromisoformat(value)
+
+
+def _encode_timestamps(values):
+    try:
+        seconds = [int((_parse_timestamp(value) - _EPOCH).total_seconds()) for value in values]
+    except (TypeError, ValueError):
+        return {'timestamp': values}
+    deltas = [b - a for a, b in zip([seconds[0]] + seconds, seconds)] if seconds else []
+    return {'t0': values[0] if values else None, 'ts': deltas}
+
+
+def _display_time(timestamp):
+    # 与 format_timestamp_parts 一致：展示时间是时间戳中空格之后的部分
+    return timestamp.split(' ')[-1]
+
+
+def decode_history(columns, **fields):
+    """encode_history 的逆过程；fields 是整页相同、没有编码进去的字段（如 room、type）"""
+    if 'timestamp' in columns:
+        timestamps = columns['timestamp']
+    else:
+        timestamps = []
+        current = _parse_timestamp(columns['t0']) if columns['ts'] else None
+        for delta in columns['ts']:
+            current += timedelta(seconds=delta)
+            timestamps.append(current.strftime(TIMESTAMP_FORMAT))
+    messages = []
+    message_id = 0
+    for delta, user, text, timestamp in zip(columns['id'], columns['user'], columns['text'], timestamps):
+        message_id += delta
+        msg = {
+            'id': message_id,
+            'user': columns['users'][user],
+            'text': text,
+            'time': _display_time(timestamp),
+            'timestamp': timestamp,
+        }
+        msg.update(fields)
+        messages.append(msg)
+    return messages
+
+
+def pack_history(messages):
+    """按 CHAT_HISTORY_FORMAT 生成事件中的 history 字段"""
+    if HISTORY_FORMAT == 'columns':
+        return encode_history(messages)
+    return messages
@@ -0,0 +1,346 @@
+# web/presence.py
+"""在线状态：Socket.IO 会话与用户名之间的双向索引，以及按聊天室合并推送的上下线增量"""
+import bisect
+import os
+import socket
+import threading
+import time
+import uuid
+
+# 上下线增量的合并窗口（毫秒）：窗口内每个聊天室的进出合并成一条事件
+PRESENCE_DEBOUNCE_MS = int(os.environ.get('CHAT_PRESENCE_DEBOUNCE_MS', '250'))
+# 多进程模式：每个进程的心跳间隔（秒）；超过 3 个间隔没有心跳的进程视为已退出
+PRESENCE_HEARTBEAT_INTERVAL = float(os.environ.get('CHAT_PRESENCE_HEARTBEAT', '10'))
+
+
+class PresenceRegistry:
+    """记录 sid -> username，并维护 username -> {sid} 的反向索引
+
+    私聊投递、按用户名推送事件只需查反向索引，不再遍历全部连接；
+    在线用户列表在用户第一个会话上线、最后一个会话下线时用 bisect 增量维护，
+    广播在线列表时无需每次去重排序。
+
+    同时记录每个会话当前所在的聊天室和每个聊天室的在线成员
+    （room -> {username: 会话数}），用于按聊天室推送在线成员。
+    """
+
+    def __init__(self, default_room='general'):
+        self.default_room = default_room
+        self._users = {}
+        self._sessions = {}
+        self._online = []
+        self._rooms = {}
+        self._room_members = {}
+        self._lock = threading.Lock()
+
+    def add(self, sid, username, room=None):
+        """登记一个会话并进入 room，返回 (该用户是否刚刚上线, 是否刚进入该聊天室)"""
+        room = room or self.default_room
+        with self._lock:
+            if sid in self._users:
+                self._remove_locked(sid)
+            self._users[sid] = username
+            sessions = self._sessions.get(username)
+            came_online = sessions is None
+            if came_online:
+                self._sessions[username] = {sid}
+                bisect.insort(self._online, username)
+            else:
+                sessions.add(sid)
+            return came_online, self._enter_room_locked(sid, username, room)
+
+    def remove(self, sid):
+        """注销一个会话，返回 (username, 所在聊天室, 是否已完全下线, 是否已离开该聊天室)
+
+        未登记的 sid 返回 (None, None, False, False)。
+        """
+        with self._lock:
+            if sid not in self._users:
+                return None, None, False, False
+            return self._remove_locked(sid)
+
+    def _remove_locked(self, sid):
+        username = self._users.pop(sid)
+        room = self._rooms.get(sid)
+        left_room = self._leave_room_locked(sid, username)
+        went_offline = False
+        sessions = self._sessions.get(username)
+        if sessions is not None:
+            sessions.discard(sid)
+            if not sessions:
+                del self._sessions[username]
+                index = bisect.bisect_left(self._online, username)
+                if index < len(self._online) and self._online[index] == username:
+                    del self._online[index]
+                went_offline = True
+        return username, room, went_offline, left_room
+
+    def _enter_room_locked(self, sid, username, room):
+        self._rooms[sid] = room
+        members = self._room_members.setdefault(room, {})
+        members[username] = members.get(username, 0) + 1
+        return members[username] == 1
+
+    def _leave_room_locked(self, sid, username):
+        room = self._rooms.pop(sid, None)
+        members = self._room_members.get(room)
+        if not members or username not in members:
+            return False
+        members[username] -= 1
+        if members[username] > 0:
+            return False
+        del members[username]
+        if not members:
+            del self._room_members[room]
+        return True
+
+    def move(self, sid, room):
+        """把会话切换到另一个聊天室，返回 (原聊天室, 是否已离开原聊天室, 是否刚进入新聊天室)
+
+        会话未登记或已经在 room 中时返回 (room, False, False)。
+        """
+        with self._lock:
+            username = self._users.get(sid)
+            old_room = self._rooms.get(sid)
+            if username is None or old_room == room:
+                return room, False, False
+            left_old = self._leave_room_locked(sid, username)
+            return old_room, left_old, self._enter_room_locked(sid, username, room)
+
+    def current_room(self, sid):
+        with self._lock:
+            return self._rooms.get(sid, self.default_room)
+
+    def room_members(self, room):
+        """聊天室中在线的用户名（排序后）"""
+        with self._lock:
+            return sorted(self._room_members.get(room, ()))
+
+    def username(self, sid):
+        with self._lock:
+            return self._users.get(sid)
+
+    def sessions(self, username):
+        """该用户当前所有会话的 sid 列表（副本，可在锁外遍历）"""
+        with self._lock:
+            return list(self._sessions.get(username, ()))
+
+    def is_online(self, username):
+        with self._lock:
+            return username in self._sessions
+
+    def online_users(self):
+        """按用户名排序的在线用户列表"""
+        with self._lock:
+            return list(self._online)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._users),
+                'users': len(self._sessions),
+                'rooms': len(self._room_members),
+            }
+
+
+class SharedPresenceRegistry:
+    """多进程模式的在线状态：与 PresenceRegistry 接口相同，成员关系存放在共享的 SQLite 表中
+
+    本进程的会话仍然记在一个 PresenceRegistry 里（current_room、username 只涉及本进程的 sid）；
+    每个会话同时写入 presence_sessions 表（schema.py 迁移 3），上线/下线、进入/离开聊天室
+    按所有进程的会话判断，room_members、is_online、online_users 查询全局结果。
+    写操作交给写线程，在 BEGIN IMMEDIATE 事务里先写后数，多个进程同时进出同一聊天室时
+    只有一个会得到"刚进入"/"已离开"。sessions() 只返回本进程的会话，跨进程推送用 Socket.IO 房间。
+
+    每个进程定期调用 heartbeat()：刷新 presence_nodes 中自己的时间戳，并清理超时进程留下的会话。
+    数据库调用经过 offload，协程模式下不阻塞事件循环。
+    """
+
+    def __init__(self, writer, pool, default_room='general', offload=None,
+                 heartbeat_interval=PRESENCE_HEARTBEAT_INTERVAL):
+        self.default_room = default_room
+        self.node_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.heartbeat_interval = heartbeat_interval
+        self._writer = writer
+        self._pool = pool
+        self._offload = offload or (lambda fn, *args: fn(*args))
+        self._local = PresenceRegistry(default_room)
+
+    def _write(self, fn, *args):
+        return self._offload(self._writer.execute, fn, *args)
+
+    def _query(self, sql, params=()):
+        def run():
+            with self._pool.connection() as conn:
+                return conn.execute(sql, params).fetchall()
+        return self._offload(run)
+
+    @staticmethod
+    def _count(conn, username, room=None):
+        if room is None:
+            sql, params = 'SELECT COUNT(*) FROM presence_sessions WHERE username = ?', (username,)
+        else:
+            sql, params = 'SELECT COUNT(*) FROM presence_sessions WHERE username = ? AND room = ?', (username, room)
+        return conn.execute(sql, params).fetchone()[0]
+
+    def add(self, sid, username, room=None):
+        room = room or self.default_room
+        if self._local.username(sid) is not None:
+            self.remove(sid)
+        self._local.add(sid, username, room)
+
+        def insert(conn):
+            conn.execute('INSERT INTO presence_sessions (node, sid, username, room) VALUES (?, ?, ?, ?)',
+                         (self.node_id, sid, username, room))
+            return self._count(conn, username) == 1, self._count(conn, username, room) == 1
+
+        return self._write(insert)
+
+    def remove(self, sid):
+        username, room, _, _ = self._local.remove(sid)
+        if username is None:
+            return None, None, False, False
+
+        def delete(conn):
+            conn.execute('DELETE FROM presence_sessions WHERE node = ? AND sid = ?', (self.node_id, sid))
+            return self._count(conn, username) == 0, self._count(conn, username, room) == 0
+
+        went_offline, left_room = self._write(delete)
+        return username, room, went_offline, left_room
+
+    def move(self, sid, room):
+        username = self._local.username(sid)
+        old_room, _, _ = self._local.move(sid, room)
+        if username is None or old_room == room:
+            return room, False, False
+
+        def update(conn):
+            conn.execute('UPDATE presence_sessions SET room = ? WHERE node = ? AND sid = ?',
+                         (room, self.node_id, sid))
+            return self._count(conn, username, old_room) == 0, self._count(conn, username, room) == 1
+
+        left_old, joined_new = self._write(update)
+        return old_room, left_old, joined_new
+
+    def heartbeat(self):
+        """刷新本进程的心跳并清理超时进程的会话，返回因此离开聊天室的 (room, username) 列表"""
+        return self._write(self._heartbeat, time.time())
+
+    def _heartbeat(self, conn, now):
+        conn.execute('INSERT INTO presence_nodes (node, seen) VALUES (?, ?) '
+                     'ON CONFLICT (node) DO UPDATE SET seen = excluded.seen', (self.node_id, now))
+        expired = [row[0] for row in conn.execute(
+            'SELECT node FROM presence_nodes WHERE seen < ?', (now - 3 * self.heartbeat_interval,))]
+        left = []
+        for node in expired:
+            rows = conn.execute('SELECT DISTINCT username, room FROM presence_sessions WHERE node = ?',
+                                (node,)).fetchall()
+            conn.execute('DELETE FROM presence_sessions WHERE node = ?', (node,))
+            conn.execute('DELETE FROM presence_nodes WHERE node = ?', (node,))
+            left.extend((room, username) for username, room in rows
+                        if self._count(conn, username, room) == 0)
+        return left
+
+    def retire(self):
+        """进程退出时把心跳置零：其他进程的下一次 heartbeat() 清理本进程的会话并推送离开增量"""
+        self._writer.execute(lambda conn: conn.execute(
+            'UPDATE presence_nodes SET seen = 0 WHERE node = ?', (self.node_id,)))
+
+    def current_room(self, sid):
+        return self._local.current_room(sid)
+
+    def room_members(self, room):
+        rows = self._query('SELECT DISTINCT username FROM presence_sessions WHERE room = ? ORDER BY username', (room,))
+        return [row[0] for row in rows]
+
+    def username(self, sid):
+        return self._local.username(sid)
+
+    def sessions(self, username):
+        """该用户在本进程中的会话"""
+        return self._local.sessions(username)
+
+    def is_online(self, username):
+        return bool(self._query('SELECT 1 FROM presence_sessions WHERE username = ? LIMIT 1', (username,)))
+
+    def online_users(self):
+        return [row[0] for row in self._query('SELECT DISTINCT username FROM presence_sessions ORDER BY username')]
+
+    def stats(self):
+        data = self._local.stats()
+        rows = self._query('SELECT COUNT(*), COUNT(DISTINCT username), COUNT(DISTINCT node) FROM presence_sessions')
+        data['node'] = self.node_id
+        data['cluster_sessions'], data['cluster_users'], data['cluster_nodes'] = rows[0]
+        return data
+
+
+class PresenceBatcher:
+    """把聊天室成员的进出合并成增量，每个窗口每个聊天室最多推送一次
+
+    每个用户在窗口内只保留最后一次动作：重连风暴中先离开再进入的用户只出现一次。
+    不直接抵消成“无变化”，因为窗口内刚拿到全量快照的客户端可能需要这条增量；
+    对已经是该状态的客户端，重复的 joined/left 没有影响。
+    窗口结束时调用 emit(room, joined, left)。
+    spawn/sleep 默认用线程实现，app.py 传入 socketio 的对应函数以适配异步模式。
+    """
+
+    def __init__(self, emit, delay_ms=PRESENCE_DEBOUNCE_MS, spawn=None, sleep=None):
+        self._emit = emit
+        self.delay = max(0, delay_ms) / 1000
+        self._spawn = spawn or self._spawn_thread
+        self._sleep = sleep or time.sleep
+        self._pending = {}
+        self._scheduled = False
+        self._lock = threading.Lock()
+        self._stats = {'recorded': 0, 'coalesced': 0, 'flushes': 0, 'events': 0}
+
+    @staticmethod
+    def _spawn_thread(target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+
+    def joined(self, room, username):
+        self._record(room, username, True)
+
+    def left(self, room, username):
+        self._record(room, username, False)
+
+    def _record(self, room, username, present):
+        with self._lock:
+            self._stats['recorded'] += 1
+            changes = self._pending.setdefault(room, {})
+            if username in changes:
+                self._stats['coalesced'] += 1
+            changes[username] = present
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._spawn(self._flush_later)
+
+    def _flush_later(self):
+        self._sleep(self.delay)
+        self.flush()
+
+    def flush(self):
+        """立即推送所有积攒的增量"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._scheduled = False
+            self._stats['flushes'] += 1
+        for room, changes in pending.items():
+            joined = sorted(name for name, present in changes.items() if present)
+            left = sorted(name for name, present in changes.items() if not present)
+            try:
+                self._emit(room, joined, left)
+            except Exception as e:
+                print(f"[!] 推送在线状态失败: {e}")
+                continue
+            with self._lock:
+                self._stats['events'] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['pending_rooms'] = len(self._pending)
+        return data
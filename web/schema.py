@@ -0,0 +1,323 @@
+# web/schema.py
+"""数据库结构迁移：按版本号（PRAGMA user_version）依次执行，已部署的数据库文件启动时自动升级
+
+也可以单独运行做查询计划检查：
+
+    python web/schema.py --check-plans
+
+它在临时目录里建库、调用 app.py 的全部数据函数，记录实际执行的每条 SQL，
+再对它们做 EXPLAIN QUERY PLAN，发现消息类大表被全表扫描时以非零状态退出。
+"""
+import os
+import sqlite3
+import sys
+
+
+def fts5_trigram_available(conn):
+    """当前 SQLite 是否支持 FTS5 的 trigram 分词器（3.34+）"""
+    try:
+        conn.execute('CREATE VIRTUAL TABLE temp._fts_probe USING fts5(x, tokenize=\'trigram\')')
+        conn.execute('DROP TABLE temp._fts_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def create_message_fts(conn):
+    """为聊天室消息和私人消息建立 FTS5 全文索引，由触发器与原表保持同步
+
+    trigram 分词器按 3 个字符切分，不依赖空格分词，中文同样适用，
+    并且大小写不敏感；少于 3 个字符的关键词由 app.py 回退到 LIKE。
+    两张索引表都是外部内容表（不重复存储消息正文），
+    用户名也建入索引，方便在 MATCH 中先按发送者缩小范围。
+    """
+    if not fts5_trigram_available(conn):
+        print("[!] 当前 SQLite 不支持 FTS5 trigram 分词器，消息搜索将使用 LIKE")
+        return
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+            message, username,
+            content='chat_messages', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS private_messages_fts USING fts5(
+            message, from_user,
+            content='private_messages', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    for table, fts, columns in (
+        ('chat_messages', 'chat_messages_fts', ('message', 'username')),
+        ('private_messages', 'private_messages_fts', ('message', 'from_user')),
+    ):
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts} (rowid, {column_list}) VALUES (new.id, {new_values});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {fts} (rowid, {column_list}) VALUES (new.id, {new_values});
+            END
+        ''')
+        # 为已有消息建立索引
+        conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+# 聊天数据库的迁移列表：(版本号, 说明, SQL 语句列表或 callable(conn))
+# 版本 0 是 init_db 中 CREATE TABLE IF NOT EXISTS 创建的初始结构
+CHAT_MIGRATIONS = [
+    (1, '为消息和聊天室关系表添加索引', [
+        # load_chat_history: WHERE room_id = ? ORDER BY id
+        'CREATE INDEX IF NOT EXISTS idx_chat_messages_room_id ON chat_messages (room_id, id)',
+        # fetch_user_room_messages: WHERE username = ? ORDER BY id
+        'CREATE INDEX IF NOT EXISTS idx_chat_messages_username_id ON chat_messages (username, id)',
+        # load_private_messages: 两个方向的 (from_user, to_user) 各一次索引查找
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_pair ON private_messages (from_user, to_user, id)',
+        # get_private_chats: WHERE from_user = ? OR to_user = ?
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_to_user ON private_messages (to_user, from_user, id)',
+        # fetch_user_private_messages: WHERE from_user = ? ORDER BY id
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_from_user ON private_messages (from_user, id)',
+        # delete_chat_room: DELETE FROM user_rooms WHERE room_id = ?
+        'CREATE INDEX IF NOT EXISTS idx_user_rooms_room_id ON user_rooms (room_id)',
+        # get_user_created_rooms: WHERE created_by = ?
+        'CREATE INDEX IF NOT EXISTS idx_chat_rooms_created_by ON chat_rooms (created_by)',
+    ]),
+    (2, '建立消息全文索引（FTS5）', create_message_fts),
+    (3, '多进程模式的共享在线状态表', [
+        # SharedPresenceRegistry：每个会话一行，进程退出后由其他进程按心跳清理
+        '''CREATE TABLE IF NOT EXISTS presence_sessions (
+            node TEXT NOT NULL,
+            sid TEXT NOT NULL,
+            username TEXT NOT NULL,
+            room TEXT NOT NULL,
+            PRIMARY KEY (node, sid)
+        )''',
+        # 上下线、进出聊天室的计数：WHERE username = ? [AND room = ?]
+        'CREATE INDEX IF NOT EXISTS idx_presence_sessions_username ON presence_sessions (username, room)',
+        # room_members: WHERE room = ? ORDER BY username
+        'CREATE INDEX IF NOT EXISTS idx_presence_sessions_room ON presence_sessions (room, username)',
+        'CREATE TABLE IF NOT EXISTS presence_nodes (node TEXT PRIMARY KEY, seen REAL NOT NULL)',
+    ]),
+    (4, '私人消息的 to_user 索引改为单列', [
+        # (to_user, from_user, id) 与 idx_private_messages_pair 重复：两个方向的会话都由 pair 查找，
+        # 它只在 get_private_chats 的 OR 分支（WHERE to_user = ?）用到第一列。
+        # 私人消息现在的索引：
+        #   pair (from_user, to_user, id)  load_private_messages 两个方向、fetch_user_private_messages 指定 partner
+        #   from_user (from_user, id)      fetch_user_private_messages 不指定 partner 时按 id 翻页，免去排序
+        #   to_user (to_user)              get_private_chats 的 OR 分支（MULTI-INDEX OR）
+        'DROP INDEX IF EXISTS idx_private_messages_to_user',
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_to_user_only ON private_messages (to_user)',
+    ]),
+]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def ensure_message_fts(conn):
+    """启动时补建消息全文索引，返回索引是否存在
+
+    迁移 2 执行时 SQLite 不支持 trigram 会跳过建表，但版本号照常升到 2（后面的迁移不能因此
+    卡住），之后换了支持 trigram 的 SQLite 也不会再执行迁移 2，所以每次启动检查一次。
+    """
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'"
+    if conn.execute(query).fetchone():
+        return True
+    if not fts5_trigram_available(conn):
+        return False
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # 拿到写锁后再确认一次，可能已经被其他进程建好
+        if not conn.execute(query).fetchone():
+            create_message_fts(conn)
+            print("[*] 补建消息全文索引（FTS5）")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
+
+
+def migrate(conn, migrations=CHAT_MIGRATIONS):
+    """执行尚未应用的迁移，返回迁移后的版本号
+
+    每个版本在独立的 BEGIN IMMEDIATE 事务中执行并同时更新 user_version，
+    多个进程同时启动时只有一个会真正执行某个版本。
+    """
+    for version, description, statements in migrations:
+        if current_version(conn) >= version:
+            continue
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 拿到写锁后再确认一次，可能已经被其他进程升级
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            if callable(statements):
+                statements(conn)
+            else:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+            print(f"[*] 数据库迁移到版本 {version}: {description}")
+        except Exception:
+            conn.rollback()
+            raise
+    return current_version(conn)
+
+
+# ---------------- 查询计划检查 ----------------
+
+# 这些表会随消息量增长，查询必须走索引
+WATCHED_TABLES = ('chat_messages', 'private_messages', 'user_rooms')
+
+# 不需要检查的语句（事务控制、建表、连接设置等）
+IGNORED_PREFIXES = (
+    'PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE',
+    'CREATE', 'SELECT 1',
+)
+
+
+def find_full_scans(conn, sql):
+    """返回 sql 的查询计划中对大表的全表扫描步骤"""
+    try:
+        # 跟踪到的语句一般已经把参数展开成字面量
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    except sqlite3.ProgrammingError:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?')).fetchall()
+    problems = []
+    for row in rows:
+        detail = row[-1]
+        if not detail.startswith('SCAN '):
+            continue
+        table = detail.split()[1]
+        if table in WATCHED_TABLES and 'INDEX' not in detail:
+            problems.append(detail)
+    return [row[-1] for row in rows], problems
+
+
+def _exercise_app(app_module):
+    """以真实参数调用 app.py 中的每个数据函数"""
+    m = app_module
+    m.register_user('alice', 'secret1')
+    m.register_user('bob', 'secret1')
+    m.authenticate_user('alice', 'secret1')
+    m.get_user_certificate('alice')
+    m.get_all_usernames()
+    m.create_chat_room('room1', 'alice')
+    m.create_chat_room_with_type('room2', 'alice', 'private')
+    m.create_chat_room_with_type('room3', 'bob', 'public')
+    m.join_chat_room('alice', 'room1')
+    m.join_chat_room('bob', 'room1')
+    m.leave_chat_room('bob', 'room1')
+    m.get_chat_rooms()
+    m.get_chat_rooms_public_only()
+    m.get_user_rooms('alice')
+    m.get_user_created_rooms('alice')
+    token = m.create_chat_room_with_type('room4', 'bob', 'private').get('token')
+    m.get_chat_room_by_token(token)
+    m.join_chat_room_by_token('alice', token)
+
+    room_id = m.save_chat_message('alice', 'hello', 'room1')
+    private_id = m.save_private_message('alice', 'bob', 'hi bob')
+    m.save_private_message('bob', 'alice', 'hi alice')
+    # 等待写线程把上面的消息提交
+    m.chat_writer.execute(lambda conn: None)
+
+    m.load_chat_history('room1')
+    m.load_chat_history('room1', before_id=room_id)
+    m.load_chat_history('room1', after_id=room_id)
+    m.load_private_messages('alice', 'bob')
+    m.load_private_messages('alice', 'bob', before_id=private_id)
+    m.load_private_messages('alice', 'bob', after_id=private_id)
+    m.get_private_chats('alice')
+    m.fetch_user_room_messages('alice')
+    m.fetch_user_room_messages('alice', room_id='room1', keyword='hel')
+    m.fetch_user_room_messages('alice', before_id=room_id)
+    m.fetch_user_private_messages('alice')
+    m.fetch_user_private_messages('alice', partner='bob', keyword='hi')
+    m.fetch_user_private_messages('alice', after_id=private_id)
+    m.search_user_room_messages('alice', 'hello')
+    m.search_user_room_messages('alice', 'hello', room_id='room1')
+    m.search_user_private_messages('alice', 'hi bob', partner='bob')
+    m.delete_room_message_by_user(room_id, 'alice')
+    m.delete_private_message_by_user(private_id, 'alice')
+    m.delete_chat_room('room3', 'bob')
+
+
+def check_query_plans():
+    """在临时数据库上运行 app.py 的全部数据函数并检查查询计划，返回发现的问题数"""
+    import importlib
+    import tempfile
+    import threading
+
+    web_dir = os.path.dirname(os.path.abspath(__file__))
+    if web_dir not in sys.path:
+        sys.path.insert(0, web_dir)
+
+    import database
+
+    statements = []
+    statements_lock = threading.Lock()
+
+    def record(sql):
+        with statements_lock:
+            statements.append(sql)
+
+    database.set_trace_callback(record)
+
+    workdir = tempfile.mkdtemp(prefix='chat-plan-check-')
+    os.chdir(workdir)
+    app_module = importlib.import_module('app')
+    _exercise_app(app_module)
+    database.set_trace_callback(None)
+
+    seen = set()
+    failures = 0
+    for sql in statements:
+        normalized = ' '.join(sql.split())
+        if normalized in seen or normalized.upper().startswith(IGNORED_PREFIXES):
+            continue
+        if 'sqlite_sequence' in normalized:
+            continue
+        seen.add(normalized)
+        # 语句可能属于 chat_messages.db 或 users.db，依次尝试
+        for pool in (database.chat_pool, database.users_pool):
+            with pool.connection() as conn:
+                try:
+                    plan, problems = find_full_scans(conn, normalized)
+                    break
+                except Exception:
+                    continue
+        else:
+            print(f"[skip] {normalized}")
+            continue
+        status = 'FAIL' if problems else 'ok'
+        print(f"[{status}] {normalized}")
+        for step in plan:
+            print(f"        {step}")
+        failures += len(problems)
+    print(f"\n检查了 {len(seen)} 条语句，发现 {failures} 处全表扫描")
+    return failures
+
+
+if __name__ == '__main__':
+    if '--check-plans' in sys.argv:
+        sys.exit(1 if check_query_plans() else 0)
+    print(__doc__)
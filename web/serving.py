@@ -0,0 +1,163 @@
+# web/serving.py
+"""服务模式：threading（Werkzeug 开发服务器）、eventlet 或 gevent（协程 + 生产级 WSGI 服务器）
+
+    CHAT_ASYNC_MODE=eventlet python web/app.py
+
+模式必须在导入 Flask 等模块之前确定（协程模式要先给标准库打补丁），所以用环境变量选择。
+协程模式只替换 socket/select/time 等 I/O，不替换 threading：数据库写线程和连接池仍然
+使用真实的线程和锁。SQLite 调用会阻塞整个事件循环，因此 app.py 的数据函数用 @offloaded
+标记，在协程模式下放到线程池执行，调用它的协程只等待结果；threading 模式下直接调用。
+"""
+import functools
+import os
+import queue
+import socket
+import threading
+
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+ASYNC_MODE = os.environ.get('CHAT_ASYNC_MODE', 'threading')
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"unknown CHAT_ASYNC_MODE: {ASYNC_MODE}")
+
+_execute = None
+# 协程模式下只挂起当前协程、等待文件描述符可读的函数
+_wait_readable = None
+# 打补丁之前的 os.read/os.write：LoopCallbacks 的唤醒管道在真实线程里写，不能走协程版本
+_os_read = os.read
+_os_write = os.write
+
+
+def monkey_patch():
+    """协程模式下给标准库打补丁，必须在导入 Flask、flask_socketio 之前调用"""
+    global _execute, _wait_readable
+    if ASYNC_MODE == 'eventlet':
+        import eventlet
+        from eventlet import tpool
+        from eventlet.hubs import trampoline
+        eventlet.monkey_patch(thread=False)
+        _execute = tpool.execute
+        _wait_readable = lambda fd: trampoline(fd, read=True)
+    elif ASYNC_MODE == 'gevent':
+        import gevent
+        from gevent import monkey
+        from gevent.socket import wait_read
+        # queue 也不替换：数据库写线程在真实线程里阻塞等待 queue.Queue
+        monkey.patch_all(thread=False, queue=False)
+        _execute = lambda fn, *args, **kwargs: gevent.get_hub().threadpool.apply(fn, args, kwargs)
+        _wait_readable = wait_read
+
+
+def offload(fn, *args, **kwargs):
+    """在线程池中执行阻塞调用并等待结果，只挂起当前协程
+
+    threading 模式、或者已经在线程池线程中（数据函数互相调用）时直接执行。
+    """
+    if _execute is None or threading.current_thread() is not threading.main_thread():
+        return fn(*args, **kwargs)
+    return _execute(fn, *args, **kwargs)
+
+
+def offloaded(fn):
+    """装饰器：调用 fn 时经过 offload()"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return offload(fn, *args, **kwargs)
+    return wrapper
+
+
+class LoopCallbacks:
+    """把其他 OS 线程（如数据库写线程的 Future 回调）中的调用交回事件循环执行
+
+    协程模式下不能在事件循环以外的线程里调用 socketio.emit。call() 把调用放进队列，
+    再往唤醒管道写一个字节；run_forever() 作为 socketio 后台任务由事件循环等待管道可读
+    （eventlet 的 trampoline、gevent 的 wait_read，eventlet.tpool 交回结果也是这样唤醒），
+    醒来后执行队列中的全部调用，不占用线程池的线程。threading 模式下后台任务是真实线程，
+    直接阻塞在队列上。
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._rfd = self._wfd = None
+        if _wait_readable is not None:
+            self._rfd, self._wfd = os.pipe()
+            os.set_blocking(self._rfd, False)
+            os.set_blocking(self._wfd, False)
+
+    def call(self, fn, *args):
+        """可以在任意线程调用：安排 fn(*args) 在事件循环中执行"""
+        self._queue.put((fn, args))
+        if self._wfd is not None:
+            try:
+                _os_write(self._wfd, b'\0')
+            except BlockingIOError:
+                # 管道已满：事件循环已经有未处理的唤醒
+                pass
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"[!] Event loop callback failed: {e!r}")
+
+    def run_forever(self):
+        if self._rfd is None:
+            while True:
+                self._run(*self._queue.get())
+        while True:
+            _wait_readable(self._rfd)
+            # 先清空唤醒字节再取队列：之后放入的调用会再次唤醒
+            try:
+                while _os_read(self._rfd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            while True:
+                try:
+                    fn, args = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._run(fn, args)
+
+
+def _no_delay(sock):
+    """监听 socket 上设置 TCP_NODELAY，Linux 上 accept 出来的连接继承该选项
+
+    切换聊天室时服务器连续发出一个大帧（历史）和几个小帧（系统消息），Nagle 算法会让
+    小帧等待对端的延迟确认，每次切换多出约 40 ms。三种模式都关闭 Nagle。
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def run(socketio, app, host, port, certfile, keyfile):
+    """按当前模式启动服务器，TLS 在服务器进程内终结"""
+    print(f"[*] Web chat ({ASYNC_MODE}) listening on https://{host}:{port}")
+    if ASYNC_MODE == 'threading':
+        from werkzeug.serving import WSGIRequestHandler
+
+        class NoDelayRequestHandler(WSGIRequestHandler):
+            disable_nagle_algorithm = True  # socketserver 在 setup() 中设置 TCP_NODELAY
+
+        socketio.run(app, host=host, port=port, ssl_context=(certfile, keyfile), allow_unsafe_werkzeug=True,
+                     request_handler=NoDelayRequestHandler)
+    elif ASYNC_MODE == 'eventlet':
+        # 与 socketio.run 相同的 eventlet.wsgi 服务器，每个 WebSocket 连接只占一个协程；
+        # 自己创建监听 socket 以便设置 TCP_NODELAY
+        import eventlet
+        import eventlet.wsgi
+        listener = eventlet.listen((host, port))
+        _no_delay(listener)
+        listener = eventlet.wrap_ssl(listener, certfile=certfile, keyfile=keyfile, server_side=True)
+        eventlet.wsgi.server(listener, app, log_output=False)
+    else:
+        from gevent import pywsgi
+        options = {}
+        try:
+            # 与 socketio.run 一致：装了 gevent-websocket 就用它处理 WebSocket，否则由 simple-websocket 处理
+            from geventwebsocket.handler import WebSocketHandler
+            options['handler_class'] = WebSocketHandler
+        except ImportError:
+            pass
+        server = pywsgi.WSGIServer((host, port), app, certfile=certfile, keyfile=keyfile, log=None, **options)
+        server.init_socket()
+        _no_delay(server.socket)
+        server.serve_forever()
@@ -1,4 +1,5 @@
 // web/static/js/chat.js
+// 依赖 history.js（decodeHistory），需在本文件之前加载
 (function () {
   const messagesEl = document.getElementById("messages");
   const formEl = document.getElementById("chat-form");
@@ -213,7 +214,7 @@
   socket.on("room_history", function (data) {
     clearMessages();
     updateCurrentRoomDisplay(data.room);
-    data.history.forEach(function (msg) {
+    decodeHistory(data, { room: data.room, type: 'room' }).forEach(function (msg) {
       appendMessage(msg.text, msg.user, msg.time, false);
     });
   });
@@ -256,8 +257,8 @@
   // 收到私人消息历史
   socket.on("private_history", function (data) {
     clearMessages();
-    data.history.forEach(function (msg) {
-      const displayName = msg.from_user === window.me ? '我' : msg.from_user;
+    decodeHistory(data, { type: 'private', partner: data.other_user }).forEach(function (msg) {
+      const displayName = msg.user === window.me ? '我' : msg.user;
       appendMessage(msg.text, displayName, msg.time, false, true);
     });
   });
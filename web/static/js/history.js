@@ -0,0 +1,50 @@
+// web/static/js/history.js
+// 解码 room_history / private_history 事件中的 history 字段（列式格式见 web/history_codec.py）
+(function (global) {
+  function pad(n) {
+    return (n < 10 ? '0' : '') + n;
+  }
+
+  // 时间戳按 UTC 解析和格式化：只做秒数加减，不受浏览器时区和夏令时影响
+  function parseTimestamp(text) {
+    const m = /^(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})$/.exec(text);
+    return Date.UTC(+m[1], m[2] - 1, +m[3], +m[4], +m[5], +m[6]);
+  }
+
+  function formatTimestamp(ms) {
+    const d = new Date(ms);
+    return d.getUTCFullYear() + '-' + pad(d.getUTCMonth() + 1) + '-' + pad(d.getUTCDate()) + ' ' +
+      pad(d.getUTCHours()) + ':' + pad(d.getUTCMinutes()) + ':' + pad(d.getUTCSeconds());
+  }
+
+  function decodeTimestamps(columns) {
+    if (columns.timestamp) return columns.timestamp;
+    const timestamps = [];
+    let current = columns.ts.length ? parseTimestamp(columns.t0) : 0;
+    columns.ts.forEach(function (delta) {
+      current += delta * 1000;
+      timestamps.push(formatTimestamp(current));
+    });
+    return timestamps;
+  }
+
+  // 返回与旧格式相同的消息对象数组；fields 是整页相同、服务器没有逐条发送的字段（room、type、partner）
+  global.decodeHistory = function (data, fields) {
+    if (data.format !== 'columns') return data.history || [];
+    const columns = data.history;
+    const timestamps = decodeTimestamps(columns);
+    const messages = new Array(columns.id.length);
+    let id = 0;
+    for (let i = 0; i < columns.id.length; i++) {
+      id += columns.id[i];
+      messages[i] = Object.assign({
+        id: id,
+        user: columns.users[columns.user[i]],
+        text: columns.text[i],
+        time: timestamps[i].split(' ').pop(),
+        timestamp: timestamps[i]
+      }, fields);
+    }
+    return messages;
+  };
+})(window);